@@ -4,44 +4,249 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
+import hashlib
 import json
+import os
+import tempfile
+import threading
+import uuid
+import zlib
+from collections import deque
+from concurrent.futures import Future
 from functools import partial
+from pathlib import Path
 
 import socketio
 from logger import LoggerHandler
 
+try:
+    import msgpack
+except ImportError:  # without msgpack server answers in JSON
+    msgpack = None
+
 log = LoggerHandler.new(__name__)
-serverlog = []
 
+# Size of one file chunk sent to/received from server
+RELAY_CHUNK = 256 * 1024
+# Max amount of file chunks in flight for one transfer
+RELAY_WINDOW = 4
+# Flags in the first byte of server's binary answers
+MSGPACK = 0x01
+ZLIB = 0x80
 
-class Client:
-    sio = socketio.Client()
 
-    def __init__(self, asst_ip: str) -> None:
-        self.sio.connect(asst_ip)
-        self.serverlog = serverlog
+def decode(answer):
+    """Decode server's answer: JSON text or binary frame with format flags"""
+    if isinstance(answer, str):
+        return json.loads(answer)
+    flags, payload = answer[0], answer[1:]
+    if flags & ZLIB:
+        payload = zlib.decompress(payload)
+    if flags & MSGPACK:
+        return msgpack.unpackb(payload, raw=False)
+    return json.loads(payload)
+
 
-    @sio.event
-    def connect():
+class Client:
+    def __init__(self, asst_ip: str, log_level: str = "debug") -> None:
+        # Own connection for every client, answers matched to requests by ack ids
+        self.sio = socketio.Client()
+        self.serverlog = []
+        # Futures of submitted jobs waiting for 'job_done' event
+        self.jobs: dict = {}
+        self._finished: dict = {}
+        # Per host results of running fan-out jobs
+        self.fanouts: dict = {}
+        self._lock = threading.Lock()
+        self.sio.on("connect", self.connect)
+        self.sio.on("disconnect", self.disconnected)
+        self.sio.on("server_log", self.server_log)
+        self.sio.on("server_log_frame", self.server_log_frame)
+        self.sio.on("job_done", self.job_done)
+        self.sio.on("job_output", self.job_output)
+        self.sio.on("fanout_result", self.fanout_result)
+        # Server picks the best encoding it supports, answers describe themselves
+        encodings = (["msgpack"] if msgpack is not None else []) + ["json"]
+        self.sio.connect(asst_ip, auth={"encodings": encodings, "compress": ["zlib"]})
+        # Server's log messages are received in batches and only from given level.
+        # Answer is not awaited, so startup doesn't pay for extra round trip.
+        self.exec_async(
+            {
+                "type": "system",
+                "job": "log_subscribe",
+                "params": {"level": log_level, "frames": True},
+            }
+        )
+
+    def connect(self):
         log.info("connection established")
 
-    @sio.event
-    def exec(self, data):
-        out = None
+    def exec_async(self, data) -> Future:
+        """Send command to server without waiting for the answer
+
+        Returns:
+            Future -- will contain decoded server's answer
+        """
+        future = Future()
 
-        def callback(*data):
-            nonlocal out
-            out = data
+        def callback(*answer):
+            try:
+                future.set_result(decode(answer[0]))
+            except Exception as e:
+                future.set_exception(e)
 
         log.info(f"command sended: {data}")
         self.sio.emit("message", data, callback=callback)
-        while not out:
-            pass
-        return json.loads(out[0])
+        return future
+
+    def exec(self, data, timeout: float = None):
+        """Send command to server and wait for the answer"""
+        return self.exec_async(data).result(timeout)
+
+    def submit(self, data) -> Future:
+        """Submit job to server, result is delivered later with 'job_done' event
+
+        Returns:
+            Future -- will contain job's result
+        """
+        future = Future()
+
+        def accepted(answer: Future):
+            try:
+                result = answer.result()
+            except Exception as e:
+                future.set_exception(e)
+                return
+            if not result.get("job_id"):
+                future.set_result(result)
+                return
+            future.job_id = result["job_id"]
+            with self._lock:
+                # Job could be already done before its ack was processed
+                done = self._finished.pop(result["job_id"], None)
+                if done is None:
+                    self.jobs[result["job_id"]] = future
+            if done is not None:
+                future.set_result(done)
+
+        self.exec_async({**data, "mode": "submit"}).add_done_callback(accepted)
+        return future
+
+    def cancel(self, job_id: str):
+        return self.exec(
+            {"type": "system", "job": "cancel", "params": {"job_id": job_id}}
+        )
+
+    def request(self, event: str, data: dict) -> Future:
+        """Send file relay event, answers are plain dicts with possible binary data"""
+        future = Future()
+        self.sio.emit(event, data, callback=lambda answer: future.set_result(answer))
+        return future
+
+    @staticmethod
+    def _relay_ok(answer: dict) -> dict:
+        if not answer.get("result"):
+            raise IOError(f"file relay failed: {answer.get('reason')}")
+        return answer
+
+    def _relay_write(self, file, offset: int, answer: Future):
+        file.seek(offset)
+        file.write(self._relay_ok(answer.result())["data"])
 
-    @sio.event
-    def server_log(data):
-        serverlog.append(data)
+    def upload(self, src, dst: str, chunk_size: int = RELAY_CHUNK) -> dict:
+        """Stream local file to remote host through server, nothing is stored on it
+
+        Returns:
+            dict -- transfer stats
+        """
+        start = self._relay_ok(self.request("upload_start", {"path": dst}).result())
+        transfer_id = start["transfer_id"]
+        inflight = deque()
+        end = {"transfer_id": transfer_id}
+        try:
+            with open(src, "rb") as file:
+                offset = 0
+                while True:
+                    data = file.read(chunk_size)
+                    if not data:
+                        break
+                    chunk = {"transfer_id": transfer_id, "offset": offset, "data": data}
+                    inflight.append(self.request("upload_chunk", chunk))
+                    offset += len(data)
+                    # Only few chunks wait for server's ack, so memory is bounded
+                    while len(inflight) >= RELAY_WINDOW:
+                        self._relay_ok(inflight.popleft().result())
+            while inflight:
+                self._relay_ok(inflight.popleft().result())
+            # Server replaces remote file only when upload is complete
+            end["size"] = offset
+        finally:
+            end = self.request("upload_end", end).result()
+        return self._relay_ok(end)
+
+    def download(self, src: str, dst, chunk_size: int = RELAY_CHUNK) -> dict:
+        """Stream remote file from remote host through server into local file
+
+        Returns:
+            dict -- transfer stats
+        """
+        start = self._relay_ok(self.request("download_start", {"path": src}).result())
+        transfer_id = start["transfer_id"]
+        inflight = deque()
+        try:
+            with open(dst, "wb") as file:
+                for offset in range(0, start["size"], chunk_size):
+                    chunk = {
+                        "transfer_id": transfer_id,
+                        "offset": offset,
+                        "size": chunk_size,
+                    }
+                    inflight.append((offset, self.request("download_chunk", chunk)))
+                    while len(inflight) >= RELAY_WINDOW:
+                        self._relay_write(file, *inflight.popleft())
+                while inflight:
+                    self._relay_write(file, *inflight.popleft())
+        finally:
+            end = self.request("download_end", {"transfer_id": transfer_id}).result()
+        return self._relay_ok(end)
+
+    def job_done(self, data):
+        with self._lock:
+            future = self.jobs.pop(data["job_id"], None)
+            if future is None:
+                self._finished[data["job_id"]] = data["result"]
+        if future is not None:
+            future.set_result(data["result"])
+
+    def job_output(self, data):
+        # Returned value is ack for server, it sends next chunks only after acks
+        log.info(f"[{data['job_id']}] {data['stream']}: {data['data']}")
+        return True
+
+    def fanout(self, data) -> dict:
+        """Run job on many hosts, wait for all of them
+
+        Returns:
+            dict -- server's summary with 'results' of every host added
+        """
+        fanout_id = uuid.uuid4().hex
+        self.fanouts[fanout_id] = {}
+        try:
+            summary = self.exec({**data, "fanout_id": fanout_id})
+        finally:
+            results = self.fanouts.pop(fanout_id)
+        if isinstance(summary, dict):
+            summary["results"] = results
+        return summary
+
+    def fanout_result(self, data):
+        results = self.fanouts.get(data["fanout_id"])
+        if results is not None:
+            results[data["host"]] = data["result"]
+        log.debug(f"[{data['host']}] result: {data['result']}")
+
+    def server_log(self, data):
+        self.serverlog.append(data)
         if "[DEBUG]" in data:
             log.debug(f"server said: {str(data)}")
         if "[INFO]" in data:
@@ -53,16 +258,132 @@ class Client:
         if "[CRITICAL]" in data:
             log.critical(f"server said: {str(data)}")
 
-    @sio.event
-    def disconnect(self):
+    def server_log_frame(self, data):
+        for line in data["lines"]:
+            self.server_log(line)
+        if data["dropped"]:
+            log.warning(f"server dropped {data['dropped']} log messages")
+
+    def disconnected(self):
         log.info("disconnected from server")
 
+    def disconnect(self):
+        self.sio.disconnect()
+
+
+class Batch:
+    def __init__(self, client: Client, on_error: str = "stop"):
+        """Collects server's job calls and sends them in one 'batch' message.
+
+        Use as context manager, calls are sent on exit:
+            with do.batch() as batch:
+                batch.show_hostname()
+                batch.show_uptime()
+            print(batch.results)
+
+        Arguments:
+            client {Client} -- connected client
+            on_error {str} -- 'stop' to skip jobs after failed one or 'continue'
+        """
+        self.client = client
+        self.on_error = on_error
+        self.items = []
+        self.results = []
+        self.answer = None
+
+    def __getattr__(self, name: str):
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        def call(*args):
+            self.items.append({"func": name, "params": args})
+            return len(self.items) - 1
+
+        return call
+
+    def flush(self) -> list:
+        """Send collected calls, returns results in the same order"""
+        if not self.items:
+            return []
+        self.answer = self.client.exec(
+            {"type": "batch", "items": self.items, "on_error": self.on_error}
+        )
+        self.items = []
+        if isinstance(self.answer, dict) and "results" in self.answer:
+            self.results.extend(self.answer["results"])
+            for result in self.answer["results"]:
+                ClientWrapper.check_result(result)
+        else:
+            log.error(f"batch failed: {self.answer}")
+        return self.results
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.flush()
+        return False
+
+
+class ManifestCache:
+    def __init__(self, asst_ip: str, cache_dir: Path = None):
+        """Local copy of server's command manifest.
+
+        One file per server address, it keeps manifest with its version, so new
+        client processes don't need to request the command list on start.
+
+        Arguments:
+            asst_ip {str} -- server's address
+            cache_dir {Path} -- directory for cache files, ASST_CACHE_DIR env
+                or ~/.cache/asst by default
+        """
+        cache_dir = cache_dir or os.environ.get(
+            "ASST_CACHE_DIR", Path.home() / ".cache" / "asst"
+        )
+        name = hashlib.sha1(asst_ip.encode()).hexdigest()[:16]
+        self.path = Path(cache_dir, f"manifest-{name}.json")
+
+    def load(self) -> dict:
+        try:
+            manifest = json.loads(self.path.read_text())
+            if manifest.get("version") and "commands" in manifest:
+                return manifest
+        except (OSError, ValueError) as e:
+            log.debug(f"no cached manifest: {e}")
+        return None
+
+    def save(self, manifest: dict):
+        # Write into temp file and rename, so parallel processes never read half a file
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.path.parent, suffix=".tmp")
+            with os.fdopen(fd, "w") as file:
+                json.dump(manifest, file)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            log.warning(f"can't save manifest cache: {e}")
+
 
 class ClientWrapper:
+    @staticmethod
+    def check_result(result):
+        match result:
+            case [var1] if var1 is False:
+                log.warning("server not return any positive result")
+            case [var1, var2] if var1 == 0:
+                log.debug(f"Result received from server: {var2}")
+            case [var1, var2] if var1 != 0:
+                log.warning(f"RC: {var1} | {var2}")
+            case []:
+                log.error("no answer from server")
+        return result
+
     @staticmethod
     def mkfunc(name):
-        def func(client, func, *args):
-            result = client.exec(
+        def func(client, func, *args, wait: bool = True):
+            """Call server's job. With wait=False returns Future instead of result."""
+            future = client.exec_async(
                 {
                     "type": "module",
                     "job": "ssh",
@@ -70,33 +391,126 @@ class ClientWrapper:
                     "params": args,
                 }
             )
-            match result:
-                case [var1] if var1 is False:
-                    log.warning("server not return any positive result")
-                case [var1, var2] if var1 == 0:
-                    log.debug(f"Result received from server: {var2}")
-                case [var1, var2] if var1 != 0:
-                    log.warning(f"RC: {var1} | {var2}")
-                case []:
-                    log.error("no answer from server")
-            return result
+            if wait:
+                return ClientWrapper.check_result(future.result())
+
+            def check(done: Future):
+                if not done.exception():
+                    ClientWrapper.check_result(done.result())
+
+            future.add_done_callback(check)
+            return future
 
         return func
 
-    def __init__(self, asst_ip: str):
+    def __init__(self, asst_ip: str, cache_dir: Path = None, revalidate: bool = True):
+        """Connect to server and build methods for all server's commands.
+
+        Commands are taken from local manifest cache if it exists, then cache
+        is checked against server in background (if 'revalidate' is True).
+        Unknown method always triggers check of server's manifest.
+        """
         self.client = Client(asst_ip)
-        commands = self.client.exec(
-            {"type": "system", "job": "get_server_command_list"}
-        )
-        log.debug(f"Server's commands: {commands}")
+        self.cache = ManifestCache(asst_ip, cache_dir)
+        self.manifest = self.cache.load()
+        if self.manifest is None:
+            self.refresh()
+        else:
+            log.debug(f"Cached server's commands: {list(self.manifest['commands'])}")
+            self._build(self.manifest["commands"])
+            if revalidate:
+                threading.Thread(target=self.refresh, daemon=True).start()
+
+    def _build(self, commands):
         for command in commands:
             func = partial(self.mkfunc(command), self.client, command)
-            setattr(self.__class__, command, staticmethod(func))
+            setattr(self, command, func)
+
+    def refresh(self) -> bool:
+        """Check server's manifest version, download it only if it was changed
+
+        Returns:
+            bool -- True if commands were rebuilt
+        """
+        version = self.manifest["version"] if self.manifest else None
+        answer = self.client.exec(
+            {
+                "type": "system",
+                "job": "get_server_command_manifest",
+                "params": {"version": version},
+            }
+        )
+        if not answer.get("changed"):
+            return False
+        log.debug(f"Server's commands: {list(answer['commands'])}")
+        outdated = set(self.manifest["commands"]) if self.manifest else set()
+        for command in outdated - set(answer["commands"]):
+            self.__dict__.pop(command, None)
+        self.manifest = {"version": answer["version"], "commands": answer["commands"]}
+        self._build(self.manifest["commands"])
+        self.cache.save(self.manifest)
+        return True
+
+    def __getattr__(self, name: str):
+        # Called only for missing attributes: command may be newer than cache
+        if name.startswith("_") or name in ("client", "cache", "manifest"):
+            raise AttributeError(name)
+        if self.refresh() and name in self.__dict__:
+            return self.__dict__[name]
+        raise AttributeError(f"server has no command '{name}'")
+
+    def submit(self, command: str, *args) -> Future:
+        """Run server's job in background, server sends result when it's done"""
+        return self.client.submit(
+            {"type": "module", "job": "ssh", "func": command, "params": args}
+        )
+
+    def cancel(self, job_id: str):
+        return self.client.cancel(job_id)
+
+    def fanout(self, command: str, *args, targets: list = None, group: str = None):
+        """Run server's job on the list of hosts (ssh_init params) or inventory group"""
+        data = {"type": "module", "job": "ssh", "func": command, "params": args}
+        if group is not None:
+            data["group"] = group
+        else:
+            data["targets"] = targets
+        summary = self.client.fanout(data)
+        log.info(
+            f"{command}: {summary.get('ok')}/{summary.get('total')} hosts ok, "
+            f"failed: {summary.get('failed')}"
+        )
+        return summary
+
+    def batch(self, on_error: str = "stop") -> Batch:
+        """Collect calls and send them to server in one round trip"""
+        return Batch(self.client, on_error)
+
+    def upload(self, src, dst: str) -> dict:
+        """Send local file to remote host, can run in parallel from threads"""
+        stats = self.client.upload(src, dst)
+        log.info(f"{src} uploaded to {dst}: {stats['bytes']} bytes")
+        return stats
+
+    def download(self, src: str, dst) -> dict:
+        """Receive remote file from remote host, can run in parallel from threads"""
+        stats = self.client.download(src, dst)
+        log.info(f"{src} downloaded to {dst}: {stats['bytes']} bytes")
+        return stats
 
     def ssh_init(self, params):
         result = self.client.exec(
             {"type": "system", "job": "ssh_connection_init", "params": params}
         )
+        if isinstance(result, dict) and result.get("worker"):
+            # Server's cluster serves this host on other worker, move there
+            log.info(f"host is served by {result['worker']}, reconnecting")
+            self.client.disconnect()
+            self.client = Client(result["worker"])
+            self._build(self.manifest["commands"])
+            result = self.client.exec(
+                {"type": "system", "job": "ssh_connection_init", "params": params}
+            )
         if result:
             log.info("server set SSH connection data successfuly")
 
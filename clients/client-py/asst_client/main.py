@@ -70,6 +70,11 @@ try:
     srv1_hostname = do.show_hostname()
     srv1_uptime = do.show_uptime()
 
+    # Same commands can be called without waiting: with 'wait=False' method returns
+    # Future, so many requests can be in flight over the same connection.
+    futures = [do.show_uptime(wait=False) for _ in range(5)]
+    log.debug(f"Parallel uptime calls: {[future.result() for future in futures]}")
+
     # For now, ASST server keeps only one backend ssh params for client's session.
     # If we will send new ssh params, old ones will be replaced with new ones.
     do.ssh_init(
@@ -78,6 +83,23 @@ try:
     srv2_hostname = do.show_hostname()
     srv2_uptime = do.show_uptime()
 
+    # Batch: few jobs in one round trip and over one ssh connection.
+    with do.batch() as batch:
+        batch.show_hostname()
+        batch.show_uptime()
+    log.debug(f"Batch results: {batch.results}")
+
+    # Fan-out: same job on many hosts at once, without ssh_init for every one of them.
+    # ASST server runs it in parallel and returns per host results with summary.
+    fanout = do.fanout(
+        "show_uptime",
+        targets=[
+            {"ssh_ip": SERVER1_IP, "ssh_user": SERVER1_USER, "ssh_pass": SERVER1_PASSW},
+            {"ssh_ip": SERVER2_IP, "ssh_user": SERVER2_USER, "ssh_pass": SERVER2_PASSW},
+        ],
+    )
+    log.debug(f"Fan-out results: {fanout['results']}")
+
     print(f"SERVER 1 INFO: {srv1_hostname[1]}, {srv1_uptime[1]}")
     print(f"SERVER 2 INFO: {srv2_hostname[1]}, {srv2_uptime[1]}")
 except Exception as e:
@@ -0,0 +1,316 @@
+# Copyright © 2022 Nikolay Shishov. All rights reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import base64
+import hashlib
+import itertools
+import json
+import shlex
+import socket
+import threading
+import time
+from contextlib import nullcontext
+
+# Helper script, path inside backend directory like for send_file()
+AGENT_SCRIPT = "helpers/asst_agent.py"
+# Remote directory of the script, relative to user's home
+REMOTE_DIR = ".asst/"
+REMOTE_PYTHON = "python3"
+# Seconds to wait for greeting of started agent
+START_TIMEOUT = 15
+# Seconds to wait for answer to one request
+REQUEST_TIMEOUT = 120
+# Seconds after which agent is started again on host which got exec fallback
+RETRY_INTERVAL = 300
+# Checksum algorithms which have '<name>sum' tool for exec fallback
+EXEC_CHECKSUMS = ("md5", "sha1", "sha224", "sha256", "sha384", "sha512")
+# Output of 'stat -c %F' to types of the agent
+STAT_TYPES = {
+    "regular file": "file",
+    "regular empty file": "file",
+    "directory": "dir",
+    "symbolic link": "link",
+}
+
+
+class AgentError(RuntimeError):
+    """Request failed on remote side, e.g. file not found"""
+
+
+class AgentUnavailable(ConnectionError):
+    """Helper agent can't be started or has gone"""
+
+
+class BaseAgent:
+    """File and system queries of remote host, same for agent and exec fallback.
+
+    Results:
+        stat -- {'type', 'size', 'mode', 'mtime', 'uid', 'gid'}
+        read -- {'data', 'size', 'truncated'}, data is text or base64
+        checksum -- hex digest
+        listdir -- sorted names, or stat dicts with 'name' if details is True
+        sysinfo -- {'hostname', 'kernel', 'uptime', 'load', 'memory', 'disk'}
+    """
+
+    # True if queries are executed as separate commands
+    fallback = False
+
+    @property
+    def alive(self) -> bool:
+        """False if agent has to be started again"""
+        return True
+
+    def request(self, op: str, **args):
+        """Execute one query
+
+        Raises:
+            AgentError: if query failed on remote side
+        """
+        raise NotImplementedError
+
+    def batch(self, requests: list) -> list:
+        """Execute many queries
+
+        Arguments:
+            requests {list} -- (op, args dict) pairs
+
+        Returns:
+            list -- {'ok': True, 'result': ...} or {'ok': False, 'error': ...}
+                of every query in the same order
+        """
+        answers = []
+        for op, args in requests:
+            try:
+                answers.append({"ok": True, "result": self.request(op, **args)})
+            except AgentError as e:
+                answers.append({"ok": False, "error": str(e)})
+        return answers
+
+    def stat(self, path: str, follow: bool = True) -> dict:
+        return self.request("stat", path=path, follow=follow)
+
+    def read(
+        self, path: str, offset: int = 0, size: int = 4194304, encoding: str = "text"
+    ) -> dict:
+        return self.request(
+            "read", path=path, offset=offset, size=size, encoding=encoding
+        )
+
+    def checksum(self, path: str, algorithm: str = "sha256") -> str:
+        return self.request("checksum", path=path, algorithm=algorithm)
+
+    def listdir(self, path: str, details: bool = False) -> list:
+        return self.request("list", path=path, details=details)
+
+    def sysinfo(self, path: str = "/") -> dict:
+        return self.request("sysinfo", path=path)
+
+    def close(self):
+        pass
+
+
+class AgentSession(BaseAgent):
+    def __init__(
+        self,
+        ssh: object,
+        command: str,
+        track=None,
+        timeout: int = REQUEST_TIMEOUT,
+    ):
+        """Helper agent started on one channel, answers JSON requests line by line.
+
+        Arguments:
+            ssh {object} -- SSHClient to open channel on
+            command {str} -- remote command which starts the agent
+            track {callable} -- context manager for channel during request,
+                used to close the agent on cancel of the job
+            timeout {int} -- seconds to wait for answer, agent is closed after
+
+        Raises:
+            AgentUnavailable: if agent didn't greet, e.g. there is no python
+        """
+        self.channel = ssh.get_transport().open_session()
+        self.channel.exec_command(command)
+        self.stdin = self.channel.makefile_stdin("wb")
+        self.stdout = self.channel.makefile("rb")
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.track = track or nullcontext
+        self.timeout = timeout
+        self.channel.settimeout(START_TIMEOUT)
+        try:
+            greeting = json.loads(self.stdout.readline() or "null")
+        except (socket.timeout, ValueError) as e:
+            self.close()
+            raise AgentUnavailable(f"agent didn't start: {e}")
+        if not isinstance(greeting, dict) or greeting.get("agent") != "asst":
+            errors = self.channel.recv_stderr(4096).decode("utf-8", "replace")
+            self.close()
+            raise AgentUnavailable(f"agent didn't start: {errors.strip()}")
+        self.channel.settimeout(timeout)
+        self.version = greeting.get("version")
+        # sha256 of remote script, compared with script_digest()
+        self.digest = greeting.get("digest")
+
+    @property
+    def alive(self) -> bool:
+        return not self.channel.closed and not self.channel.exit_status_ready()
+
+    def _call(self, op: str, args: dict):
+        """Send request, wait for its answer"""
+        request = {"id": next(self.ids), "op": op, "args": args}
+        with self.lock:
+            with self.track(self.channel):
+                try:
+                    self.stdin.write((json.dumps(request) + "\n").encode())
+                    self.stdin.flush()
+                    line = self.stdout.readline()
+                except socket.timeout:
+                    self.close()
+                    raise AgentUnavailable(f"agent didn't answer in {self.timeout}s")
+        if not line:
+            raise AgentUnavailable("remote agent closed")
+        answer = json.loads(line)
+        if answer.get("id") != request["id"]:
+            self.close()
+            raise AgentUnavailable("agent answered to other request")
+        if not answer["ok"]:
+            raise AgentError(answer["error"])
+        return answer["result"]
+
+    def request(self, op: str, **args):
+        return self._call(op, args)
+
+    def batch(self, requests: list) -> list:
+        """All queries in one round trip"""
+        items = [{"op": op, "args": args} for op, args in requests]
+        return self._call("batch", {"requests": items})
+
+    def close(self):
+        self.channel.close()
+
+
+class ExecAgent(BaseAgent):
+    fallback = True
+
+    def __init__(self, execute, retry: int = RETRY_INTERVAL):
+        """Queries as plain commands, for hosts where agent can't run.
+
+        Every query costs own exec round trip, results are the same as agent's.
+        Fallback isn't alive after retry seconds, so agent is started again,
+        e.g. when python3 was installed or connection failure has gone.
+
+        Arguments:
+            execute {callable} -- function which runs command: (rc, output lines)
+            retry {int} -- seconds until next try of the agent
+        """
+        self.execute = execute
+        self.expires = time.monotonic() + retry
+
+    @property
+    def alive(self) -> bool:
+        return time.monotonic() < self.expires
+
+    def _run(self, cmd: str) -> list:
+        response_code, output = self.execute(cmd)
+        if response_code != 0:
+            raise AgentError(" ".join(output) or f"'{cmd}' failed: {response_code}")
+        return output
+
+    def request(self, op: str, **args):
+        handler = getattr(self, f"_op_{op}", None)
+        if handler is None:
+            raise AgentError(f"unknown op: {op}")
+        return handler(**args)
+
+    def _op_ping(self) -> dict:
+        return {"version": None}
+
+    def _op_stat(self, path: str, follow: bool = True) -> dict:
+        flags = "-L " if follow else ""
+        line = self._run(f"stat {flags}-c '%F|%s|%a|%Y|%u|%g' -- {shlex.quote(path)}")
+        kind, size, mode, mtime, uid, gid = line[0].split("|")
+        return {
+            "type": STAT_TYPES.get(kind, "other"),
+            "size": int(size),
+            "mode": int(mode, 8),
+            "mtime": int(mtime),
+            "uid": int(uid),
+            "gid": int(gid),
+        }
+
+    def _op_read(
+        self, path: str, offset: int = 0, size: int = 4194304, encoding: str = "text"
+    ) -> dict:
+        # Output lines are stripped, base64 keeps data exact
+        quoted = shlex.quote(path)
+        output = self._run(
+            f"stat -L -c %s -- {quoted} && "
+            f"tail -c +{int(offset) + 1} -- {quoted} | head -c {int(size)} | base64"
+        )
+        total = int(output[0])
+        data = base64.b64decode("".join(output[1:]))
+        if encoding == "base64":
+            text = base64.b64encode(data).decode()
+        else:
+            text = data.decode("utf-8", "replace")
+        return {"data": text, "size": total, "truncated": offset + len(data) < total}
+
+    def _op_checksum(self, path: str, algorithm: str = "sha256") -> str:
+        if algorithm not in EXEC_CHECKSUMS:
+            raise AgentError(f"unsupported algorithm: {algorithm}")
+        return self._run(f"{algorithm}sum -- {shlex.quote(path)}")[0].split()[0]
+
+    def _op_list(self, path: str, details: bool = False) -> list:
+        names = sorted(self._run(f"ls -A1 -- {shlex.quote(path)}"))
+        if not details:
+            return names
+        result = []
+        for name in names:
+            try:
+                entry = self._op_stat(f"{path.rstrip('/')}/{name}", follow=False)
+            except AgentError as e:
+                entry = {"error": str(e)}
+            entry["name"] = name
+            result.append(entry)
+        return result
+
+    def _op_sysinfo(self, path: str = "/") -> dict:
+        output = self._run(
+            "hostname && uname -r && cat /proc/uptime /proc/loadavg && "
+            f"df -Pk -- {shlex.quote(path)} | tail -n 1 && "
+            "grep -E '^(MemTotal|MemAvailable):' /proc/meminfo"
+        )
+        hostname, kernel, uptime, load, disk = output[:5]
+        memory = {}
+        for line in output[5:]:
+            name, value = line.split(":", 1)
+            memory[name[3:].lower()] = int(value.split()[0]) * 1024
+        disk = disk.split()
+        return {
+            "hostname": hostname,
+            "kernel": kernel,
+            "uptime": float(uptime.split()[0]),
+            "load": [float(value) for value in load.split()[:3]],
+            "memory": memory,
+            "disk": {
+                "path": path,
+                "total": int(disk[1]) * 1024,
+                "free": int(disk[3]) * 1024,
+            },
+        }
+
+
+def script_digest(path) -> str:
+    """sha256 of local agent script, running agent reports it for its file"""
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def agent_command() -> str:
+    """Remote command which starts uploaded agent"""
+    script = REMOTE_DIR + AGENT_SCRIPT.rsplit("/", 1)[-1]
+    return f"{REMOTE_PYTHON} -u {script}"
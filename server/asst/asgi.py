@@ -0,0 +1,151 @@
+# Copyright © 2022 Nikolay Shishov. All rights reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Asyncio entry point: the same server on socketio.AsyncServer under ASGI.
+# Idle clients cost only a coroutine, handlers of main.py and all blocking
+# paramiko work run in threads, so jobs from 'jobs' work without changes.
+# Plain job and batch messages await their scheduler job on the loop, so
+# amount of them in flight isn't limited by threads. Fan-out, cacheable jobs,
+# ssh_connection_init (which can wait for lease) and other events still hold
+# one of [asgi] workers threads until they answer.
+#
+#   uvicorn asgi:app --host 0.0.0.0 --port 5000    (or: python3 asgi.py)
+
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ["ASST_ASYNC"] = "1"
+
+import main  # noqa: E402
+import socketio  # noqa: E402
+from metrics import metrics  # noqa: E402
+
+# Threads for handlers which aren't awaited on the loop, see above
+ASGI_WORKERS: int = main.app_config.getint("asgi", "workers", fallback=256)
+# Own threads for connect, disconnect and job cancel, so they aren't queued
+# behind running jobs when all ASGI_WORKERS are busy
+ASGI_CONTROL_WORKERS: int = main.app_config.getint(
+    "asgi", "control_workers", fallback=4
+)
+CONTROL_EVENTS = ("connect", "disconnect")
+
+
+class ThreadsafeEmitter:
+    def __init__(self, server: socketio.AsyncServer):
+        """Sync interface of AsyncServer for code which runs in threads.
+
+        Emits are handed over to event loop and not awaited, like emits of
+        sync server. Background tasks are threads.
+        """
+        self.server = server
+        self.loop = None
+
+    def emit(self, event: str, data=None, room=None, callback=None, **kwargs):
+        future = asyncio.run_coroutine_threadsafe(
+            self.server.emit(event, data, room=room, callback=callback, **kwargs),
+            self.loop,
+        )
+        future.add_done_callback(self._report)
+
+    @staticmethod
+    def _report(future):
+        if not future.cancelled() and future.exception() is not None:
+            main.log.error(f"emit failed: {future.exception()}")
+
+    def sleep(self, seconds: float):
+        time.sleep(seconds)
+
+    def start_background_task(self, target, *args, **kwargs):
+        thread = threading.Thread(target=target, args=args, kwargs=kwargs, daemon=True)
+        thread.start()
+        return thread
+
+
+if main.CLUSTER_STORE != "memory":
+    raise ValueError("asgi server supports only 'memory' session store")
+
+sio = socketio.AsyncServer(async_mode="asgi")
+executor = ThreadPoolExecutor(ASGI_WORKERS, thread_name_prefix="asst-asgi")
+control = ThreadPoolExecutor(
+    ASGI_CONTROL_WORKERS, thread_name_prefix="asst-asgi-control"
+)
+emitter = ThreadsafeEmitter(sio)
+
+
+def is_control(event: str, args: tuple) -> bool:
+    """Event which must not wait for a free thread of jobs"""
+    if event in CONTROL_EVENTS:
+        return True
+    if event != "message" or len(args) < 2 or not isinstance(args[1], dict):
+        return False
+    data = args[1]
+    return "system" in (data.get("type") or "") and data.get("job") == "cancel"
+
+
+def awaitable(event: str, handler):
+    """Async handler which runs sync handler of main.py in executor"""
+
+    async def run(*args):
+        pool = control if is_control(event, args) else executor
+        return await asyncio.get_running_loop().run_in_executor(pool, handler, *args)
+
+    return run
+
+
+async def message(sid, data):
+    """Plain job waits for scheduler's future on the loop, not in a thread"""
+    job_func = main.scheduled_func(data)
+    if job_func is None:
+        return await awaitable("message", main.message)(sid, data)
+    main.log.info(f"server received command: {str(data)}", sid)
+    # Scheduling only queues the job, it doesn't block the loop
+    job, rejected = main.schedule(sid, data, job_func)
+    if job is None:
+        return main.encode_answer(sid, rejected)
+    # wait() doesn't raise, job_result() turns failures into answer
+    await asyncio.wait([asyncio.wrap_future(job.future)])
+    try:
+        result = main.job_result(job)
+    finally:
+        main.sio.emit("job_stats", main.job_stats(job), room=sid)
+    return main.encode_answer(sid, result)
+
+
+# All events of main.py: connect, message, relay events, disconnect
+for event, handler in main.sio.handlers["/"].items():
+    sio.on(event, message if event == "message" else awaitable(event, handler))
+
+
+async def metrics_app(scope, receive, send):
+    """Prometheus text page, like /metrics of WSGI server"""
+    if scope["type"] != "http" or scope["path"] != "/metrics":
+        await send({"type": "http.response.start", "status": 404, "headers": []})
+        await send({"type": "http.response.body", "body": b"Not Found"})
+        return
+    body = metrics.render().encode()
+    headers = [(b"content-type", b"text/plain; version=0.0.4; charset=utf-8")]
+    await send({"type": "http.response.start", "status": 200, "headers": headers})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def startup():
+    emitter.loop = asyncio.get_running_loop()
+    # Code of main.py emits and starts tasks through emitter from now on
+    main.sio = emitter
+    main.log.servlog = emitter
+    main.start_background_tasks()
+
+
+app = socketio.ASGIApp(sio, metrics_app, on_startup=startup)
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(app, host=main.SERVER_IP, port=main.SERVER_PORT)
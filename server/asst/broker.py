@@ -0,0 +1,151 @@
+# Copyright © 2022 Nikolay Shishov. All rights reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import base64
+import json
+import logging
+import os
+import pickle
+import socketserver
+import sys
+import threading
+import time
+
+import socketio
+from store import BrokerClient, MemoryStore
+
+
+class BrokerHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        broker = self.server.broker
+        for line in self.rfile:
+            request = json.loads(line)
+            op, args = request["op"], request.get("args", [])
+            if op == "subscribe":
+                # Connection becomes stream of channel's messages until closed
+                broker.subscribe(args[0], self.wfile)
+                try:
+                    while self.rfile.readline():
+                        pass
+                finally:
+                    broker.unsubscribe(args[0], self.wfile)
+                return
+            try:
+                answer = {"result": broker.call(op, args)}
+            except Exception as e:
+                answer = {"error": f"{op}: {e}"}
+            self.wfile.write(json.dumps(answer, default=list).encode() + b"\n")
+            self.wfile.flush()
+
+
+class BrokerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class Broker:
+    def __init__(self, path: str):
+        """Process which keeps state shared by server workers.
+
+        Keeps clients' sessions, hosts' owners and leases (MemoryStore) and
+        relays SocketIO messages between workers (publish/subscribe).
+
+        Arguments:
+            path {str} -- Unix socket path to listen on
+        """
+        self.log = logging.getLogger(__name__)
+        self.path = path
+        self.store = MemoryStore()
+        self.leases = self.store.leases()
+        self.ops = {
+            "store.get": self.store.get,
+            "store.set": self.store.set,
+            "store.delete": self.store.delete,
+            "store.claim": self.store.claim,
+            "leases.acquire": self.leases.acquire,
+            "leases.release": self.leases.release,
+            "leases.release_all": self.leases.release_all,
+            "leases.holders": self.leases.holders,
+            "leases.stats": self.leases.stats,
+            "publish": self.publish,
+        }
+        self._subscribers: dict = {}
+        self._lock = threading.Lock()
+        self._server = None
+
+    def call(self, op: str, args: list):
+        if op not in self.ops:
+            raise ValueError("unknown operation")
+        return self.ops[op](*args)
+
+    def subscribe(self, channel: str, stream):
+        with self._lock:
+            self._subscribers.setdefault(channel, {})[stream] = threading.Lock()
+
+    def unsubscribe(self, channel: str, stream):
+        with self._lock:
+            self._subscribers.get(channel, {}).pop(stream, None)
+
+    def publish(self, channel: str, message: str) -> int:
+        line = json.dumps({"message": message}).encode() + b"\n"
+        with self._lock:
+            subscribers = list(self._subscribers.get(channel, {}).items())
+        for stream, lock in subscribers:
+            try:
+                with lock:
+                    stream.write(line)
+                    stream.flush()
+            except OSError:
+                self.unsubscribe(channel, stream)
+        return len(subscribers)
+
+    def serve_forever(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._server = BrokerServer(self.path, BrokerHandler)
+        self._server.broker = self
+        self.log.info(f"broker listens on {self.path}")
+        self._server.serve_forever()
+
+    def shutdown(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            os.unlink(self.path)
+
+
+class UnixSocketManager(socketio.PubSubManager):
+    name = "unix"
+
+    def __init__(self, path: str, channel: str = "socketio", write_only: bool = False):
+        """SocketIO client manager which sends messages between workers via broker"""
+        self.client = BrokerClient(path)
+        super().__init__(channel=channel, write_only=write_only)
+
+    def _publish(self, data):
+        message = base64.b64encode(pickle.dumps(data)).decode()
+        self.client.call("publish", self.channel, message)
+
+    def _listen(self):
+        while True:
+            try:
+                sock, stream = self.client.connect()
+            except OSError as e:
+                self._get_logger().error(f"can't connect to broker: {e}")
+                time.sleep(1)
+                continue
+            try:
+                self.client.send(stream, "subscribe", self.channel)
+                for line in stream:
+                    yield pickle.loads(base64.b64decode(json.loads(line)["message"]))
+            finally:
+                sock.close()
+            time.sleep(1)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+    path = sys.argv[1] if len(sys.argv) > 1 else "/tmp/asst-broker.sock"
+    Broker(path).serve_forever()
@@ -0,0 +1,164 @@
+# Copyright © 2022 Nikolay Shishov. All rights reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+
+@dataclass
+class CacheEntry:
+    value: object
+    size: int
+    expires: float
+
+
+class ResultCache:
+    def __init__(self, max_entries: int = 1024, max_bytes: int = 16 * 1024 * 1024):
+        """LRU cache of results of idempotent jobs.
+
+        Results expire after job's TTL. Identical requests which come while
+        job is running wait for its result instead of running it once more.
+
+        Arguments:
+            max_entries {int} -- max amount of cached results
+            max_bytes {int} -- max total size of cached results in JSON
+        """
+        self.log = logging.getLogger(__name__)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evicted = 0
+        self._entries: OrderedDict = OrderedDict()
+        self._inflight: dict = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(host: str, connection: tuple, func: str, params) -> tuple:
+        """Cache key of job's result
+
+        Arguments:
+            host {str} -- host job runs on, used by invalidate()
+            connection {tuple} -- pooled connection's key with hash of password,
+                so result is served only to clients with the same credentials
+            func {str} -- job name
+            params -- job's params and options
+        """
+        params = json.dumps(params, sort_keys=True, default=str)
+        return host, connection, func, params
+
+    def _drop(self, key: tuple):
+        entry = self._entries.pop(key)
+        self._bytes -= entry.size
+
+    def get(self, key: tuple) -> tuple:
+        """Returns:
+        tuple -- (True, value) if key is cached, otherwise (False, None)
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires <= time.monotonic():
+                self._drop(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return False, None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return True, entry.value
+
+    def put(self, key: tuple, value, ttl: float):
+        try:
+            size = len(json.dumps(value, default=str))
+        except (TypeError, ValueError):
+            return
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = CacheEntry(value, size, time.monotonic() + ttl)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+                self.evicted += 1
+
+    def fetch(
+        self,
+        key: tuple,
+        ttl: float,
+        compute: Callable,
+        store: Optional[Callable] = None,
+    ):
+        """Cached value or result of compute(), shared by concurrent callers
+
+        Arguments:
+            key {tuple} -- cache key from key()
+            ttl {float} -- seconds to keep the result
+            compute {callable} -- runs the job and returns its result
+            store {callable} -- returns False for results which must not be cached
+        """
+        hit, value = self.get(key)
+        if hit:
+            return value
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+            else:
+                self.coalesced += 1
+        if not leader:
+            return future.result()
+        try:
+            value = compute()
+        except Exception as e:
+            with self._lock:
+                self._inflight.pop(key, None)
+            future.set_exception(e)
+            raise
+        if store is None or store(value):
+            self.put(key, value, ttl)
+        with self._lock:
+            self._inflight.pop(key, None)
+        future.set_result(value)
+        return value
+
+    def invalidate(self, host: Optional[str] = None, func: Optional[str] = None) -> int:
+        """Drop cached results of host and/or job, everything if both are None
+
+        Returns:
+            int -- amount of dropped results
+        """
+        with self._lock:
+            keys = [
+                key
+                for key in self._entries
+                if (host is None or key[0] == host) and (func is None or key[2] == func)
+            ]
+            for key in keys:
+                self._drop(key)
+        self.log.info(f"{len(keys)} cached results invalidated")
+        return len(keys)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "evicted": self.evicted,
+            }
@@ -0,0 +1,67 @@
+# Copyright © 2022 Nikolay Shishov. All rights reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Runs broker and N server workers from config's [cluster] section.
+# Worker 'i' listens on server's port + i and shares sessions, host leases
+# and SocketIO messages with other workers through the broker.
+
+import configparser
+import logging
+import os
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+from broker import Broker
+
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+log = logging.getLogger("cluster")
+
+
+def main():
+    workdir = Path(__file__).parent.absolute()
+    config = configparser.ConfigParser()
+    config.read(workdir / "config.ini")
+    workers = config.getint("cluster", "workers", fallback=2)
+    path = config.get("cluster", "broker", fallback="/tmp/asst-broker.sock")
+    advertise = config.get("cluster", "advertise", fallback="127.0.0.1")
+    port = config.getint("server", "port")
+
+    broker = Broker(path)
+    threading.Thread(target=broker.serve_forever, daemon=True).start()
+    while not os.path.exists(path):
+        time.sleep(0.1)
+
+    procs = []
+    for i in range(workers):
+        env = {
+            **os.environ,
+            "ASST_PORT": str(port + i),
+            "ASST_STORE": f"unix:{path}",
+            "ASST_WORKER_URL": f"http://{advertise}:{port + i}",
+        }
+        procs.append(
+            subprocess.Popen([sys.executable, "main.py"], cwd=workdir, env=env)
+        )
+        log.info(f"worker {i} started on port {port + i}")
+    try:
+        while all(proc.poll() is None for proc in procs):
+            time.sleep(1)
+        log.error("worker stopped, shutting down cluster")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for proc in procs:
+            proc.terminate()
+        for proc in procs:
+            proc.wait()
+        broker.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+# Copyright © 2022 Nikolay Shishov. All rights reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import json
+import zlib
+
+try:
+    import msgpack
+except ImportError:  # msgpack is optional, JSON is always available
+    msgpack = None
+
+# First byte of binary answer: format and compression flags
+MSGPACK = 0x01
+JSON = 0x02
+ZLIB = 0x80
+
+
+def encodings() -> list:
+    """Encodings supported by server, the best one first"""
+    return (["msgpack"] if msgpack is not None else []) + ["json"]
+
+
+class Codec:
+    def __init__(
+        self,
+        encoding: str = "json",
+        compress: bool = False,
+        threshold: int = 4096,
+        level: int = 1,
+    ):
+        """Encoder of answers for one client.
+
+        Plain JSON text is sent to clients which didn't ask for anything else,
+        so old clients keep working. Other answers are binary SocketIO frames:
+        one header byte with format flags and the payload.
+
+        Arguments:
+            encoding {str} -- 'msgpack' or 'json'
+            compress {bool} -- client accepts zlib compressed answers
+            threshold {int} -- answers smaller than this are not compressed
+            level {int} -- zlib compression level
+        """
+        self.encoding = encoding
+        self.compress = compress
+        self.threshold = threshold
+        self.level = level
+
+    def encode(self, value):
+        """Returns:
+        str or bytes -- JSON text or binary frame
+        """
+        if self.encoding == "msgpack":
+            flags, payload = MSGPACK, msgpack.packb(value, use_bin_type=True)
+        else:
+            text = json.dumps(value)
+            if not self.compress or len(text) < self.threshold:
+                return text
+            flags, payload = JSON, text.encode()
+        if self.compress and len(payload) >= self.threshold:
+            flags, payload = flags | ZLIB, zlib.compress(payload, self.level)
+        return bytes([flags]) + payload
+
+
+def negotiate(auth, threshold: int = 4096, level: int = 1) -> Codec:
+    """Pick codec from client's connect auth:
+    {'encodings': ['msgpack', 'json'], 'compress': ['zlib']}
+    """
+    if not isinstance(auth, dict):
+        return Codec()
+    offered = auth.get("encodings") or ["json"]
+    encoding = next((name for name in offered if name in encodings()), "json")
+    compress = "zlib" in (auth.get("compress") or [])
+    return Codec(encoding, compress, threshold, level)
@@ -4,18 +4,55 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
+import contextvars
 import logging
 import re
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from dataclasses import dataclass
 from pathlib import Path
+from typing import Optional
 
 import paramiko
+from agent import (
+    AGENT_SCRIPT,
+    REMOTE_DIR,
+    RETRY_INTERVAL,
+    AgentSession,
+    AgentUnavailable,
+    BaseAgent,
+    ExecAgent,
+    agent_command,
+    script_digest,
+)
+from filters import OutputFilter
+from metrics import metrics
 from paramiko import SSHClient, client
+from profiles import TransportProfile
+from scheduler import current_job
+from shell import SHELL_TIMEOUT, ShellSession
+from stream import CHUNK_SIZE, OutputStream
+from transfer import TransferEngine
+
+# Seconds between checks of stdout and stderr while output is streamed
+STREAM_POLL = 0.1
 
 
 class ConnectionHandler:
-    def __init__(self, conn_params: dataclass):
+    def __init__(
+        self,
+        conn_params: dataclass,
+        keepalive: int = 0,
+        bastions=None,
+        max_channels: int = 8,
+        profile: Optional[TransportProfile] = None,
+        transfer_dir: Optional[Path] = None,
+    ):
         self.workdir = Path(__file__).parent.absolute()
+        # Local root of send_files() and others, outside of code and config
+        self.transfer_dir = transfer_dir
         self.log = logging.getLogger(__name__)
 
         if not conn_params.ready():
@@ -29,14 +66,46 @@ class ConnectionHandler:
         self.port = conn_params.ssh_port
         self.username = conn_params.ssh_user
         self.password = conn_params.ssh_pass
-        # --- End of params block ---
-        self.session_ha = self._ha_init(
-            self.ip_ha, self.port, self.username, self.password
+        # Transport settings of both hops, keepalive of profile wins over pool's
+        self.profile = profile or TransportProfile()
+        self.keepalive = (
+            keepalive if self.profile.keepalive is None else self.profile.keepalive
         )
+        # Max amount of session channels open at once on this connection
+        self.max_channels = max(max_channels, 1)
+        # --- End of params block ---
+        # sshd refuses channels above its MaxSessions (10 by default), so exec,
+        # exec_many, SFTP, shells and agent of all jobs share one cap
+        self._channels = threading.BoundedSemaphore(self.max_channels)
+        # Persistent shells for 'shell' job option, one per ssh object
+        self._shells: dict = {}
+        self._shells_lock = threading.Lock()
+        # Helper agent of target, started on first use
+        self._agent = None
+        self._agent_lock = threading.Lock()
+        # HA transport can be shared with other handlers which use same jump server
+        self.bastions = bastions if self.hostname else None
+        self.bastion_key = (self.ip_ha, self.port, self.username, self.profile.name)
+        if self.bastions is not None:
+            self.session_ha = self.bastions.acquire(
+                self.bastion_key,
+                self.password,
+                lambda: self._ha_init(
+                    self.ip_ha, self.port, self.username, self.password
+                ),
+            )
+        else:
+            self.session_ha = self._ha_init(
+                self.ip_ha, self.port, self.username, self.password
+            )
         self.is_proxy = True
 
-        cur_srv = str(self._ssh_execute(self.session_ha, "hostname")[1][0])
-        if not self.hostname or cur_srv == self.hostname:
+        try:
+            is_proxy = self._check_proxy()
+        except Exception:
+            self._close_ha()
+            raise
+        if not is_proxy:
             self.session_srv = self.session_ha
             self.is_proxy = False
         else:
@@ -45,10 +114,48 @@ class ConnectionHandler:
                     self.session_ha, self.hostname, self.port
                 )
             except Exception as e:
-                self.session_ha.close()
+                self._close_ha()
+                if self.bastions is not None:
+                    self.bastions.forget(self.bastion_key, self.hostname)
                 msg = f"jump server not found: {e}"
                 self.log.exception(msg)
                 raise ConnectionError(msg)
+        if self.bastions is not None:
+            self.bastions.remember(self.bastion_key, self.hostname, self.is_proxy)
+        self._set_keepalive()
+
+    def _check_proxy(self) -> bool:
+        """Check if target must be reached through HA as jump server
+
+        Result for shared HA is cached, so 'hostname' probe runs only once.
+
+        Returns:
+            bool -- True if target is behind HA
+        """
+        if not self.hostname:
+            return False
+        if self.bastions is not None:
+            is_proxy = self.bastions.is_proxy(self.bastion_key, self.hostname)
+            if is_proxy is not None:
+                return is_proxy
+        cur_srv = str(
+            self._ssh_execute(self.session_ha, "hostname", job_options=False)[1][0]
+        )
+        return cur_srv != self.hostname
+
+    def _close_ha(self):
+        """Close HA session or give it back if it is shared"""
+        if self.bastions is not None:
+            self.bastions.release(self.bastion_key, self.session_ha)
+        else:
+            self.session_ha.close()
+
+    def _set_keepalive(self):
+        """Enable transport keepalives so idle pooled sessions are not dropped"""
+        if not self.keepalive:
+            return
+        for session in {self.session_ha, self.session_srv}:
+            session.get_transport().set_keepalive(self.keepalive)
 
     def _ha_init(self, ssh_ip: str, ssh_port: str, ssh_user: str, ssh_passw: str):
         """Init SSH session to HA
@@ -66,13 +173,15 @@ class ConnectionHandler:
             ssh = SSHClient()
             # ssh.load_system_host_keys()
             ssh.set_missing_host_key_policy(client.AutoAddPolicy)
-            ssh.connect(
-                ssh_ip,
-                port=ssh_port,
-                username=ssh_user,
-                password=ssh_passw,
-                timeout=120,
-            )
+            with metrics.timer("ssh_connect", hop="ha"):
+                ssh.connect(
+                    ssh_ip,
+                    port=ssh_port,
+                    username=ssh_user,
+                    password=ssh_passw,
+                    **self.profile.connect_kwargs(),
+                )
+            self.profile.apply(ssh.get_transport())
             return ssh
         except paramiko.AuthenticationException:
             self.log.exception("Authentication failed, please verify your credentials.")
@@ -84,7 +193,7 @@ class ConnectionHandler:
             )
             raise
         except paramiko.SSHException as sshException:
-            self.log.exception("Unable to establish SSH connection:", sshException)
+            self.log.exception(f"Unable to establish SSH connection: {sshException}")
             raise
         except TimeoutError:
             self.log.exception("Host not properly respond")
@@ -103,58 +212,146 @@ class ConnectionHandler:
         transport = session_ha.get_transport()
         dest_ip = (hostname, port)
         local_ip = ("127.0.0.1", port)
-        channel = transport.open_channel("direct-tcpip", dest_ip, local_ip)
+        with metrics.timer("ssh_channel_open", kind="direct-tcpip"):
+            channel = transport.open_channel("direct-tcpip", dest_ip, local_ip)
 
         ssh = SSHClient()
         ssh.load_system_host_keys()
         ssh.set_missing_host_key_policy(client.AutoAddPolicy)
         if hostname:
             try:
-                ssh.connect(
-                    "127.0.0.1",
-                    port=self.port,
-                    username=self.username,
-                    password=self.password,
-                    sock=channel,
-                )
+                with metrics.timer("ssh_connect", hop="srv"):
+                    ssh.connect(
+                        "127.0.0.1",
+                        port=self.port,
+                        username=self.username,
+                        password=self.password,
+                        sock=channel,
+                        **self.profile.connect_kwargs(),
+                    )
+                self.profile.apply(ssh.get_transport())
             except Exception as e:
-                self.session_ha.close()
-                self.log.exception("Connecting with proxy:", e)
+                channel.close()
+                self.log.exception(f"Connecting with proxy: {e}")
                 raise
         else:
-            self.session_ha.close()
+            channel.close()
             msg = "Wrong target name when connect with proxy"
             self.log.exception(msg)
             raise ConnectionError(msg)
         return ssh
 
-    def _ssh_execute(self, ssh: object, cmd: str) -> tuple:
+    @contextmanager
+    def _tracked(self, channel: object):
+        """Register channel in current job, so cancel of the job can close it"""
+        job = current_job.get()
+        if job is None:
+            yield channel
+            return
+        job.track(channel)
+        try:
+            yield channel
+        finally:
+            job.untrack(channel)
+        job.check()
+
+    @contextmanager
+    def _channel_slot(self):
+        """Hold one of connection's channel slots while channel is open"""
+        self._channels.acquire()
+        try:
+            yield
+        finally:
+            self._channels.release()
+
+    def open_sftp(self, ssh: object = None, blocking: bool = True):
+        """SFTP client which holds channel slot until it's closed
+
+        Arguments:
+            ssh {object} -- ssh object, server's one by default
+            blocking {bool} -- wait for free slot, otherwise None is returned
+
+        Returns:
+            object -- SFTPClient() or None
+        """
+        if not self._channels.acquire(blocking):
+            return None
+        try:
+            sftp = (ssh or self.session_srv).open_sftp()
+        except Exception:
+            self._channels.release()
+            raise
+        close, once = sftp.close, threading.Lock()
+
+        def close_and_release():
+            close()
+            if once.acquire(blocking=False):
+                self._channels.release()
+
+        sftp.close = close_and_release
+        return sftp
+
+    def _ssh_execute(self, ssh: object, cmd: str, job_options: bool = True) -> tuple:
         """Inner SSH exec linked to ssh object
 
         Arguments:
             cmd {str} -- command to execute
             ssh {object} -- ssh object
+            job_options {bool} -- apply output options of current job, e.g. streaming
 
         Returns:
             str -- response code
             str -- output message
         """
-        chan = ssh.get_transport().open_session()
-        if chan:
+        job = current_job.get()
+        options = job.options if job_options and job is not None else {}
+        if options.get("shell"):
+            return self._shell_execute(
+                ssh,
+                cmd,
+                OutputFilter.from_options(options),
+                options.get("shell_timeout", SHELL_TIMEOUT),
+            )
+        with self._channel_slot():
+            with metrics.timer("ssh_channel_open", kind="session"):
+                chan = ssh.get_transport().open_session()
+            if not chan:
+                msg = "SSH channel not establish"
+                self.log.exception(msg)
+                raise ConnectionError(msg)
+            try:
+                return self._channel_execute(chan, cmd, job, options)
+            finally:
+                chan.close()
+
+    def _channel_execute(self, chan: object, cmd: str, job, options: dict) -> tuple:
+        """Exec of command on opened session channel"""
+        if options.get("stream"):
+            return self._ssh_stream(chan, cmd, job)
+        # Filter processes lines while they are read, so only its result is kept
+        output_filter = OutputFilter.from_options(options)
+        with self._tracked(chan):
             try:
-                chan.get_pty()
-                chan.exec_command(cmd)
-                response_code = chan.recv_exit_status()
+                with metrics.timer("ssh_exec"):
+                    # PTY costs remote allocation and rewrites line endings, it's
+                    # requested only by 'pty' option, e.g. for sudo
+                    if options.get("pty"):
+                        chan.get_pty()
+                    else:
+                        chan.set_combine_stderr(True)
+                    chan.exec_command(cmd)
+                    if output_filter is not None:
+                        for line in chan.makefile():
+                            output_filter.feed(line.strip())
+                    response_code = chan.recv_exit_status()
             except Exception as e:
                 chan.close()
-                self.log.exception("Channel Error:", e)
+                self.log.exception(f"Channel Error: {e}")
                 raise
-        else:
-            msg = "SSH channel not establish"
-            self.log.exception(msg)
-            raise ConnectionError(msg)
-        output = chan.makefile().readlines()
-        output = [line.strip() for line in output]
+            if output_filter is None:
+                output = [line.strip() for line in chan.makefile().readlines()]
+        if output_filter is not None:
+            output = output_filter.result()
         self.log.debug("cmd: {}; rc: {}; out: {}".format(cmd, response_code, output))
         if response_code != 0:
             self.log.debug(
@@ -164,6 +361,132 @@ class ConnectionHandler:
             )
         return response_code, output
 
+    def _shell(self, ssh: object) -> ShellSession:
+        """Persistent shell of ssh object, new one is started if it's closed"""
+        with self._shells_lock:
+            shell = self._shells.get(id(ssh))
+            if shell is None or not shell.alive:
+                if shell is not None:
+                    shell.close()
+                    self._shells.pop(id(ssh))
+                    self._channels.release()
+                # Shell holds its slot while it lives
+                self._channels.acquire()
+                try:
+                    with metrics.timer("ssh_channel_open", kind="shell"):
+                        shell = ShellSession(ssh)
+                except Exception:
+                    self._channels.release()
+                    raise
+                self._shells[id(ssh)] = shell
+            return shell
+
+    def _shell_execute(
+        self,
+        ssh: object,
+        cmd: str,
+        output_filter=None,
+        timeout: float = SHELL_TIMEOUT,
+    ) -> tuple:
+        """Inner SSH exec in persistent shell of ssh object
+
+        Arguments:
+            ssh {object} -- ssh object
+            cmd {str} -- command to execute
+            output_filter {OutputFilter} -- filter of output lines
+            timeout {float} -- seconds to wait for end of command
+
+        Returns:
+            str -- response code
+            str -- output message
+        """
+        shell = self._shell(ssh)
+        with self._tracked(shell.channel):
+            try:
+                with metrics.timer("ssh_exec", shell="true"):
+                    response_code, output = shell.run(cmd, output_filter, timeout)
+            except Exception as e:
+                # Shell state is unknown after error, next command starts new one
+                shell.close()
+                self.log.exception(f"Shell Error: {e}")
+                raise
+        self.log.debug(
+            "shell cmd: {}; rc: {}; out: {}".format(cmd, response_code, output)
+        )
+        return response_code, output
+
+    def _ssh_stream(self, chan: object, cmd: str, job: object) -> tuple:
+        """Inner SSH exec which sends output to client while command runs
+
+        Output is not kept in memory, client receives it as 'job_output' events.
+
+        Arguments:
+            chan {object} -- opened session channel
+            cmd {str} -- command to execute
+            job {Job} -- current job with streaming options
+
+        Returns:
+            str -- response code, -1 if command stopped because of output limit
+            list -- always empty, output was already sent
+        """
+        stream = OutputStream(
+            job,
+            max_bytes=job.options.get("max_bytes"),
+            max_lines=job.options.get("max_lines"),
+        )
+        with self._tracked(chan):
+            try:
+                with metrics.timer("ssh_exec", streamed="true"):
+                    chan.settimeout(STREAM_POLL)
+                    chan.exec_command(cmd)
+                    if self._forward_output(chan, stream):
+                        response_code = chan.recv_exit_status()
+                    else:
+                        chan.close()
+                        response_code = -1
+                    stream.close()
+            except Exception as e:
+                chan.close()
+                self.log.exception(f"Channel Error: {e}")
+                raise
+        self.log.debug(
+            "cmd: {}; rc: {}; streamed: {} bytes, {} lines".format(
+                cmd, response_code, stream.bytes, stream.lines
+            )
+        )
+        return response_code, []
+
+    def _forward_output(self, chan: object, stream: OutputStream) -> bool:
+        """Read channel's stdout and stderr chunks until command ends
+
+        Returns:
+            bool -- False if stream limit reached before command end
+        """
+        while True:
+            try:
+                data = chan.recv(CHUNK_SIZE)
+            except socket.timeout:
+                data = None
+            while chan.recv_stderr_ready():
+                if not stream.write("stderr", chan.recv_stderr(CHUNK_SIZE)):
+                    return False
+            if data == b"":
+                break
+            if data and not stream.write("stdout", data):
+                return False
+        # stdout is closed, but rest of stderr can be still on the way
+        while True:
+            try:
+                data = chan.recv_stderr(CHUNK_SIZE)
+            except socket.timeout:
+                if chan.exit_status_ready() and not chan.recv_stderr_ready():
+                    return True
+                continue
+            if not data:
+                return True
+            if not stream.write("stderr", data):
+                return False
+
     def _sending_file(self, ssh: object, src: str, dst: str):
         """Send file to the server
 
@@ -171,16 +494,17 @@ class ConnectionHandler:
             src {str} -- path to local file inside backend directory
             dst {str} -- path to the remote server with '/' at the end
         """
-        sftp = ssh.open_sftp()
+        sftp = self.open_sftp(ssh)
         filename = re.search(r"[A-Za-z0-9_-]+\.?[A-Za-z0-9]+$", src)[0]
         lfile = Path(self.workdir, src)
         rfile = dst + filename
         if lfile.exists():
             try:
-                sftp.put(lfile, rfile)
+                with self._tracked(sftp.get_channel()):
+                    sftp.put(lfile, rfile)
             except Exception as e:
                 sftp.close()
-                self.log.exception("SFTP Error:", e)
+                self.log.exception(f"SFTP Error: {e}")
                 raise
         else:
             sftp.close()
@@ -196,17 +520,18 @@ class ConnectionHandler:
             src {str} -- path to remote file inside server directory
             dst {str} -- path to the local server with '/' at the end
         """
-        sftp = ssh.open_sftp()
+        sftp = self.open_sftp(ssh)
         filename = re.search(r"[A-Za-z0-9_-]+\.?[A-Za-z0-9]+$", src)[0]
         rfile = src
         lfile = Path(self.workdir, filename)
         # todo: needed remote server check if remote file exist
         if rfile:
             try:
-                sftp.get(rfile, lfile)
+                with self._tracked(sftp.get_channel()):
+                    sftp.get(rfile, lfile)
             except Exception as e:
                 sftp.close()
-                self.log.exception("SFTP Error:", e)
+                self.log.exception(f"SFTP Error: {e}")
                 raise
         else:
             sftp.close()
@@ -215,6 +540,16 @@ class ConnectionHandler:
             raise FileNotFoundError(msg)
         sftp.close()
 
+    def _transfer(self, ssh: object, workers: int) -> TransferEngine:
+        """Transfer engine over ssh object's transport, reports progress to job"""
+        job = current_job.get()
+        return TransferEngine(
+            lambda blocking: self.open_sftp(ssh, blocking),
+            workers=workers,
+            progress=(lambda stats: job.progress("transfer", **stats)) if job else None,
+            track=self._tracked,
+        )
+
     def exec(self, cmd: str):
         """Execute SSH command on server
 
@@ -223,6 +558,91 @@ class ConnectionHandler:
         """
         return self._ssh_execute(self.session_srv, cmd)
 
+    def exec_many(self, cmds: list, max_channels: int = None) -> list:
+        """Execute SSH commands on server at once, every one on own channel
+
+        All channels are opened on the same transport, so independent commands
+        take the time of the slowest one instead of the sum of all of them.
+
+        Arguments:
+            cmds {list} -- commands to execute
+            max_channels {int} -- max amount of channels at once, can't be
+                bigger than connection's cap
+
+        Returns:
+            list -- (response code, output) of every command in the same order
+        """
+        workers = min(len(cmds), max_channels or self.max_channels, self.max_channels)
+        if workers <= 1:
+            return [self.exec(cmd) for cmd in cmds]
+        with ThreadPoolExecutor(workers, thread_name_prefix="asst-exec") as pool:
+            # Commands run in caller's context, so job's options and cancel work
+            futures = [
+                pool.submit(contextvars.copy_context().run, self.exec, cmd)
+                for cmd in cmds
+            ]
+            return [future.result() for future in futures]
+
+    def agent(self) -> BaseAgent:
+        """Helper agent of server for bulk file and system queries
+
+        Agent script is sent with send_file() and started once per connection,
+        every query is one JSON line on its channel instead of own exec.
+        Servers where it can't run, e.g. without python3, get ExecAgent with
+        the same methods.
+
+        Returns:
+            object -- AgentSession() or ExecAgent()
+        """
+        with self._agent_lock:
+            if self._agent is None or not self._agent.alive:
+                self._drop_agent()
+                self._agent = self._agent_init(self.session_srv)
+            return self._agent
+
+    def _drop_agent(self):
+        """Close agent and give its channel slot back"""
+        if isinstance(self._agent, AgentSession):
+            self._agent.close()
+            self._channels.release()
+        self._agent = None
+
+    def _agent_session(self, ssh: object) -> AgentSession:
+        # Agent holds its slot while it lives
+        self._channels.acquire()
+        try:
+            return AgentSession(ssh, agent_command(), track=self._tracked)
+        except Exception:
+            self._channels.release()
+            raise
+
+    def _agent_init(self, ssh: object) -> BaseAgent:
+        try:
+            with metrics.timer("ssh_channel_open", kind="agent"):
+                return self._agent_start(ssh)
+        except (OSError, paramiko.SSHException) as e:
+            self.log.warning(
+                f"helper agent can't run, exec is used for {RETRY_INTERVAL}s: {e}"
+            )
+            return ExecAgent(
+                lambda cmd: self._ssh_execute(ssh, cmd, job_options=False)
+            )
+
+    def _agent_start(self, ssh: object) -> AgentSession:
+        # Script left by earlier connection is reused if it's the same file
+        digest = script_digest(Path(self.workdir, AGENT_SCRIPT))
+        try:
+            agent = self._agent_session(ssh)
+            if agent.digest == digest:
+                return agent
+            agent.close()
+            self._channels.release()
+        except AgentUnavailable:
+            pass
+        self._ssh_execute(ssh, f"mkdir -p {REMOTE_DIR}", job_options=False)
+        self._sending_file(ssh, AGENT_SCRIPT, REMOTE_DIR)
+        return self._agent_session(ssh)
+
     def ha_exec(self, cmd: str):
         """Execute SSH command on HA server
 
@@ -276,11 +696,108 @@ class ConnectionHandler:
 
         return self._downloading_file(self.session_ha, src)
 
+    def _local_path(self, path: str) -> Path:
+        """Client's local path resolved inside transfer directory
+
+        Raises:
+            PermissionError: if path leads outside transfer directory
+        """
+        if self.transfer_dir is None:
+            msg = "transfer directory is not set"
+            self.log.error(msg)
+            raise PermissionError(msg)
+        root = self.transfer_dir.resolve()
+        resolved = Path(root, path).resolve()
+        if not resolved.is_relative_to(root):
+            msg = f"path is outside transfer directory: {path}"
+            self.log.error(msg)
+            raise PermissionError(msg)
+        return resolved
+
+    def send_files(self, pairs: list, resume: bool = True, workers: int = 4) -> dict:
+        """Send many files to server at once
+
+        Arguments:
+            pairs {list} -- (local path inside transfer directory, remote path) pairs
+            resume {bool} -- skip sent files and continue partly sent ones
+            workers {int} -- max amount of parallel SFTP channels
+
+        Returns:
+            dict -- transfer stats: files, bytes, elapsed, throughput
+        """
+        pairs = [(self._local_path(src), dst) for src, dst in pairs]
+        with self._transfer(self.session_srv, workers) as engine:
+            return engine.put(pairs, resume)
+
+    def download_files(
+        self, pairs: list, resume: bool = True, workers: int = 4
+    ) -> dict:
+        """Download many files from server at once
+
+        Arguments:
+            pairs {list} -- (remote path, local path inside transfer directory) pairs
+            resume {bool} -- skip downloaded files and continue partly downloaded ones
+            workers {int} -- max amount of parallel SFTP channels
+
+        Returns:
+            dict -- transfer stats: files, bytes, elapsed, throughput
+        """
+        pairs = [(src, self._local_path(dst)) for src, dst in pairs]
+        with self._transfer(self.session_srv, workers) as engine:
+            return engine.get(pairs, resume)
+
+    def send_tree(
+        self, src: str, dst: str, resume: bool = True, workers: int = 4
+    ) -> dict:
+        """Send directory from transfer directory to server with all its content
+
+        Arguments:
+            src {str} -- path to local directory inside transfer directory
+            dst {str} -- path to the remote directory
+
+        Returns:
+            dict -- transfer stats: files, bytes, elapsed, throughput
+        """
+        with self._transfer(self.session_srv, workers) as engine:
+            return engine.put_tree(self._local_path(src), dst, resume)
+
+    def download_tree(
+        self, src: str, dst: str, resume: bool = True, workers: int = 4
+    ) -> dict:
+        """Download remote directory with all its content
+
+        Arguments:
+            src {str} -- path to the remote directory
+            dst {str} -- path to local directory inside transfer directory
+
+        Returns:
+            dict -- transfer stats: files, bytes, elapsed, throughput
+        """
+        with self._transfer(self.session_srv, workers) as engine:
+            return engine.get_tree(src, self._local_path(dst), resume)
+
+    def is_alive(self) -> bool:
+        """Check that all SSH transports used by handler are still active
+
+        Returns:
+            bool -- True if handler can be used for new commands
+        """
+        for session in {self.session_ha, self.session_srv}:
+            transport = session.get_transport()
+            if transport is None or not transport.is_active():
+                return False
+        return True
+
     def close(self):
         """Close SSH session"""
+        with self._shells_lock:
+            shells, self._shells = list(self._shells.values()), {}
+        for shell in shells:
+            shell.close()
+            self._channels.release()
+        with self._agent_lock:
+            self._drop_agent()
         if self.is_proxy:
             self.session_srv.close()
-            self.session_ha.close()
-        else:
-            self.session_ha.close()
+        self._close_ha()
         self.log.info("SSH connections closed")
@@ -0,0 +1,125 @@
+# Copyright © 2022 Nikolay Shishov. All rights reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import json
+import re
+from collections import deque
+from typing import Optional
+
+# Job options handled by OutputFilter
+FILTER_OPTIONS = ("head", "tail", "include", "exclude", "max_bytes", "parse")
+KV_SEPARATOR = re.compile(r"\s*[=:]\s*")
+
+
+def parse_kv(lines: list) -> dict:
+    """'key=value' or 'key: value' lines to dict, other lines are skipped"""
+    result = {}
+    for line in lines:
+        parts = KV_SEPARATOR.split(line, maxsplit=1)
+        if len(parts) == 2 and parts[0]:
+            result[parts[0]] = parts[1]
+    return result
+
+
+def parse_columns(lines: list) -> list:
+    """Table with header line to list of dicts, last column takes the rest of line"""
+    lines = [line for line in lines if line.strip()]
+    if not lines:
+        return []
+    header = lines[0].split()
+    return [
+        dict(zip(header, line.split(maxsplit=len(header) - 1))) for line in lines[1:]
+    ]
+
+
+def parse_json(lines: list):
+    return json.loads("\n".join(lines))
+
+
+PARSERS = {"kv": parse_kv, "columns": parse_columns, "json": parse_json}
+
+
+class OutputFilter:
+    def __init__(
+        self,
+        head: Optional[int] = None,
+        tail: Optional[int] = None,
+        include: Optional[str] = None,
+        exclude: Optional[str] = None,
+        max_bytes: Optional[int] = None,
+        parse: Optional[str] = None,
+    ):
+        """Processing of command output line by line while it's read.
+
+        Only lines which will be returned are kept in memory: 'include' and
+        'exclude' drop lines right away, 'head' keeps first lines, 'tail'
+        keeps last ones, 'max_bytes' stops keeping after the limit.
+
+        Arguments:
+            head {int} -- keep only first N lines
+            tail {int} -- keep only last N lines
+            include {str} -- keep only lines matching regex
+            exclude {str} -- drop lines matching regex
+            max_bytes {int} -- max size of kept lines
+            parse {str} -- 'kv', 'columns' or 'json' to return parsed output
+
+        Raises:
+            ValueError: if options are wrong
+        """
+        for name, value in (("head", head), ("tail", tail), ("max_bytes", max_bytes)):
+            if value is not None and (not isinstance(value, int) or value < 0):
+                raise ValueError(f"'{name}' must be positive integer")
+        if parse is not None and parse not in PARSERS:
+            raise ValueError(f"unknown parser: {parse}")
+        try:
+            self.include = re.compile(include) if include else None
+            self.exclude = re.compile(exclude) if exclude else None
+        except re.error as e:
+            raise ValueError(f"wrong regex: {e}")
+        self.head = head
+        self.max_bytes = max_bytes
+        self.parse = parse
+        self.lines = deque(maxlen=tail)
+        self.bytes = 0
+        self.matched = 0
+        self.truncated = False
+
+    @classmethod
+    def from_options(cls, options: dict) -> Optional["OutputFilter"]:
+        """Filter from job's options, None if options have no filters"""
+        if not any(options.get(name) is not None for name in FILTER_OPTIONS):
+            return None
+        return cls(**{name: options.get(name) for name in FILTER_OPTIONS})
+
+    def feed(self, line: str):
+        if self.include and not self.include.search(line):
+            return
+        if self.exclude and self.exclude.search(line):
+            return
+        self.matched += 1
+        if self.head is not None and self.matched > self.head:
+            return
+        if self.lines.maxlen == 0:
+            return
+        size = len(line.encode()) + 1
+        # With 'tail' the oldest kept line goes away when new one comes
+        evicted = 0
+        if self.lines.maxlen is not None and len(self.lines) == self.lines.maxlen:
+            evicted = len(self.lines[0].encode()) + 1
+        if self.max_bytes is not None and self.bytes - evicted + size > self.max_bytes:
+            self.truncated = True
+            return
+        self.lines.append(line)
+        self.bytes += size - evicted
+
+    def result(self):
+        """Kept lines or parsed output"""
+        lines = list(self.lines)
+        if self.parse is not None:
+            return PARSERS[self.parse](lines)
+        if self.truncated:
+            lines.append(f"[output truncated after {self.bytes} bytes]")
+        return lines
@@ -0,0 +1,171 @@
+# Copyright © 2022 Nikolay Shishov. All rights reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Helper agent which runs on remote host, started by agent.py of the server.
+# One JSON request per line on stdin, one JSON answer per line on stdout:
+#   {"id": 1, "op": "stat", "args": {"path": "/etc/hosts"}}
+#   {"id": 1, "ok": true, "result": {"type": "file", "size": 220, ...}}
+# Only standard library of python 3.5+ is used, file must stay self-contained.
+
+import base64
+import hashlib
+import json
+import os
+import socket
+import stat
+import sys
+
+# Protocol version, server replaces script when its sha256 differs
+VERSION = 1
+# Limit of data returned by one 'read'
+MAX_READ = 4 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+
+
+def _type(mode):
+    if stat.S_ISLNK(mode):
+        return "link"
+    if stat.S_ISDIR(mode):
+        return "dir"
+    if stat.S_ISREG(mode):
+        return "file"
+    return "other"
+
+
+def op_ping():
+    return {"version": VERSION}
+
+
+def op_stat(path, follow=True):
+    info = os.stat(path) if follow else os.lstat(path)
+    return {
+        "type": _type(info.st_mode),
+        "size": info.st_size,
+        "mode": stat.S_IMODE(info.st_mode),
+        "mtime": int(info.st_mtime),
+        "uid": info.st_uid,
+        "gid": info.st_gid,
+    }
+
+
+def op_read(path, offset=0, size=MAX_READ, encoding="text"):
+    size = min(size, MAX_READ)
+    with open(path, "rb") as f:
+        total = os.fstat(f.fileno()).st_size
+        f.seek(offset)
+        data = f.read(size)
+    if encoding == "base64":
+        text = base64.b64encode(data).decode()
+    else:
+        text = data.decode("utf-8", "replace")
+    return {"data": text, "size": total, "truncated": offset + len(data) < total}
+
+
+def op_checksum(path, algorithm="sha256"):
+    digest = hashlib.new(algorithm)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def op_list(path, details=False):
+    names = sorted(os.listdir(path))
+    if not details:
+        return names
+    result = []
+    for name in names:
+        try:
+            entry = op_stat(os.path.join(path, name), follow=False)
+        except OSError as e:
+            entry = {"error": str(e)}
+        entry["name"] = name
+        result.append(entry)
+    return result
+
+
+def _meminfo():
+    memory = {}
+    with open("/proc/meminfo") as f:
+        for line in f:
+            name, value = line.split(":", 1)
+            if name in ("MemTotal", "MemAvailable"):
+                memory[name[3:].lower()] = int(value.split()[0]) * 1024
+    return memory
+
+
+def op_sysinfo(path="/"):
+    with open("/proc/uptime") as f:
+        uptime = float(f.read().split()[0])
+    disk = os.statvfs(path)
+    return {
+        "hostname": socket.gethostname(),
+        "kernel": os.uname().release,
+        "uptime": uptime,
+        "load": list(os.getloadavg()),
+        "memory": _meminfo(),
+        "disk": {
+            "path": path,
+            "total": disk.f_blocks * disk.f_frsize,
+            "free": disk.f_bavail * disk.f_frsize,
+        },
+    }
+
+
+OPS = {
+    "ping": op_ping,
+    "stat": op_stat,
+    "read": op_read,
+    "checksum": op_checksum,
+    "list": op_list,
+    "sysinfo": op_sysinfo,
+}
+
+
+def run(op, args):
+    """Answer of one request: {"ok": true, "result": ...} or error"""
+    try:
+        if op not in OPS:
+            raise ValueError("unknown op: {}".format(op))
+        return {"ok": True, "result": OPS[op](**(args or {}))}
+    except Exception as e:
+        return {"ok": False, "error": "{}: {}".format(type(e).__name__, e)}
+
+
+def _digest():
+    with open(os.path.abspath(__file__), "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def main():
+    out = sys.stdout
+    greeting = {"agent": "asst", "version": VERSION, "digest": _digest()}
+    out.write(json.dumps(greeting) + "\n")
+    out.flush()
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            answer = {"id": None, "ok": False, "error": "bad request: {}".format(e)}
+        else:
+            # Many requests in one round trip, answers in the same order
+            if request.get("op") == "batch":
+                items = request.get("args", {}).get("requests", [])
+                answer = {
+                    "ok": True,
+                    "result": [run(item.get("op"), item.get("args")) for item in items],
+                }
+            else:
+                answer = run(request.get("op"), request.get("args"))
+            answer["id"] = request.get("id")
+        out.write(json.dumps(answer) + "\n")
+        out.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+# Copyright © 2022 Nikolay Shishov. All rights reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+from logger import LoggerHandler
+
+log = LoggerHandler()
+
+
+def send_files(conn, args):
+    """args: [[local path inside transfer dir, remote path], ...], resume=True"""
+    pairs = args[0]
+    resume = args[1] if len(args) > 1 else True
+    log.debug(f"I'm sending {len(pairs)} files for you.")
+    return 0, [conn.send_files(pairs, resume)]
+
+
+def download_files(conn, args):
+    """args: [[remote path, local path inside transfer dir], ...], resume=True"""
+    pairs = args[0]
+    resume = args[1] if len(args) > 1 else True
+    log.debug(f"I'm downloading {len(pairs)} files for you.")
+    return 0, [conn.download_files(pairs, resume)]
+
+
+def send_tree(conn, args):
+    """args: local dir inside transfer dir, remote dir, resume=True"""
+    resume = args[2] if len(args) > 2 else True
+    log.debug(f"I'm sending {args[0]} directory for you.")
+    return 0, [conn.send_tree(args[0], args[1], resume)]
+
+
+def download_tree(conn, args):
+    """args: remote dir, local dir inside transfer dir, resume=True"""
+    resume = args[2] if len(args) > 2 else True
+    log.debug(f"I'm downloading {args[0]} directory for you.")
+    return 0, [conn.download_tree(args[0], args[1], resume)]
+
+
+def files_info(conn, args):
+    """args: [remote path, ...], stat and sha256 of every file in one round trip"""
+    log.debug(f"I'm checking {len(args)} files for you.")
+    requests = []
+    for path in args:
+        requests += [("stat", {"path": path}), ("checksum", {"path": path})]
+    answers = conn.agent().batch(requests)
+    result = {}
+    for path, stat, checksum in zip(args, answers[::2], answers[1::2]):
+        if stat["ok"] and checksum["ok"]:
+            result[path] = dict(stat["result"], sha256=checksum["result"])
+        else:
+            result[path] = {"error": stat.get("error") or checksum.get("error")}
+    response_code = 0 if all("error" not in info for info in result.values()) else 1
+    return response_code, result
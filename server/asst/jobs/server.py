@@ -4,7 +4,10 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
-from main import log
+from logger import LoggerHandler
+from registry import job
+
+log = LoggerHandler()
 
 
 def show_uptime(conn, args):
@@ -12,6 +15,21 @@ def show_uptime(conn, args):
     return conn.exec("uptime")
 
 
+def show_health(conn, args):
+    """Disk, memory, uptime and system state, all commands run at once"""
+    log.debug("I'm checking server's health for you.")
+    checks = {
+        "disk": "df -h /",
+        "memory": "free -m",
+        "uptime": "uptime",
+        "services": "systemctl is-system-running",
+    }
+    results = conn.exec_many(list(checks.values()))
+    response_code = next((rc for rc, _ in results if rc != 0), 0)
+    return response_code, {name: output for name, (_, output) in zip(checks, results)}
+
+
+@job(cacheable=True, ttl=300)
 def show_hostname(conn, args):
     log.debug("I'm query server's hostname for you.")
     return conn.exec("hostname")
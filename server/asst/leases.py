@@ -0,0 +1,133 @@
+# Copyright © 2022 Nikolay Shishov. All rights reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import logging
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Optional
+
+MODES = ("shared", "exclusive")
+
+
+@dataclass
+class LeaseWaiter:
+    sid: str
+    mode: str
+
+
+@dataclass
+class HostLease:
+    mode: Optional[str] = None
+    holders: set = field(default_factory=set)
+    waiters: deque = field(default_factory=deque)
+
+    def compatible(self, mode: str) -> bool:
+        return not self.holders or (self.mode == "shared" and mode == "shared")
+
+
+class HostLeaseRegistry:
+    def __init__(self):
+        """Leases of hosts for clients, indexed by host.
+
+        Many clients can hold 'shared' lease of one host at once, 'exclusive'
+        lease has only one holder. Clients which can't get lease right away
+        wait in the host's queue in order of arrival until timeout.
+        """
+        self.log = logging.getLogger(__name__)
+        self.waited = 0
+        self.timeouts = 0
+        self._leases: dict = {}
+        self._by_sid: dict = {}
+        self._cond = threading.Condition()
+
+    def _grantable(self, lease: HostLease, waiter: LeaseWaiter) -> bool:
+        # Queue is fair: nobody overtakes earlier waiters
+        return lease.waiters[0] is waiter and lease.compatible(waiter.mode)
+
+    def _grant(self, host: str, lease: HostLease, sid: str, mode: str):
+        lease.mode = mode
+        lease.holders.add(sid)
+        self._by_sid.setdefault(sid, set()).add(host)
+
+    def _release(self, sid: str, host: str):
+        lease = self._leases.get(host)
+        if lease is None or sid not in lease.holders:
+            return
+        lease.holders.discard(sid)
+        hosts = self._by_sid.get(sid)
+        if hosts is not None:
+            hosts.discard(host)
+            if not hosts:
+                self._by_sid.pop(sid)
+        if not lease.holders:
+            lease.mode = None
+            if not lease.waiters:
+                self._leases.pop(host)
+        self._cond.notify_all()
+
+    def acquire(self, sid: str, host: str, mode: str = "exclusive", timeout: float = 0):
+        """Take lease of host, wait up to 'timeout' seconds if it's busy
+
+        Returns:
+            bool -- True if lease is granted
+        """
+        if mode not in MODES:
+            raise ValueError(f"unknown lease mode: {mode}")
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            lease = self._leases.setdefault(host, HostLease())
+            if sid in lease.holders:
+                if lease.mode == mode:
+                    return True
+                # Mode is changed: client goes to the queue like everybody else
+                self._release(sid, host)
+                lease = self._leases.setdefault(host, HostLease())
+            waiter = LeaseWaiter(sid, mode)
+            lease.waiters.append(waiter)
+            if not self._grantable(lease, waiter):
+                self.waited += 1
+                self.log.info(f"{sid} waits for {mode} lease of {host}")
+            try:
+                while not self._grantable(lease, waiter):
+                    left = deadline - time.monotonic()
+                    if left <= 0:
+                        self.timeouts += 1
+                        return False
+                    self._cond.wait(left)
+                self._grant(host, lease, sid, mode)
+                return True
+            finally:
+                lease.waiters.remove(waiter)
+                if not lease.holders and not lease.waiters:
+                    self._leases.pop(host, None)
+                # Next waiter can be compatible with this one too
+                self._cond.notify_all()
+
+    def release(self, sid: str, host: str):
+        with self._cond:
+            self._release(sid, host)
+
+    def release_all(self, sid: str):
+        """Drop all leases of client, e.g. when it's disconnected"""
+        with self._cond:
+            for host in list(self._by_sid.get(sid, ())):
+                self._release(sid, host)
+
+    def holders(self, host: str) -> set:
+        with self._cond:
+            lease = self._leases.get(host)
+            return set(lease.holders) if lease else set()
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "hosts": len(self._leases),
+                "waiting": sum(len(lease.waiters) for lease in self._leases.values()),
+                "waited": self.waited,
+                "timeouts": self.timeouts,
+            }
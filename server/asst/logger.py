@@ -6,10 +6,25 @@
 
 import logging
 import sys
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+
+from scheduler import current_job
 
 logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
 logging.getLogger("paramiko").setLevel(logging.WARNING)
 
+LEVELS = {
+    "debug": logging.DEBUG,
+    "info": logging.INFO,
+    "warn": logging.WARNING,
+    "warning": logging.WARNING,
+    "error": logging.ERROR,
+    "critical": logging.CRITICAL,
+}
+
 
 def singleton(cls, *args, **kw):
     instances = {}
@@ -22,6 +37,16 @@ def singleton(cls, *args, **kw):
     return _singleton
 
 
+@dataclass
+class LogSubscription:
+    level: int = logging.DEBUG
+    frames: bool = False
+    lines: deque = field(default_factory=deque)
+    dropped: int = 0
+    tokens: float = 0.0
+    updated: float = field(default_factory=time.monotonic)
+
+
 @singleton
 class LoggerHandler(object):
     def __init__(self, name: str = "mainlogger", level: str = "debug", sio=None):
@@ -29,7 +54,7 @@ class LoggerHandler(object):
         Args:
             name (str): name of logger.
             level (str): set lever for logger, can be "info", "warn", "error" or "debug".
-            parent (str): set parent dearpygui window
+            sio (obj): SocketIO server used to send log messages to clients.
         Raises:
             ValueError: if logger level is unknown.
         Returns:
@@ -38,33 +63,127 @@ class LoggerHandler(object):
         self.pylog = logging.getLogger(name)
         if sio:
             self.servlog = sio
-        if level == "info":
-            self.pylog.setLevel(logging.INFO)
-        elif level == "warn":
-            self.pylog.setLevel(logging.WARNING)
-        elif level == "error":
-            self.pylog.setLevel(logging.ERROR)
-        elif level == "debug":
-            self.pylog.setLevel(logging.DEBUG)
-        else:
+        if level not in LEVELS:
             raise ValueError("Unknown logger level")
+        self.pylog.setLevel(LEVELS[level])
+        # Clients' log subscriptions, messages are sent by flush() in frames
+        self.subscriptions: dict = {}
+        self.rate = 100.0
+        self.burst = 200
+        self.max_pending = 1000
+        self.interval = 0.2
+        self.emitted = 0
+        self.dropped = 0
+        self._lock = threading.Lock()
+
+    def configure(
+        self,
+        rate: float = 100.0,
+        burst: int = 200,
+        max_pending: int = 1000,
+        interval: float = 0.2,
+    ):
+        """Set limits of log delivery to clients.
+        Args:
+            rate (float): lines per second allowed for one client.
+            burst (int): lines which client can receive above the rate at once.
+            max_pending (int): max lines waiting for the next frame of one client.
+            interval (float): seconds between frames.
+        """
+        self.rate = rate
+        self.burst = burst
+        self.max_pending = max_pending
+        self.interval = interval
+
+    def subscribe(self, sid: str, level: str = "debug", frames: bool = False):
+        """Start sending log messages to client.
+        Args:
+            sid (str): client's session id.
+            level (str): min level of messages for client.
+            frames (bool): send lines in batches as 'server_log_frame' events,
+                otherwise every line is sent as 'server_log' event.
+        """
+        if level not in LEVELS:
+            raise ValueError("Unknown logger level")
+        with self._lock:
+            sub = self.subscriptions.get(sid) or LogSubscription(tokens=self.burst)
+            sub.level = LEVELS[level]
+            sub.frames = frames
+            self.subscriptions[sid] = sub
+
+    def unsubscribe(self, sid: str):
+        with self._lock:
+            self.subscriptions.pop(sid, None)
+
+    def _queue(self, levelno: int, label: str, message: str, sid: str = None):
+        """Put message into client's queue. Never blocks and never emits itself."""
+        if sid is None:
+            # Messages of job are sent only to the client who runs it
+            job = current_job.get()
+            if job is None or job.sid is None:
+                return
+            sid = job.sid
+        with self._lock:
+            sub = self.subscriptions.get(sid)
+            if sub is None or levelno < sub.level:
+                return
+            now = time.monotonic()
+            sub.tokens = min(self.burst, sub.tokens + (now - sub.updated) * self.rate)
+            sub.updated = now
+            if sub.tokens < 1 or len(sub.lines) >= self.max_pending:
+                sub.dropped += 1
+                self.dropped += 1
+                return
+            sub.tokens -= 1
+            sub.lines.append(f"[{label}] {message}")
+
+    def flush(self):
+        """Send queued messages to clients"""
+        frames = []
+        with self._lock:
+            for sid, sub in self.subscriptions.items():
+                if not sub.lines and not sub.dropped:
+                    continue
+                frames.append((sid, sub.frames, list(sub.lines), sub.dropped))
+                sub.lines.clear()
+                sub.dropped = 0
+        for sid, as_frame, lines, dropped in frames:
+            if as_frame:
+                self.servlog.emit(
+                    "server_log_frame", {"lines": lines, "dropped": dropped}, room=sid
+                )
+            else:
+                if dropped:
+                    lines.append(f"[WARNING] {dropped} log messages dropped")
+                for line in lines:
+                    self.servlog.emit("server_log", line, room=sid)
+            self.emitted += len(lines)
+
+    def run_flusher(self):
+        """Loop which sends queued messages every 'interval' seconds"""
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                self.pylog.error(f"log flush failed: {e}")
 
     def debug(self, message: str, sid: str = None):
         self.pylog.debug(message)
-        self.servlog.emit("server_log", f"[DEBUG] {message}", room=sid)
+        self._queue(logging.DEBUG, "DEBUG", message, sid)
 
     def info(self, message: str, sid: str = None):
         self.pylog.info(message)
-        self.servlog.emit("server_log", f"[INFO] {message}", room=sid)
+        self._queue(logging.INFO, "INFO", message, sid)
 
     def warning(self, message: str, sid: str = None):
         self.pylog.warning(message)
-        self.servlog.emit("server_log", f"[WARNING] {message}", room=sid)
+        self._queue(logging.WARNING, "WARNING", message, sid)
 
     def error(self, message: str, sid: str = None):
         self.pylog.error(message)
-        self.servlog.emit("server_log", f"[ERROR] {message}", room=sid)
+        self._queue(logging.ERROR, "ERROR", message, sid)
 
     def critical(self, message: str, sid: str = None):
         self.pylog.critical(message)
-        self.servlog.emit("server_log", f"[CRITICAL] {message}", room=sid)
+        self._queue(logging.CRITICAL, "CRITICAL", message, sid)
@@ -13,23 +13,41 @@
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
 import configparser
-import json
-from dataclasses import dataclass
+import hashlib
+import os
+import uuid
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, wait
+from dataclasses import asdict, dataclass
 from pathlib import Path
 from typing import Optional
 
-import eventlet
-import socketio
-from connector import ConnectionHandler
-from logger import LoggerHandler
-
-# SocketIO initialization
-sio = socketio.Server()
-app = socketio.WSGIApp(sio)
-# First init of logger singleton
-log = LoggerHandler(name=__name__, sio=sio)
-# Global dict to keep all ssh connections params from clients
-ssh_connects: dict = {}
+# asgi.py runs the same handlers on asyncio with real threads, without eventlet
+ASYNC_MODE: bool = os.environ.get("ASST_ASYNC") == "1"
+if not ASYNC_MODE:
+    import eventlet
+
+    # Paramiko's blocking calls must yield to other clients, so stdlib is
+    # patched before anything imports socket or threading.
+    eventlet.monkey_patch()
+
+import socketio  # noqa: E402
+from cache import ResultCache  # noqa: E402
+from codec import Codec, negotiate  # noqa: E402
+from filters import OutputFilter  # noqa: E402
+from leases import MODES as LEASE_MODES  # noqa: E402
+from logger import LoggerHandler  # noqa: E402
+from metrics import metrics  # noqa: E402
+from pool import ConnectionPool  # noqa: E402
+from profiles import profiles_init  # noqa: E402
+from registry import JobRegistry  # noqa: E402
+from relay import RelayManager  # noqa: E402
+from scheduler import JobCancelled, JobScheduler, SchedulerBusy  # noqa: E402
+from store import store_init  # noqa: E402
+from transfer import transfer_dir_init  # noqa: E402
+
+# First init of logger singleton, SocketIO server is added after config init
+log = LoggerHandler(name=__name__)
 app_workdir = Path(__file__).cwd()
 
 # Config init
@@ -50,10 +68,137 @@ app_config = config_init(app_workdir)
 # App params
 try:
     SERVER_IP: str = app_config["server"]["ip"]
-    SERVER_PORT: int = app_config["server"].getint("port")
+    SERVER_PORT: int = int(
+        os.environ.get("ASST_PORT") or app_config["server"].getint("port")
+    )
+
+    # 'memory' keeps sessions in this process, 'unix:<path>' shares them with
+    # other workers through broker (see cluster.py)
+    CLUSTER_STORE: str = os.environ.get("ASST_STORE") or app_config.get(
+        "cluster", "store", fallback="memory"
+    )
+    # Address of this worker for clients, hosts are owned by workers if it's set
+    CLUSTER_WORKER_URL: Optional[str] = os.environ.get("ASST_WORKER_URL")
+    CLUSTER_STICKY: bool = app_config.getboolean("cluster", "sticky", fallback=True)
+
+    POOL_MAX_SIZE: int = app_config.getint("ssh_pool", "max_size", fallback=32)
+    POOL_IDLE_TIMEOUT: int = app_config.getint("ssh_pool", "idle_timeout", fallback=300)
+    POOL_KEEPALIVE: int = app_config.getint("ssh_pool", "keepalive", fallback=30)
+    POOL_MAX_CHANNELS: int = app_config.getint("ssh_pool", "max_channels", fallback=8)
+
+    SCHEDULER_WORKERS: int = app_config.getint("scheduler", "workers", fallback=16)
+    SCHEDULER_PER_HOST: int = app_config.getint("scheduler", "per_host", fallback=4)
+    SCHEDULER_MAX_QUEUE: int = app_config.getint(
+        "scheduler", "max_queue", fallback=256
+    )
+
+    FANOUT_PARALLELISM: int = app_config.getint("fanout", "parallelism", fallback=32)
+
+    CACHE_MAX_ENTRIES: int = app_config.getint("cache", "max_entries", fallback=1024)
+    CACHE_MAX_BYTES: int = app_config.getint(
+        "cache", "max_bytes", fallback=16 * 1024 * 1024
+    )
+    CACHE_TTL: float = app_config.getfloat("cache", "ttl", fallback=60.0)
+
+    LEASE_MODE: str = app_config.get("leases", "mode", fallback="exclusive")
+    LEASE_TIMEOUT: float = app_config.getfloat("leases", "timeout", fallback=30.0)
+
+    TRANSFER_DIR: str = app_config.get("transfer", "dir", fallback="~/asst-files")
+
+    RELAY_MAX_CHUNK: int = app_config.getint(
+        "relay", "max_chunk", fallback=512 * 1024
+    )
+    RELAY_PER_CLIENT: int = app_config.getint("relay", "per_client", fallback=8)
+
+    JOBS_RELOAD_INTERVAL: float = app_config.getfloat(
+        "jobs", "reload_interval", fallback=2.0
+    )
+
+    CODEC_THRESHOLD: int = app_config.getint(
+        "codec", "compress_threshold", fallback=4096
+    )
+    CODEC_LEVEL: int = app_config.getint("codec", "compress_level", fallback=1)
+
+    LOG_CLIENT_LEVEL: str = app_config.get("logging", "client_level", fallback="debug")
+    LOG_RATE: float = app_config.getfloat("logging", "rate", fallback=100.0)
+    LOG_BURST: int = app_config.getint("logging", "burst", fallback=200)
+    LOG_MAX_PENDING: int = app_config.getint("logging", "max_pending", fallback=1000)
+    LOG_INTERVAL: float = app_config.getfloat("logging", "interval", fallback=0.2)
 except Exception as e:
     log.error(f"Fail to load app params: {e}")
 
+
+# Prometheus text page with server's metrics, other paths are not served
+def metrics_app(environ, start_response):
+    if environ.get("PATH_INFO") != "/metrics":
+        start_response("404 Not Found", [("Content-Type", "text/plain")])
+        return [b"Not Found"]
+    body = metrics.render().encode()
+    start_response(
+        "200 OK",
+        [
+            ("Content-Type", "text/plain; version=0.0.4; charset=utf-8"),
+            ("Content-Length", str(len(body))),
+        ],
+    )
+    return [body]
+
+
+# SocketIO initialization, workers of cluster exchange messages through broker
+if ASYNC_MODE:
+    # Handlers are only registered here, asgi.py serves them with AsyncServer
+    sio = socketio.Server(async_mode="threading")
+elif CLUSTER_STORE.startswith("unix:"):
+    from broker import UnixSocketManager
+
+    sio = socketio.Server(client_manager=UnixSocketManager(CLUSTER_STORE[5:]))
+else:
+    sio = socketio.Server()
+app = socketio.WSGIApp(sio, metrics_app)
+log.servlog = sio
+# Clients' ssh connections params, shared by all workers in cluster mode
+sessions = store_init(CLUSTER_STORE)
+# Encoders of answers agreed with every client at connect, JSON if not set
+codecs: dict = {}
+
+# Index of all jobs from 'jobs' modules, built once and reloaded on changes
+registry = JobRegistry()
+registry.refresh()
+# Log messages are delivered to clients in frames, with per client rate limit
+log.configure(
+    rate=LOG_RATE, burst=LOG_BURST, max_pending=LOG_MAX_PENDING, interval=LOG_INTERVAL
+)
+# Pool of live ssh connections shared between all clients' messages
+ssh_pool = ConnectionPool(
+    max_size=POOL_MAX_SIZE,
+    idle_timeout=POOL_IDLE_TIMEOUT,
+    keepalive=POOL_KEEPALIVE,
+    max_channels=POOL_MAX_CHANNELS,
+    profiles=profiles_init(app_config),
+    # Jobs' local files are kept apart from code and config of the server
+    transfer_dir=transfer_dir_init(TRANSFER_DIR, Path(__file__).parent, app_workdir),
+)
+# Clients' leases of hosts they work with, instead of scan of all connections
+leases = sessions.leases()
+# Results of cacheable jobs, shared by all clients
+cache = ResultCache(max_entries=CACHE_MAX_ENTRIES, max_bytes=CACHE_MAX_BYTES)
+# Client's file transfers piped straight to/from remote hosts over pooled connections
+relay = RelayManager(ssh_pool, max_chunk=RELAY_MAX_CHUNK, per_client=RELAY_PER_CLIENT)
+# Worker pool which runs jobs, so slow backend can't stall other clients
+scheduler = JobScheduler(
+    workers=SCHEDULER_WORKERS,
+    per_host=SCHEDULER_PER_HOST,
+    max_queue=SCHEDULER_MAX_QUEUE,
+)
+# Gauges read from server's parts every time metrics are requested
+metrics.collector("ssh_pool", ssh_pool.stats)
+metrics.collector("bastions", ssh_pool.bastions.stats)
+metrics.collector("scheduler", scheduler.stats)
+metrics.collector("cache", cache.stats)
+metrics.collector("relay", relay.stats)
+metrics.collector("leases", leases.stats)
+metrics.collector("log", lambda: {"emitted": log.emitted, "dropped": log.dropped})
+
 # Data class for client's ssh params.
 @dataclass
 class SshParams:
@@ -62,6 +207,8 @@ class SshParams:
     ssh_user: Optional[str]
     ssh_pass: Optional[str]
     ssh_port: int = 22
+    # Name of transport profile from 'profile.<name>' config sections
+    ssh_profile: Optional[str] = None
 
     def ready(self):
         if self.ssh_ip and self.ssh_user and self.ssh_pass and self.ssh_port:
@@ -69,14 +216,72 @@ class SshParams:
         else:
             return False
 
+    def target(self) -> Optional[str]:
+        """Host which jobs are really executed on"""
+        return self.ssh_hostname or self.ssh_ip
+
+    @classmethod
+    def from_params(cls, params: dict):
+        """Build params from client's dict in 'ssh_connection_init' format"""
+        return cls(
+            params["ssh_ip"],
+            params.get("ssh_hostname"),
+            params["ssh_user"],
+            params["ssh_pass"],
+            int(params.get("ssh_port", 22)),
+            params.get("ssh_profile"),
+        )
+
+
+# Client's current ssh params, every call returns new copy
+def session(sid) -> SshParams:
+    params = sessions.get(sid)
+    return SshParams(**params) if params else SshParams(None, None, None, None)
+
+
+# Named groups of hosts for fan-out jobs, from 'inventory.<group>' config sections:
+# # hosts - comma separated ips, or hostnames behind jump server if 'jump' is set
+# # jump - optional, ip of jump server (HA)
+# # user, pass, port - ssh params shared by all hosts of the group
+# # profile - optional, transport profile of all hosts of the group
+def inventory_init(config: configparser.ConfigParser) -> dict:
+    inventory = {}
+    for section in config.sections():
+        if not section.startswith("inventory."):
+            continue
+        group = config[section]
+        hosts = [host.strip() for host in group.get("hosts", "").split(",")]
+        inventory[section[len("inventory.") :]] = [
+            SshParams(
+                group.get("jump", host),
+                host if "jump" in group else None,
+                group.get("user"),
+                group.get("pass"),
+                group.getint("port", 22),
+                group.get("profile"),
+            )
+            for host in hosts
+            if host
+        ]
+    return inventory
+
+
+inventory = inventory_init(app_config)
+
 
 # This function executed when new client connected.
 @sio.event
-def connect(sid, _):
+def connect(sid, _, auth=None):
     # Lets create new SshParams object for connected client and store it into our global params list.
     # With empty params for now. Because we do not force client to connect ssh from start.
     # And client can change ssh params on the fly in any moment.
-    ssh_connects[sid] = SshParams(None, None, None, None)
+    sessions.set(sid, asdict(SshParams(None, None, None, None)))
+    # Client can offer encodings and compression of answers in connect's auth
+    codecs[sid] = negotiate(auth, CODEC_THRESHOLD, CODEC_LEVEL)
+    metrics.inc("clients_connected")
+    metrics.add("clients_active", 1)
+    # Client receives only own log messages, level can be changed with 'log_subscribe'
+    log.subscribe(sid, LOG_CLIENT_LEVEL)
     log.info(f"{sid} connected")
 
 
@@ -87,89 +292,541 @@ def message(sid, data):
     log.info(f"server received command: {str(data)}", sid)
     # Lets check what client wants from us.
     # Structure of client's messages ('data' variable):
-    # # type: str - can be 'system' or 'module' so far
+    # # type: str - can be 'system', 'module' or 'batch' so far
     # # job: str - name of the job for server to looking for inside
     # # func: str - name of the function to execute inside module
     # # params: str - addition variables for function
+    # # priority: str - optional, 'high', 'normal' or 'low' priority of the job
+    # # mode: str - optional, 'submit' to receive job id right away and result
+    # #   later as 'job_done' event, progress comes as 'job_progress' events
+    # # options: dict - optional, job execution options:
+    # #   stream: bool - send command output as 'job_output' events while it runs
+    # #   max_bytes / max_lines: int - truncate streamed output after the limit
+    # #   head / tail: int - return only first / last lines of output
+    # #   include / exclude: str - return only lines matching / not matching regex
+    # #   max_bytes: int - without streaming, max size of returned output
+    # #   parse: str - 'kv', 'columns' or 'json' to return parsed output
+    # #   pty: bool - run commands with PTY (old behaviour, e.g. for sudo)
+    # #   shell: bool - run commands one by one in persistent shell of connection
+    # # targets: list - optional, ssh params of hosts to run job on all of them
+    # # group: str - optional, inventory group from config to run job on
 
     # TODO: Standartization and validation of client's message
 
+    # 'batch' type messages have 'items': list of {'func', 'params'} and
+    # 'on_error': 'stop' or 'continue' instead of single 'func' and 'params'.
+
     # 'System' type for server's system stuff, like various connections
     if "system" in data["type"]:
         # If client requests server command list
         if "get_server_command_list" in data["job"]:
-            # jobs modules import must be inside message func
-            from jobs import server
-
-            msg_result = [
-                func
-                for func in dir(server)
-                if callable(getattr(server, func)) and not func.startswith("__")
-            ]
-        # If client want to set params for ssh connection
+            msg_result = registry.names()
+        # If client requests description of server commands. Client can send
+        # 'version' which it already knows to skip download of the same list.
+        if data["job"] == "get_server_command_manifest":
+            params = data.get("params") or {}
+            if params.get("version") and params["version"] == registry.version:
+                msg_result = {"version": registry.version, "changed": False}
+            else:
+                msg_result = {**registry.manifest(), "changed": True}
+        # If client want to set params for ssh connection. Optional 'lease':
+        # 'exclusive' (default) or 'shared' and 'lease_timeout' in seconds.
         if "ssh_connection_init" in data["job"]:
-            check_conn = [
-                conn
-                for conn in ssh_connects.values()
-                if conn.ssh_ip == data["params"]["ssh_ip"]
-            ]
-            if len(check_conn) > 0:
-                if (
-                    ssh_connects[sid]
-                    and ssh_connects[sid].ssh_ip == data["params"]["ssh_ip"]
-                ):
-                    log.warning("Your already use same SSH connection params", sid)
-                else:
-                    log.error("Oops, somebody already works with same ip", sid)
-                    log.warning(
-                        "Your SSH connection params dropped off. Please reinit.", sid
-                    )
-                    ssh_connects[sid] = SshParams(None, None, None, None)
+            msg_result = ssh_connection_init(sid, data["params"])
+        # If client want to change level of server's log messages or receive
+        # them in frames ('server_log_frame' events) instead of line by line
+        if data["job"] == "log_subscribe":
+            try:
+                log.subscribe(
+                    sid,
+                    data["params"].get("level", LOG_CLIENT_LEVEL),
+                    bool(data["params"].get("frames", False)),
+                )
+                msg_result = {"result": True}
+            except ValueError as e:
+                log.error(f"wrong log subscription: {e}", sid)
                 msg_result = {"result": False}
+        # If client want to drop cached results, optional 'host' and 'func'
+        # params limit it to one host and/or one job
+        if data["job"] == "cache_invalidate":
+            params = data.get("params") or {}
+            removed = cache.invalidate(params.get("host"), params.get("func"))
+            msg_result = {"result": True, "removed": removed}
+        if data["job"] == "cache_stats":
+            msg_result = cache.stats()
+        # If client want counters and latencies of server, jobs and ssh
+        if data["job"] == "get_metrics":
+            msg_result = metrics.snapshot()
+        # If client want to cancel submitted job
+        if data["job"] == "cancel":
+            job = scheduler.get(data["params"]["job_id"])
+            if job is not None and job.sid == sid:
+                msg_result = {"result": scheduler.cancel(job.id)}
             else:
-                try:
-                    ssh_connects[sid].ssh_ip = data["params"]["ssh_ip"]
-                    if "ssh_hostname" in data["params"]:
-                        ssh_connects[sid]["ssh_hostname"] = data["params"][
-                            "ssh_hostname"
-                        ]
-                    ssh_connects[sid].ssh_user = data["params"]["ssh_user"]
-                    ssh_connects[sid].ssh_pass = data["params"]["ssh_pass"]
-                    if "ssh_port" in data["params"]:
-                        ssh_connects[sid].ssh_port = data["params"]["ssh_port"]
-                    msg_result = {"result": True}
-                except Exception as e:
-                    log.error(f"server can't set SSH connection data: {e}", sid)
-                    msg_result = {"result": False}
+                log.warning("No such job to cancel", sid)
+                msg_result = {"result": False}
     # 'Module' type for calling varios server's modules
     elif "module" in data["type"]:
         # TODO: 'Job' is part of this func right now. Will good to rework it.
         # if clinet want to work with SSH jobs
         if "ssh" in data["job"]:
-            # jobs modules import must be inside message func
-            from jobs import server
+            if data["job"] == "ssh" and registry.get(data["func"]) is None:
+                log.error(f"Unknown job: {data['func']}", sid)
+                msg_result = {"result": False}
+            elif data["job"] == "ssh":
+                # 'submit' mode returns job id and sends result later as event
+                if data.get("mode") == "submit":
+                    msg_result = submit_scheduled(sid, data, ssh_job)
+                # fan-out mode runs job on the list of targets or inventory group
+                elif "targets" in data or "group" in data:
+                    msg_result = run_fanout(sid, data, ssh_job)
+                else:
+                    msg_result = run_cached(sid, data, ssh_job)
+    # 'Batch' type runs list of jobs one by one over one connection
+    elif "batch" in data["type"]:
+        if data.get("mode") == "submit":
+            msg_result = submit_scheduled(sid, data, batch_job)
+        else:
+            msg_result = run_scheduled(sid, data, batch_job)
+    return encode_answer(sid, msg_result)
+
+
+# Answer in format agreed with client, json by default
+def encode_answer(sid, msg_result):
+    codec = codecs.get(sid) or Codec()
+    answer = codec.encode(msg_result)
+    metrics.inc("answer_bytes", len(answer), encoding=codec.encoding)
+    return answer
+
 
+# Sets client's ssh params after it gets lease of the host. Client waits in the
+# host's queue if other clients hold incompatible lease.
+def ssh_connection_init(sid, params: dict):
+    # Everything is checked before current lease is released, so wrong
+    # request leaves client with its old params and lease
+    try:
+        conn_params = SshParams.from_params(params)
+        ssh_pool.profile(conn_params.ssh_profile)
+        mode = params.get("lease", LEASE_MODE)
+        if mode not in LEASE_MODES:
+            raise ValueError(f"unknown lease mode: {mode}")
+        lease_timeout = float(params.get("lease_timeout", LEASE_TIMEOUT))
+    except (KeyError, TypeError, ValueError) as e:
+        log.error(f"server can't set SSH connection data: {e}", sid)
+        return {"result": False}
+    host = conn_params.target()
+    # In cluster every host is served by one worker, so its pooled connections
+    # stay warm. Client is sent to the owner instead of connecting from here.
+    if CLUSTER_WORKER_URL and CLUSTER_STICKY:
+        owner = sessions.claim(host, CLUSTER_WORKER_URL, POOL_IDLE_TIMEOUT)
+        if owner != CLUSTER_WORKER_URL:
+            log.info(f"{host} is served by {owner}", sid)
+            return {"result": False, "reason": "moved", "worker": owner}
+    current = session(sid).target()
+    if current and current != host:
+        leases.release(sid, current)
+    elif current == host and sid in leases.holders(host):
+        log.warning("Your already use same SSH connection params", sid)
+    try:
+        granted = leases.acquire(sid, host, mode, timeout=lease_timeout)
+    except ValueError as e:
+        log.error(f"wrong lease: {e}", sid)
+        sessions.set(sid, asdict(SshParams(None, None, None, None)))
+        return {"result": False}
+    if not granted:
+        log.error(f"Oops, {host} is still busy with other clients", sid)
+        log.warning("Your SSH connection params dropped off. Please reinit.", sid)
+        sessions.set(sid, asdict(SshParams(None, None, None, None)))
+        return {"result": False, "reason": "lease timeout"}
+    sessions.set(sid, asdict(conn_params))
+    return {"result": True, "lease": mode}
+
+
+# Executed by scheduler's worker: runs job from 'jobs' modules over pooled connection.
+def ssh_job(conn_params: SshParams, data: dict):
+    func = job_func(data["func"])
+    with metrics.timer("job", func=data["func"]):
+        with ssh_pool.connection(conn_params) as conn:
+            result = func(conn, data["params"])
+    if not job_ok(result):
+        metrics.inc("job_failed", func=data["func"])
+    return result
+
+
+# Job function from registry by its name.
+def job_func(name: str):
+    spec = registry.get(name)
+    if spec is None:
+        raise LookupError(f"unknown job: {name}")
+    return spec.func
+
+
+# Executed by scheduler's worker: runs all batch's jobs over one pooled connection.
+# With 'on_error': 'stop' (default) jobs after the first failed one are skipped.
+def batch_job(conn_params: SshParams, data: dict):
+    stop_on_error = data.get("on_error", "stop") == "stop"
+    results = []
+    with metrics.timer("job", func="batch"), ssh_pool.connection(conn_params) as conn:
+        for item in data["items"]:
             try:
-                conn = ConnectionHandler(ssh_connects[sid])
-                if data["job"] == "ssh":
-                    func = getattr(server, data["func"])
-                    result = func(conn, data["params"])
-                    conn.close()
-                    msg_result = result
+                func = job_func(item["func"])
+                result = func(conn, item.get("params", []))
+            except JobCancelled:
+                raise
             except Exception as e:
-                log.error(f"server did't init SSH connection: {e}", sid)
-                msg_result = {"result": False}
-    # return of answer in json format
-    return json.dumps(msg_result)
+                log.error(f"batch job {item.get('func')} failed: {e}")
+                result = {"result": False, "error": str(e)}
+            results.append(result)
+            if stop_on_error and not job_ok(result):
+                break
+    return {
+        "result": len(results) == len(data["items"]) and all(map(job_ok, results)),
+        "completed": len(results),
+        "results": results,
+    }
+
+
+# Sends job's events (progress, streamed output) to the client who runs the job.
+def job_emitter(sid):
+    def emit(event: str, data: dict, callback=None):
+        sio.emit(event, data, room=sid, callback=callback)
+
+    return emit
+
+
+# Put job into scheduler. Returns job or ready answer for client if job rejected.
+def schedule(sid, data: dict, job_func, conn_params: SshParams = None):
+    if conn_params is None:
+        # Copy of params, so client can change them while job is waiting in queue
+        conn_params = session(sid)
+    try:
+        # Wrong output filter options are rejected before job is queued
+        options = data.get("options") or {}
+        OutputFilter.from_options(options)
+        timeout = options.get("shell_timeout")
+        if timeout is not None and (
+            not isinstance(timeout, (int, float)) or timeout <= 0
+        ):
+            raise ValueError("'shell_timeout' must be positive number")
+        job = scheduler.submit(
+            sid,
+            conn_params.target(),
+            job_func,
+            conn_params,
+            data,
+            priority=data.get("priority", "normal"),
+            options=data.get("options"),
+            emitter=job_emitter(sid),
+        )
+    except SchedulerBusy as e:
+        log.warning(f"server busy, job rejected: {e}", sid)
+        return None, {"result": False, "reason": "server busy", **scheduler.stats()}
+    except ValueError as e:
+        log.error(f"job rejected: {e}", sid)
+        return None, {"result": False}
+    return job, None
+
+
+# Waits for job's end and converts failures to answer for client.
+def job_result(job):
+    if job.cancelled or job.future.cancelled():
+        log.warning(f"job {job.id} cancelled", job.sid)
+        return {"result": False, "reason": "cancelled"}
+    try:
+        return job.future.result()
+    except JobCancelled:
+        log.warning(f"job {job.id} cancelled", job.sid)
+        return {"result": False, "reason": "cancelled"}
+    except Exception as e:
+        log.error(f"server did't init SSH connection: {e}", job.sid)
+        return {"result": False}
+
+
+def job_stats(job) -> dict:
+    return {
+        "job_id": job.id,
+        "queue_depth": job.queue_depth,
+        "wait_time": round(job.wait_time, 3),
+    }
+
+
+# Put job into scheduler and wait for the result without blocking other clients.
+def run_scheduled(sid, data: dict, job_func):
+    job, rejected = schedule(sid, data, job_func)
+    if job is None:
+        return rejected
+    try:
+        return job_result(job)
+    finally:
+        sio.emit("job_stats", job_stats(job), room=sid)
+
+
+# Job function of message which only waits for its scheduled job in
+# run_scheduled(), None for all other messages. Async server (asgi.py) awaits
+# job's future for such messages instead of holding a thread until it's done.
+def scheduled_func(data):
+    if not isinstance(data, dict) or data.get("mode") == "submit":
+        return None
+    if data.get("type") == "batch":
+        return batch_job
+    if data.get("type") != "module" or data.get("job") != "ssh":
+        return None
+    if "targets" in data or "group" in data or not isinstance(data.get("func"), str):
+        return None
+    spec = registry.get(data["func"])
+    options = data.get("options") or {}
+    if spec is None or not isinstance(options, dict):
+        return None
+    if spec.meta.get("cacheable") and CACHE_MAX_ENTRIES and not options.get("stream"):
+        return None
+    return ssh_job
+
+
+# Jobs marked with @job(cacheable=True, ttl=...) answer from cache while their
+# result is fresh, identical calls coming at the same time share one execution.
+def run_cached(sid, data: dict, job_func):
+    meta = registry.get(data["func"]).meta
+    options = data.get("options") or {}
+    if not meta.get("cacheable") or not CACHE_MAX_ENTRIES or options.get("stream"):
+        return run_scheduled(sid, data, job_func)
+    conn_params = session(sid)
+    # Whole connection with password is in the key: client with other
+    # credentials or jump server doesn't get result it couldn't get itself
+    password = hashlib.sha256((conn_params.ssh_pass or "").encode()).hexdigest()
+    key = cache.key(
+        conn_params.target(),
+        (ssh_pool.key(conn_params), password),
+        data["func"],
+        # Filtered output differs from full one, so options are part of the key
+        [data.get("params"), options],
+    )
+    return cache.fetch(
+        key,
+        meta.get("ttl", CACHE_TTL),
+        lambda: run_scheduled(sid, data, job_func),
+        store=job_ok,
+    )
+
+
+# Put job into scheduler and return its id right away.
+# Result will be sent to client as 'job_done' event.
+def submit_scheduled(sid, data: dict, job_func):
+    job, rejected = schedule(sid, data, job_func)
+    if job is None:
+        return rejected
+
+    def done(_):
+        sio.emit("job_done", {**job_stats(job), "result": job_result(job)}, room=sid)
+
+    job.future.add_done_callback(done)
+    return {"result": True, "job_id": job.id}
+
+
+# True if job's result looks like successful command: (0, output)
+def job_ok(result) -> bool:
+    if isinstance(result, dict):
+        return result.get("result") is not False
+    if isinstance(result, (list, tuple)) and result:
+        return result[0] == 0
+    return result is not None
+
+
+# Runs job on many targets at once. Every host's result is sent to client
+# as 'fanout_result' event right away, answer contains only summary.
+# Job holds shared lease of its host, hosts leased exclusively by other
+# clients are skipped and counted as failed.
+def run_fanout(sid, data: dict, job_func):
+    fanout_id = data.get("fanout_id") or uuid.uuid4().hex
+    try:
+        if "group" in data:
+            targets = list(inventory[data["group"]])
+        else:
+            targets = [SshParams.from_params(params) for params in data["targets"]]
+        for target in targets:
+            ssh_pool.profile(target.ssh_profile)
+        parallelism = int(data.get("parallelism", FANOUT_PARALLELISM))
+    except (KeyError, TypeError, ValueError) as e:
+        log.error(f"wrong fan-out targets: {e}", sid)
+        return {"result": False}
+    parallelism = min(parallelism, FANOUT_PARALLELISM)
+    # Results are keyed by host, so every host runs the job once
+    unique = {}
+    for target in targets:
+        unique.setdefault(target.target(), target)
+    if len(unique) < len(targets):
+        skipped = len(targets) - len(unique)
+        log.warning(f"duplicate fan-out targets skipped: {skipped}", sid)
+        targets = list(unique.values())
+    summary = {"fanout_id": fanout_id, "total": len(targets), "ok": 0, "failed": []}
+    pending = deque(targets)
+    running = {}
+    # Own lease holder, so client's lease from ssh_connection_init isn't changed
+    holder = f"{sid}/fanout/{fanout_id}"
+    leased = set()
+
+    def lease(host: str) -> bool:
+        if sid in leases.holders(host):
+            return True
+        if not leases.acquire(holder, host, "shared"):
+            return False
+        leased.add(host)
+        return True
+
+    def finish(host: str, result):
+        if host in leased:
+            leased.discard(host)
+            leases.release(holder, host)
+        if job_ok(result):
+            summary["ok"] += 1
+        else:
+            summary["failed"].append(host)
+        sio.emit(
+            "fanout_result",
+            {"fanout_id": fanout_id, "host": host, "result": result},
+            room=sid,
+        )
+
+    log.info(f"fan-out {data['func']} on {len(targets)} hosts", sid)
+    try:
+        while pending or running:
+            while pending and len(running) < max(parallelism, 1):
+                conn_params = pending[0]
+                host = conn_params.target()
+                if not lease(host):
+                    pending.popleft()
+                    log.warning(f"{host} is leased by other client, skipped", sid)
+                    finish(host, {"result": False, "reason": "leased"})
+                    continue
+                job, rejected = schedule(sid, data, job_func, conn_params)
+                if job is None:
+                    # Queue is full: wait for own jobs, fail host if there are none
+                    if running:
+                        break
+                    pending.popleft()
+                    finish(host, rejected)
+                    continue
+                pending.popleft()
+                running[job.future] = job
+            if not running:
+                continue
+            done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in done:
+                job = running.pop(future)
+                finish(job.host, job_result(job))
+    finally:
+        for host in list(leased):
+            leases.release(holder, host)
+    summary["result"] = not summary["failed"]
+    return summary
+
+
+# File relay: client uploads file in chunks which are written directly into
+# remote file, or downloads it asking for chunks one by one. Nothing is stored
+# on the server. Chunks have 'offset', so client can send several at once.
+# # upload_start / download_start: {'path'} -> {'result', 'transfer_id'[, 'size']}
+# # upload_chunk: {'transfer_id', 'offset', 'data': bytes} -> {'result', 'bytes'}
+# # download_chunk: {'transfer_id', 'offset', 'size'} -> {'result', 'data': bytes}
+# # upload_end: {'transfer_id', 'size'} -> {'result', 'bytes', 'elapsed', ...}
+# # download_end: {'transfer_id'} -> {'result', 'bytes', 'elapsed', ...}
+# Upload replaces remote file only when 'size' of upload_end matches written
+# data, upload_end without it aborts upload and keeps the old file.
+# Every handler answers, client waits for the ack of each event.
+def relay_call(sid, call):
+    try:
+        return call()
+    except Exception as e:
+        log.error(f"file relay failed: {e}", sid)
+        return {"result": False, "reason": str(e)}
+
+
+def relay_start(sid, start, data: dict):
+    conn_params = session(sid)
+    if not conn_params.ready():
+        log.error("SSH connection params are not set", sid)
+        return {"result": False, "reason": "no ssh params"}
+    return start(sid, conn_params, data["path"])
+
+
+@sio.event
+def upload_start(sid, data):
+    return relay_call(sid, lambda: relay_start(sid, relay.start_upload, data))
+
+
+@sio.event
+def upload_chunk(sid, data):
+    return relay_call(
+        sid,
+        lambda: relay.write(
+            sid, data["transfer_id"], int(data["offset"]), data["data"]
+        ),
+    )
+
+
+@sio.event
+def upload_end(sid, data):
+    def finish():
+        size = data.get("size")
+        return relay.finish(
+            sid, data["transfer_id"], "upload", None if size is None else int(size)
+        )
+
+    return relay_call(sid, finish)
+
+
+@sio.event
+def download_start(sid, data):
+    return relay_call(sid, lambda: relay_start(sid, relay.start_download, data))
+
+
+@sio.event
+def download_chunk(sid, data):
+    return relay_call(
+        sid,
+        lambda: relay.read(
+            sid,
+            data["transfer_id"],
+            int(data["offset"]),
+            int(data.get("size", RELAY_MAX_CHUNK)),
+        ),
+    )
+
+
+@sio.event
+def download_end(sid, data):
+    return relay_call(sid, lambda: relay.finish(sid, data["transfer_id"], "download"))
 
 
 # This function executed when client disconnected.
 @sio.event
 def disconnect(sid):
-    # Lets remove client's connection params from global list
-    ssh_connects.pop(sid)
+    # Lets remove client's connection params from sessions store
+    sessions.delete(sid)
+    codecs.pop(sid, None)
+    # and stop all its jobs, nobody will wait for the results
+    scheduler.cancel_all(sid)
+    relay.abort_all(sid)
+    leases.release_all(sid)
+    log.unsubscribe(sid)
+    metrics.add("clients_active", -1)
     log.info(f"{sid} disconnected")
 
 
+# Background task which closes pooled ssh connections nobody used for a while.
+def ssh_pool_reaper():
+    while True:
+        sio.sleep(max(POOL_IDLE_TIMEOUT // 4, 1))
+        ssh_pool.evict_idle()
+
+
+# Workers and background tasks of the server, started by entry point.
+def start_background_tasks():
+    scheduler.start()
+    sio.start_background_task(ssh_pool_reaper)
+    sio.start_background_task(log.run_flusher)
+    if JOBS_RELOAD_INTERVAL > 0:
+        sio.start_background_task(registry.run_watcher, JOBS_RELOAD_INTERVAL)
+
+
 if __name__ == "__main__":
+    start_background_tasks()
     eventlet.wsgi.server(eventlet.listen((SERVER_IP, SERVER_PORT)), app)
@@ -0,0 +1,168 @@
+# Copyright © 2022 Nikolay Shishov. All rights reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable
+
+# Upper bounds of latency histograms' buckets in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _labels(labels: dict) -> tuple:
+    return tuple(sorted(labels.items()))
+
+
+class Metrics:
+    def __init__(self):
+        """Counters, gauges and latency histograms of the server.
+
+        Recording is one dict lookup and few additions under a lock, so it is
+        always on. Values are read by get_metrics system job and /metrics page.
+        """
+        self.counters: dict = {}
+        self.gauges: dict = {}
+        self.histograms: dict = {}
+        self.collectors: dict = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def add(self, name: str, value: float, **labels):
+        """Change gauge, e.g. +1 when client connects and -1 when it leaves"""
+        key = (name, _labels(labels))
+        with self._lock:
+            self.gauges[key] = self.gauges.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """Observe duration of the block, failed blocks are counted in <name>_errors"""
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.inc(f"{name}_errors", **labels)
+            raise
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def collector(self, name: str, func: Callable):
+        """Add function which returns dict of gauges, called on every read"""
+        self.collectors[name] = func
+
+    def _collected(self) -> dict:
+        gauges = {}
+        for prefix, func in self.collectors.items():
+            try:
+                values = func()
+            except Exception:
+                continue
+            for name, value in values.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    gauges[(f"{prefix}_{name}", ())] = value
+        return gauges
+
+    def snapshot(self) -> dict:
+        """All metrics as plain dict for clients"""
+
+        def name(key: tuple) -> str:
+            labels = ",".join(f"{k}={v}" for k, v in key[1])
+            return f"{key[0]}{{{labels}}}" if labels else key[0]
+
+        with self._lock:
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+            histograms = {
+                key: (histogram.count, histogram.sum)
+                for key, histogram in self.histograms.items()
+            }
+        gauges.update(self._collected())
+        return {
+            "counters": {name(key): value for key, value in counters.items()},
+            "gauges": {name(key): value for key, value in gauges.items()},
+            "histograms": {
+                name(key): {
+                    "count": count,
+                    "sum": round(total, 6),
+                    "avg": round(total / count, 6) if count else 0,
+                }
+                for key, (count, total) in histograms.items()
+            },
+        }
+
+    def render(self, prefix: str = "asst") -> str:
+        """All metrics in Prometheus text format"""
+
+        def labels(pairs: tuple, extra: str = "") -> str:
+            items = [f'{k}="{v}"' for k, v in pairs]
+            if extra:
+                items.append(extra)
+            return "{" + ",".join(items) + "}" if items else ""
+
+        with self._lock:
+            counters = sorted(self.counters.items())
+            gauges = dict(self.gauges)
+            histograms = sorted(
+                (key, list(h.counts), h.sum, h.count)
+                for key, h in self.histograms.items()
+            )
+        gauges.update(self._collected())
+        lines = []
+        typed = set()
+
+        def header(name: str, kind: str):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, pairs), value in counters:
+            header(f"{prefix}_{name}_total", "counter")
+            lines.append(f"{prefix}_{name}_total{labels(pairs)} {value}")
+        for (name, pairs), value in sorted(gauges.items()):
+            header(f"{prefix}_{name}", "gauge")
+            lines.append(f"{prefix}_{name}{labels(pairs)} {value}")
+        for (name, pairs), counts, total, count in histograms:
+            metric = f"{prefix}_{name}_seconds"
+            header(metric, "histogram")
+            cumulative = 0
+            for bound, bucket in zip(BUCKETS + ("+Inf",), counts):
+                cumulative += bucket
+                le = labels(pairs, f'le="{bound}"')
+                lines.append(f"{metric}_bucket{le} {cumulative}")
+            lines.append(f"{metric}_sum{labels(pairs)} {total}")
+            lines.append(f"{metric}_count{labels(pairs)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+# Shared by all server's modules
+metrics = Metrics()
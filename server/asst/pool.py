@@ -0,0 +1,348 @@
+# Copyright © 2022 Nikolay Shishov. All rights reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Optional
+
+from connector import ConnectionHandler
+from profiles import DEFAULT_PROFILE, TransportProfile
+
+
+@dataclass
+class PoolEntry:
+    conn: ConnectionHandler
+    password: Optional[str]
+    users: int = 0
+    stale: bool = False
+    last_used: float = field(default_factory=time.monotonic)
+
+
+@dataclass
+class BastionEntry:
+    session: object
+    password: Optional[str]
+    users: int = 0
+
+
+class BastionPool:
+    def __init__(self):
+        """Authenticated HA (jump server) sessions shared by all targets behind them.
+
+        Also keeps map of target hostnames to their reachability through HA,
+        so ConnectionHandler can skip 'hostname' probe after first success.
+        """
+        self.log = logging.getLogger(__name__)
+        self._sessions: dict = {}
+        self._retired: dict = {}
+        self._reachable: dict = {}
+        self._lock = threading.Lock()
+        # Connect to one HA doesn't wait for handshakes with other ones
+        self._key_locks: dict = {}
+
+    def _key_lock(self, key: tuple) -> threading.Lock:
+        with self._lock:
+            if key not in self._key_locks:
+                self._key_locks[key] = threading.Lock()
+            return self._key_locks[key]
+
+    def acquire(self, key: tuple, password: Optional[str], connect) -> object:
+        """Get shared HA session, connect if there is no live one
+
+        Arguments:
+            key {tuple} -- HA (ip, port, user, profile)
+            password {str} -- password for ssh connection
+            connect {callable} -- function which returns new SSHClient() to HA
+
+        Returns:
+            object -- SSHClient()
+        """
+        with self._key_lock(key):
+            with self._lock:
+                entry = self._sessions.get(key)
+            if entry:
+                transport = entry.session.get_transport()
+                if entry.password != password or not (
+                    transport and transport.is_active()
+                ):
+                    self.log.info(f"shared HA session {key} is outdated, reconnecting")
+                    self._retire(key, entry)
+                    entry = None
+            if entry is None:
+                entry = BastionEntry(connect(), password)
+                with self._lock:
+                    self._sessions[key] = entry
+                self.log.debug(f"new shared HA session {key}")
+            with self._lock:
+                entry.users += 1
+            return entry.session
+
+    def release(self, key: tuple, session: object):
+        """Give shared HA session back, last user closes it"""
+        with self._lock:
+            entry = self._sessions.get(key)
+            if entry is None or entry.session is not session:
+                entry = self._retired.get(id(session))
+            if entry is None:
+                session.close()
+                return
+            entry.users -= 1
+            close_now = entry.users <= 0
+            if close_now:
+                if self._sessions.get(key) is entry:
+                    self._sessions.pop(key)
+                self._retired.pop(id(session), None)
+        if close_now:
+            entry.session.close()
+            self.log.debug(f"shared HA session {key} closed")
+
+    def _retire(self, key: tuple, entry: BastionEntry):
+        """Remove entry from map, it will be closed by its last user"""
+        with self._lock:
+            if self._sessions.get(key) is entry:
+                self._sessions.pop(key)
+            close_now = entry.users <= 0
+            if not close_now:
+                self._retired[id(entry.session)] = entry
+        if close_now:
+            entry.session.close()
+
+    def is_proxy(self, key: tuple, hostname: str) -> Optional[bool]:
+        """Cached result of target check, None if target was never reached"""
+        with self._lock:
+            return self._reachable.get((key, hostname))
+
+    def remember(self, key: tuple, hostname: str, is_proxy: bool):
+        with self._lock:
+            self._reachable[(key, hostname)] = is_proxy
+
+    def forget(self, key: tuple, hostname: str):
+        with self._lock:
+            self._reachable.pop((key, hostname), None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "sessions": len(self._sessions),
+                "users": sum(entry.users for entry in self._sessions.values()),
+                "known_targets": len(self._reachable),
+            }
+
+
+class ConnectionPool:
+    def __init__(
+        self,
+        max_size: int = 32,
+        idle_timeout: int = 300,
+        keepalive: int = 30,
+        max_channels: int = 8,
+        profiles: Optional[dict] = None,
+        transfer_dir: Optional[Path] = None,
+    ):
+        """Pool of live SSH connections shared between messages and client sessions.
+
+        Arguments:
+            max_size {int} -- max amount of kept connections, LRU idle ones dropped
+            idle_timeout {int} -- seconds after which unused connection is closed
+            keepalive {int} -- transport keepalive interval in seconds, 0 to disable
+            max_channels {int} -- max open channels of one connection
+            profiles {dict} -- TransportProfile by name, targets choose it by name
+            transfer_dir {Path} -- local root of connections' file transfers
+        """
+        self.log = logging.getLogger(__name__)
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.keepalive = keepalive
+        self.max_channels = max_channels
+        self.profiles = profiles or {DEFAULT_PROFILE: TransportProfile()}
+        self.transfer_dir = transfer_dir
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict = OrderedDict()
+        self._by_conn: dict = {}
+        self._key_locks: dict = {}
+        self._lock = threading.Lock()
+        self.bastions = BastionPool()
+
+    @staticmethod
+    def key(conn_params: dataclass) -> tuple:
+        """Pool key of the target: (ip, port, user, jump hostname, profile)"""
+        return (
+            conn_params.ssh_ip,
+            conn_params.ssh_port,
+            conn_params.ssh_user,
+            conn_params.ssh_hostname,
+            conn_params.ssh_profile or DEFAULT_PROFILE,
+        )
+
+    def profile(self, name: Optional[str]) -> TransportProfile:
+        """Transport profile by name, 'default' one for None
+
+        Raises:
+            ValueError: if there is no such profile
+        """
+        name = name or DEFAULT_PROFILE
+        if name not in self.profiles:
+            raise ValueError(f"unknown transport profile: {name}")
+        return self.profiles[name]
+
+    def _key_lock(self, key: tuple) -> threading.Lock:
+        with self._lock:
+            if key not in self._key_locks:
+                self._key_locks[key] = threading.Lock()
+            return self._key_locks[key]
+
+    def _detach(self, key: tuple, entry: PoolEntry):
+        """Remove entry from pool. Connection closed right away if nobody uses it."""
+        with self._lock:
+            if self._entries.get(key) is entry:
+                self._entries.pop(key)
+            entry.stale = True
+            close_now = entry.users == 0
+            if close_now:
+                self._by_conn.pop(id(entry.conn), None)
+        if close_now:
+            self._close(entry)
+
+    def _close(self, entry: PoolEntry):
+        try:
+            entry.conn.close()
+        except Exception as e:
+            self.log.warning(f"pooled connection close failed: {e}")
+
+    def acquire(self, conn_params: dataclass) -> ConnectionHandler:
+        """Get live connection for target, reconnect if pooled one is dead
+
+        Arguments:
+            conn_params {dataclass} -- client's SshParams
+
+        Returns:
+            object -- ConnectionHandler()
+        """
+        key = self.key(conn_params)
+        profile = self.profile(conn_params.ssh_profile)
+        with self._key_lock(key):
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry:
+                    self._entries.move_to_end(key)
+            if entry and entry.password != conn_params.ssh_pass:
+                self.log.info(f"credentials changed for {key}, reconnecting")
+                self._detach(key, entry)
+                entry = None
+            if entry and not entry.conn.is_alive():
+                self.log.info(f"pooled transport for {key} is dead, reconnecting")
+                self._detach(key, entry)
+                entry = None
+            if entry is None:
+                conn = ConnectionHandler(
+                    conn_params,
+                    keepalive=self.keepalive,
+                    bastions=self.bastions,
+                    max_channels=self.max_channels,
+                    profile=profile,
+                    transfer_dir=self.transfer_dir,
+                )
+                entry = PoolEntry(conn, conn_params.ssh_pass)
+                with self._lock:
+                    self._entries[key] = entry
+                    self._by_conn[id(conn)] = entry
+                    self.misses += 1
+            else:
+                with self._lock:
+                    self.hits += 1
+            with self._lock:
+                entry.users += 1
+                entry.last_used = time.monotonic()
+        self._shrink()
+        return entry.conn
+
+    def release(self, conn: ConnectionHandler):
+        """Return connection to the pool
+
+        Arguments:
+            conn {ConnectionHandler} -- connection received from acquire()
+        """
+        with self._lock:
+            entry = self._by_conn.get(id(conn))
+            if entry is None:
+                return
+            entry.users -= 1
+            entry.last_used = time.monotonic()
+            close_now = entry.stale and entry.users == 0
+            if close_now:
+                self._by_conn.pop(id(conn))
+        if close_now:
+            self._close(entry)
+        else:
+            self._shrink()
+
+    def discard(self, conn: ConnectionHandler):
+        """Drop connection from pool, e.g. after transport error inside a job"""
+        with self._lock:
+            entry = self._by_conn.get(id(conn))
+            key = next((k for k, v in self._entries.items() if v is entry), None)
+        if entry is not None:
+            self._detach(key, entry)
+
+    @contextmanager
+    def connection(self, conn_params: dataclass):
+        """Context manager around acquire() and release()"""
+        conn = self.acquire(conn_params)
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def _shrink(self):
+        """Drop least recently used idle connections above max_size"""
+        with self._lock:
+            extra = len(self._entries) - self.max_size
+            victims = []
+            for key, entry in self._entries.items():
+                if extra <= 0:
+                    break
+                if entry.users == 0:
+                    victims.append((key, entry))
+                    extra -= 1
+        for key, entry in victims:
+            self.log.debug(f"pool is full, dropping {key}")
+            self._detach(key, entry)
+
+    def evict_idle(self):
+        """Close connections which were not used longer than idle_timeout"""
+        now = time.monotonic()
+        with self._lock:
+            victims = [
+                (key, entry)
+                for key, entry in self._entries.items()
+                if entry.users == 0 and now - entry.last_used > self.idle_timeout
+            ]
+        for key, entry in victims:
+            self.log.debug(f"idle timeout, dropping {key}")
+            self._detach(key, entry)
+
+    def close_all(self):
+        """Close all pooled connections"""
+        with self._lock:
+            victims = list(self._entries.items())
+        for key, entry in victims:
+            self._detach(key, entry)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "in_use": sum(1 for entry in self._entries.values() if entry.users),
+                "hits": self.hits,
+                "misses": self.misses,
+                "bastions": self.bastions.stats(),
+            }
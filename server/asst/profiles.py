@@ -0,0 +1,111 @@
+# Copyright © 2022 Nikolay Shishov. All rights reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import configparser
+from dataclasses import dataclass
+from typing import Optional
+
+import paramiko
+
+# Name of profile used by targets which didn't ask for any
+DEFAULT_PROFILE = "default"
+# Algorithm lists of profile, named as in paramiko's 'disabled_algorithms'
+ALGORITHMS = ("ciphers", "kex", "macs")
+
+
+@dataclass(frozen=True)
+class TransportProfile:
+    """SSH transport settings for a group of targets, e.g. fast ciphers
+    for LAN hosts or compression for hosts behind slow links.
+
+    Algorithm lists limit transport to the given algorithms, empty list
+    keeps all of paramiko's ones. Sizes and keepalive left as None keep
+    paramiko's and pool's defaults.
+    """
+
+    name: str = DEFAULT_PROFILE
+    ciphers: tuple = ()
+    kex: tuple = ()
+    macs: tuple = ()
+    compress: bool = False
+    window_size: Optional[int] = None
+    max_packet_size: Optional[int] = None
+    connect_timeout: float = 120
+    banner_timeout: Optional[float] = None
+    auth_timeout: Optional[float] = None
+    keepalive: Optional[int] = None
+
+    def disabled_algorithms(self) -> dict:
+        """Argument of SSHClient.connect() which leaves only profile's algorithms
+
+        Raises:
+            ValueError: if profile has algorithm unknown to paramiko
+        """
+        disabled = {}
+        for name in ALGORITHMS:
+            wanted = getattr(self, name)
+            if not wanted:
+                continue
+            known = getattr(paramiko.Transport, f"_preferred_{name}")
+            unknown = set(wanted) - set(known)
+            if unknown:
+                raise ValueError(
+                    f"profile '{self.name}': unsupported {name}: {sorted(unknown)}"
+                )
+            disabled[name] = [algo for algo in known if algo not in wanted]
+        return disabled
+
+    def connect_kwargs(self) -> dict:
+        """Keyword arguments of SSHClient.connect()"""
+        return {
+            "timeout": self.connect_timeout,
+            "banner_timeout": self.banner_timeout,
+            "auth_timeout": self.auth_timeout,
+            "compress": self.compress,
+            "disabled_algorithms": self.disabled_algorithms() or None,
+        }
+
+    def apply(self, transport: object):
+        """Settings of connected transport: sizes of channels opened from now on"""
+        if self.window_size:
+            transport.default_window_size = self.window_size
+        if self.max_packet_size:
+            transport.default_max_packet_size = self.max_packet_size
+
+
+def _names(value: str) -> tuple:
+    return tuple(name.strip() for name in value.split(",") if name.strip())
+
+
+def profiles_init(config: configparser.ConfigParser) -> dict:
+    """Profiles from 'profile.<name>' config sections, 'default' is always there
+
+    Raises:
+        ValueError: if profile has wrong values
+    """
+    profiles = {DEFAULT_PROFILE: TransportProfile()}
+    for section in config.sections():
+        if not section.startswith("profile."):
+            continue
+        name = section[len("profile.") :]
+        options = config[section]
+        profile = TransportProfile(
+            name=name,
+            ciphers=_names(options.get("ciphers", "")),
+            kex=_names(options.get("kex", "")),
+            macs=_names(options.get("macs", "")),
+            compress=options.getboolean("compress", False),
+            window_size=options.getint("window_size"),
+            max_packet_size=options.getint("max_packet_size"),
+            connect_timeout=options.getfloat("connect_timeout", 120),
+            banner_timeout=options.getfloat("banner_timeout"),
+            auth_timeout=options.getfloat("auth_timeout"),
+            keepalive=options.getint("keepalive"),
+        )
+        # Wrong algorithm names are found at start, not at first connect
+        profile.disabled_algorithms()
+        profiles[name] = profile
+    return profiles
@@ -0,0 +1,158 @@
+# Copyright © 2022 Nikolay Shishov. All rights reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import hashlib
+import importlib
+import inspect
+import json
+import logging
+import threading
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Optional
+
+
+def job(**meta):
+    """Decorator which adds metadata to job function, e.g. @job(cacheable=True)"""
+
+    def wrapper(func: Callable) -> Callable:
+        func.job_meta = meta
+        return func
+
+    return wrapper
+
+
+@dataclass
+class JobSpec:
+    name: str
+    module: str
+    func: Callable
+    signature: str
+    doc: str
+    meta: dict = field(default_factory=dict)
+
+    def describe(self) -> dict:
+        return {
+            "module": self.module,
+            "signature": self.signature,
+            "doc": self.doc,
+            "meta": self.meta,
+        }
+
+
+class JobRegistry:
+    def __init__(self, package: str = "jobs", path: Path = None):
+        """Index of all jobs from modules inside 'jobs' package.
+
+        Index is built once and rebuilt only when job modules are changed,
+        so lookups during dispatch are plain dict reads.
+
+        Arguments:
+            package {str} -- package name with job modules
+            path {Path} -- directory of the package
+        """
+        self.log = logging.getLogger(__name__)
+        self.package = package
+        self.path = path or Path(__file__).parent.absolute() / package
+        self.jobs: dict = {}
+        self.version = ""
+        self._modules: dict = {}
+        self._mtimes: dict = {}
+        self._lock = threading.Lock()
+
+    def _scan(self) -> dict:
+        """Find job modules and their modification times"""
+        return {
+            f"{self.package}.{path.stem}": path.stat().st_mtime
+            for path in sorted(self.path.glob("*.py"))
+            if not path.stem.startswith("_")
+        }
+
+    def _index(self) -> dict:
+        jobs = {}
+        for module_name, module in sorted(self._modules.items()):
+            for name, func in inspect.getmembers(module, inspect.isfunction):
+                if name.startswith("_") or func.__module__ != module_name:
+                    continue
+                if name in jobs:
+                    self.log.warning(
+                        f"job {name} from {module_name} hidden by {jobs[name].module}"
+                    )
+                    continue
+                jobs[name] = JobSpec(
+                    name,
+                    module_name,
+                    func,
+                    str(inspect.signature(func)),
+                    inspect.getdoc(func) or "",
+                    dict(getattr(func, "job_meta", {})),
+                )
+        return jobs
+
+    @staticmethod
+    def _version(jobs: dict) -> str:
+        described = {name: spec.describe() for name, spec in jobs.items()}
+        dump = json.dumps(described, sort_keys=True, default=str)
+        return hashlib.sha1(dump.encode()).hexdigest()[:12]
+
+    def refresh(self) -> bool:
+        """Import new job modules, reload changed ones and drop removed ones
+
+        Returns:
+            bool -- True if jobs index was rebuilt
+        """
+        with self._lock:
+            mtimes = self._scan()
+            if mtimes == self._mtimes:
+                return False
+            for module_name in set(self._modules) - set(mtimes):
+                self.log.info(f"job module {module_name} removed")
+                self._modules.pop(module_name)
+            for module_name, mtime in mtimes.items():
+                try:
+                    if module_name not in self._modules:
+                        self._modules[module_name] = importlib.import_module(
+                            module_name
+                        )
+                    elif self._mtimes.get(module_name) != mtime:
+                        self.log.info(f"job module {module_name} changed, reloading")
+                        self._modules[module_name] = importlib.reload(
+                            self._modules[module_name]
+                        )
+                except Exception as e:
+                    # Broken module keeps its previous version
+                    self.log.error(f"can't load job module {module_name}: {e}")
+            self._mtimes = mtimes
+            jobs = self._index()
+            # New index replaces old one at once, readers don't need the lock
+            self.jobs = jobs
+            self.version = self._version(jobs)
+            self.log.info(f"jobs registry version {self.version}: {len(jobs)} jobs")
+            return True
+
+    def get(self, name: str) -> Optional[JobSpec]:
+        return self.jobs.get(name)
+
+    def names(self) -> list:
+        return list(self.jobs)
+
+    def manifest(self) -> dict:
+        """Description of all jobs with registry's version"""
+        jobs = self.jobs
+        return {
+            "version": self.version,
+            "commands": {name: spec.describe() for name, spec in jobs.items()},
+        }
+
+    def run_watcher(self, interval: float):
+        """Loop which reloads changed job modules every 'interval' seconds"""
+        while True:
+            time.sleep(interval)
+            try:
+                self.refresh()
+            except Exception as e:
+                self.log.error(f"jobs registry refresh failed: {e}")
@@ -0,0 +1,205 @@
+# Copyright © 2022 Nikolay Shishov. All rights reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import logging
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Optional
+
+from metrics import metrics
+from transfer import replace
+
+# Upload is written under temporary name and renamed when client confirms it,
+# so aborted upload doesn't truncate existing file
+PART_SUFFIX = ".asst-relay-part"
+
+
+class RelayError(Exception):
+    pass
+
+
+@dataclass
+class Relay:
+    sid: str
+    mode: str
+    path: str
+    conn: object
+    sftp: object
+    file: object
+    part: Optional[str] = None
+    size: int = 0
+    bytes: int = 0
+    started: float = field(default_factory=time.monotonic)
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def report(self) -> dict:
+        elapsed = time.monotonic() - self.started
+        return {
+            "bytes": self.bytes,
+            "elapsed": round(elapsed, 3),
+            "throughput": round(self.bytes / elapsed) if elapsed > 0 else 0,
+        }
+
+
+class RelayManager:
+    def __init__(self, pool: object, max_chunk: int = 1024 * 1024, per_client: int = 8):
+        """File transfers between clients and remote hosts without files on server.
+
+        Client's chunks are written straight into remote SFTP file and remote
+        file is read only when client asks for next chunk, so memory use is
+        limited by chunk size and amount of client's requests in flight.
+
+        Arguments:
+            pool {ConnectionPool} -- pool to take ssh connections from
+            max_chunk {int} -- max size of one chunk in bytes
+            per_client {int} -- max amount of parallel transfers of one client
+        """
+        self.log = logging.getLogger(__name__)
+        self.pool = pool
+        self.max_chunk = max_chunk
+        self.per_client = per_client
+        self._relays: dict = {}
+        self._lock = threading.Lock()
+
+    def _open(self, sid: str, conn_params: object, path: str, mode: str) -> tuple:
+        with self._lock:
+            active = sum(1 for relay in self._relays.values() if relay.sid == sid)
+        if active >= self.per_client:
+            raise RelayError(f"too many transfers: {active}")
+        transfer_id = uuid.uuid4().hex
+        part = None
+        conn = self.pool.acquire(conn_params)
+        try:
+            # Don't wait for jobs' channels in socket.io handler
+            sftp = conn.open_sftp(blocking=False)
+            if sftp is None:
+                raise RelayError("no free channels on connection")
+            try:
+                if mode == "upload":
+                    part = f"{path}-{transfer_id[:8]}{PART_SUFFIX}"
+                    file = sftp.open(part, "wb")
+                    file.set_pipelined(True)
+                    size = 0
+                else:
+                    file = sftp.open(path, "rb")
+                    size = file.stat().st_size
+            except Exception:
+                sftp.close()
+                raise
+        except Exception:
+            self.pool.release(conn)
+            raise
+        relay = Relay(sid, mode, path, conn, sftp, file, part, size)
+        with self._lock:
+            self._relays[transfer_id] = relay
+        return transfer_id, relay
+
+    def _get(self, sid: str, transfer_id: str, mode: str) -> Relay:
+        with self._lock:
+            relay = self._relays.get(transfer_id)
+        if relay is None or relay.sid != sid or relay.mode != mode:
+            raise RelayError(f"no such {mode}: {transfer_id}")
+        return relay
+
+    def start_upload(self, sid: str, conn_params: object, path: str) -> dict:
+        """Open remote file for writing
+
+        Returns:
+            dict -- answer with 'transfer_id'
+        """
+        transfer_id, _ = self._open(sid, conn_params, path, "upload")
+        self.log.info(f"upload to {path} started")
+        return {"result": True, "transfer_id": transfer_id}
+
+    def write(self, sid: str, transfer_id: str, offset: int, data: bytes) -> dict:
+        """Write client's chunk at offset, chunks can come in any order"""
+        if len(data) > self.max_chunk:
+            raise RelayError(f"chunk is bigger than {self.max_chunk} bytes")
+        relay = self._get(sid, transfer_id, "upload")
+        with relay.lock:
+            relay.file.seek(offset)
+            relay.file.write(data)
+            relay.bytes += len(data)
+        return {"result": True, "bytes": relay.bytes}
+
+    def start_download(self, sid: str, conn_params: object, path: str) -> dict:
+        """Open remote file for reading
+
+        Returns:
+            dict -- answer with 'transfer_id' and file's 'size'
+        """
+        transfer_id, relay = self._open(sid, conn_params, path, "download")
+        self.log.info(f"download of {path} started")
+        return {"result": True, "transfer_id": transfer_id, "size": relay.size}
+
+    def read(self, sid: str, transfer_id: str, offset: int, size: int) -> dict:
+        """Read chunk at offset, empty data means end of file"""
+        relay = self._get(sid, transfer_id, "download")
+        size = max(min(size, self.max_chunk, relay.size - offset), 0)
+        if not size:
+            return {"result": True, "data": b""}
+        with relay.lock:
+            # readv sends all SFTP read requests of the chunk at once
+            data = b"".join(relay.file.readv([(offset, size)]))
+            relay.bytes += len(data)
+        return {"result": True, "data": data}
+
+    def finish(
+        self,
+        sid: str,
+        transfer_id: str,
+        mode: Optional[str] = None,
+        size: Optional[int] = None,
+    ) -> dict:
+        """Close transfer and return its stats
+
+        Upload replaces remote file only if client sent its complete size,
+        otherwise temporary file is removed and the old one is kept.
+        """
+        with self._lock:
+            relay = self._relays.get(transfer_id)
+            if relay is None or relay.sid != sid or mode not in (None, relay.mode):
+                raise RelayError(f"no such transfer: {transfer_id}")
+            self._relays.pop(transfer_id)
+        complete = True
+        try:
+            with relay.lock:
+                relay.file.close()
+            if relay.part is not None:
+                complete = size is not None and (
+                    relay.sftp.stat(relay.part).st_size == size
+                )
+                if complete:
+                    replace(relay.sftp, relay.part, relay.path)
+                else:
+                    relay.sftp.remove(relay.part)
+        finally:
+            relay.sftp.close()
+            self.pool.release(relay.conn)
+        metrics.inc("relay_bytes", relay.bytes, direction=relay.mode)
+        if not complete:
+            self.log.warning(f"upload to {relay.path} aborted: {relay.bytes} bytes")
+            return {"result": False, "reason": "upload aborted", **relay.report()}
+        self.log.info(f"{relay.mode} of {relay.path} finished: {relay.bytes} bytes")
+        return {"result": True, **relay.report()}
+
+    def abort_all(self, sid: str):
+        """Close all transfers of client, e.g. when it's disconnected"""
+        with self._lock:
+            transfer_ids = [
+                key for key, relay in self._relays.items() if relay.sid == sid
+            ]
+        for transfer_id in transfer_ids:
+            try:
+                self.finish(sid, transfer_id)
+            except Exception as e:
+                self.log.warning(f"transfer {transfer_id} abort failed: {e}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"active": len(self._relays)}
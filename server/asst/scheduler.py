@@ -0,0 +1,301 @@
+# Copyright © 2022 Nikolay Shishov. All rights reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import Future
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Callable, Optional
+
+from metrics import metrics
+
+PRIORITIES = {"high": 0, "normal": 1, "low": 2}
+
+# Job which is executed by current worker, None outside of scheduler
+current_job: ContextVar = ContextVar("current_job", default=None)
+
+
+class SchedulerBusy(Exception):
+    pass
+
+
+class JobCancelled(Exception):
+    pass
+
+
+@dataclass
+class Job:
+    sid: Optional[str]
+    host: Optional[str]
+    func: Callable
+    args: tuple
+    priority: int = PRIORITIES["normal"]
+    id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    future: Future = field(default_factory=Future)
+    queue_depth: int = 0
+    submitted: float = field(default_factory=time.monotonic)
+    started: Optional[float] = None
+    options: dict = field(default_factory=dict)
+    emitter: Optional[Callable] = None
+    cancelled: bool = False
+    channels: set = field(default_factory=set)
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+    @property
+    def wait_time(self) -> float:
+        """Seconds job spent in queue"""
+        end = self.started if self.started is not None else time.monotonic()
+        return end - self.submitted
+
+    def emit(self, event: str, data: dict, callback: Optional[Callable] = None):
+        """Send event about this job to whoever submitted it"""
+        if self.emitter is None:
+            if callback is not None:
+                callback()
+            return
+        try:
+            self.emitter(event, {"job_id": self.id, **data}, callback)
+        except Exception as e:
+            logging.getLogger(__name__).warning(f"job event {event} failed: {e}")
+
+    def progress(self, status: str, **info):
+        """Report job's progress to whoever submitted it"""
+        self.emit("job_progress", {"status": status, **info})
+
+    def track(self, channel: object):
+        """Remember remote channel used by job, so cancel() can close it"""
+        with self.lock:
+            if self.cancelled:
+                raise JobCancelled(f"job {self.id} cancelled")
+            self.channels.add(channel)
+
+    def untrack(self, channel: object):
+        with self.lock:
+            self.channels.discard(channel)
+
+    def check(self):
+        """Raise JobCancelled if job was cancelled"""
+        if self.cancelled:
+            raise JobCancelled(f"job {self.id} cancelled")
+
+    def cancel(self):
+        """Mark job cancelled and close all its remote channels"""
+        with self.lock:
+            self.cancelled = True
+            channels = list(self.channels)
+            self.channels.clear()
+        for channel in channels:
+            try:
+                channel.close()
+            except Exception:
+                pass
+
+
+class JobScheduler:
+    def __init__(self, workers: int = 16, per_host: int = 4, max_queue: int = 256):
+        """Bounded worker pool which runs client's jobs out of SocketIO handlers.
+
+        Jobs are picked by priority, then round-robin between clients (sids),
+        and never more than 'per_host' jobs run against same host at once.
+
+        Arguments:
+            workers {int} -- amount of worker threads
+            per_host {int} -- max concurrent jobs for one target host
+            max_queue {int} -- max amount of waiting jobs, new ones rejected above it
+        """
+        self.log = logging.getLogger(__name__)
+        self.workers = workers
+        self.per_host = per_host
+        self.max_queue = max_queue
+        # One round-robin map (sid -> deque of jobs) per priority level
+        self._queues = [OrderedDict() for _ in PRIORITIES]
+        self._queued = 0
+        self._running: defaultdict = defaultdict(int)
+        self._jobs: dict = {}
+        self._cond = threading.Condition()
+        self._threads: list = []
+        self._stopped = False
+
+    def start(self):
+        """Start worker threads"""
+        with self._cond:
+            if self._threads:
+                return
+            self._stopped = False
+            for num in range(self.workers):
+                thread = threading.Thread(
+                    target=self._worker, name=f"asst-worker-{num}", daemon=True
+                )
+                self._threads.append(thread)
+        for thread in self._threads:
+            thread.start()
+
+    def shutdown(self):
+        """Stop workers after their current jobs, queued jobs are cancelled"""
+        with self._cond:
+            self._stopped = True
+            for queue in self._queues:
+                for jobs in queue.values():
+                    for job in jobs:
+                        job.future.cancel()
+                queue.clear()
+            self._queued = 0
+            self._jobs.clear()
+            self._cond.notify_all()
+        self._threads = []
+
+    def submit(
+        self,
+        sid: Optional[str],
+        host: Optional[str],
+        func: Callable,
+        *args,
+        priority: str = "normal",
+        options: Optional[dict] = None,
+        emitter: Optional[Callable] = None,
+    ) -> Job:
+        """Put job into queue
+
+        Arguments:
+            sid {str} -- client's session id, used for fairness
+            host {str} -- target host, used for per host limit
+            func {callable} -- function to execute, gets *args
+            priority {str} -- 'high', 'normal' or 'low'
+            options {dict} -- client's options for job execution, e.g. streaming
+            emitter {callable} -- called with (event, data, callback) to send
+                job's events to client
+
+        Raises:
+            SchedulerBusy: if queue is full
+
+        Returns:
+            Job -- queued job, result will be set into job.future
+        """
+        if priority not in PRIORITIES:
+            raise ValueError(f"Unknown job priority: {priority}")
+        job = Job(
+            sid,
+            host,
+            func,
+            args,
+            PRIORITIES[priority],
+            options=options or {},
+            emitter=emitter,
+        )
+        with self._cond:
+            if self._stopped:
+                raise SchedulerBusy("scheduler is stopped")
+            if self._queued >= self.max_queue:
+                raise SchedulerBusy(f"queue is full: {self._queued} jobs waiting")
+            job.queue_depth = self._queued
+            self._queues[job.priority].setdefault(sid, deque()).append(job)
+            self._queued += 1
+            self._jobs[job.id] = job
+            self._cond.notify()
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        """Queued or running job by id"""
+        with self._cond:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id: str) -> bool:
+        """Cancel job: queued one is dropped, running one gets its channels closed
+
+        Returns:
+            bool -- False if there is no such queued or running job
+        """
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return False
+            queue = self._queues[job.priority]
+            jobs = queue.get(job.sid)
+            if jobs and job in jobs:
+                jobs.remove(job)
+                if not jobs:
+                    queue.pop(job.sid)
+                self._queued -= 1
+                self._jobs.pop(job_id)
+                job.cancelled = True
+                job.future.cancel()
+                return True
+        job.cancel()
+        return True
+
+    def cancel_all(self, sid: str):
+        """Cancel all queued and running jobs of client"""
+        with self._cond:
+            job_ids = [job.id for job in self._jobs.values() if job.sid == sid]
+        for job_id in job_ids:
+            self.cancel(job_id)
+
+    def _next(self) -> Optional[Job]:
+        """Pick next job which can run now. Must be called under self._cond."""
+        for queue in self._queues:
+            for sid in list(queue):
+                jobs = queue[sid]
+                if self._running.get(jobs[0].host, 0) >= self.per_host:
+                    continue
+                job = jobs.popleft()
+                # Move client to the end of line for round-robin
+                queue.pop(sid)
+                if jobs:
+                    queue[sid] = jobs
+                self._queued -= 1
+                return job
+        return None
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                job = self._next()
+                while job is None:
+                    if self._stopped:
+                        return
+                    self._cond.wait()
+                    job = self._next()
+                self._running[job.host] += 1
+            self._run(job)
+            with self._cond:
+                self._jobs.pop(job.id, None)
+                self._running[job.host] -= 1
+                if not self._running[job.host]:
+                    self._running.pop(job.host)
+                # Slot for this host is free, waiting jobs may be eligible now
+                self._cond.notify_all()
+
+    def _run(self, job: Job):
+        if not job.future.set_running_or_notify_cancel():
+            return
+        job.started = time.monotonic()
+        metrics.observe("job_wait", job.wait_time)
+        if job.cancelled:
+            job.future.set_exception(JobCancelled(f"job {job.id} cancelled"))
+            return
+        job.progress("started")
+        token = current_job.set(job)
+        try:
+            result = job.func(*job.args)
+            # Job may swallow channel errors caused by cancel, so check it here too
+            job.check()
+            job.future.set_result(result)
+        except Exception as e:
+            job.future.set_exception(e)
+        finally:
+            current_job.reset(token)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "queue_depth": self._queued,
+                "running": sum(self._running.values()),
+                "workers": self.workers,
+            }
@@ -0,0 +1,122 @@
+# Copyright © 2022 Nikolay Shishov. All rights reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import logging
+import socket
+import threading
+import time
+import uuid
+from typing import Optional
+
+# Prefix of the line which ends output of every command
+MARKER_PREFIX = "__ASST_END_"
+# Default seconds for one command, e.g. unclosed quote never prints marker
+SHELL_TIMEOUT = 300
+
+
+class ShellClosed(ConnectionError):
+    pass
+
+
+class ShellSession:
+    def __init__(self, ssh: object, shell: str = "/bin/sh"):
+        """Long-lived shell on one channel which runs commands one by one.
+
+        Channel and remote shell are started once, so every command costs only
+        its own run time. Output of command ends with marker line which has its
+        exit code. Shell state like current directory is kept between commands.
+        Command which exits the shell, e.g. 'exit 3', returns shell's exit
+        code and next command starts new shell.
+
+        Arguments:
+            ssh {object} -- SSHClient to open channel on
+            shell {str} -- remote shell which reads commands from stdin
+        """
+        self.log = logging.getLogger(__name__)
+        self.channel = ssh.get_transport().open_session()
+        self.channel.set_combine_stderr(True)
+        self.channel.exec_command(shell)
+        self.stdin = self.channel.makefile_stdin("wb")
+        self.stdout = self.channel.makefile("rb")
+        self.commands = 0
+        self.lock = threading.Lock()
+
+    @property
+    def alive(self) -> bool:
+        return not self.channel.closed and not self.channel.exit_status_ready()
+
+    def run(
+        self,
+        cmd: str,
+        output_filter: Optional[object] = None,
+        timeout: float = SHELL_TIMEOUT,
+    ) -> tuple:
+        """Run command in the shell
+
+        Arguments:
+            cmd {str} -- command to execute
+            output_filter {OutputFilter} -- filter which gets output lines
+            timeout {float} -- seconds to wait for end of command
+
+        Returns:
+            int -- response code
+            list -- output lines, or filter's result
+
+        Raises:
+            TimeoutError: if command didn't end in time, shell is closed
+            ShellClosed: if shell has gone without exit code
+        """
+        marker = MARKER_PREFIX + uuid.uuid4().hex
+        # stdin of command is closed, so it can't read next commands of the shell
+        script = f"{{ {cmd}\n}} < /dev/null 2>&1\nprintf '\\n%s %d\\n' {marker} $?\n"
+        with self.lock:
+            self.stdin.write(script.encode())
+            self.stdin.flush()
+            output = []
+            # Line before marker is added by printf, it's dropped if it's empty
+            pending = None
+            deadline = time.monotonic() + timeout
+            while True:
+                self.channel.settimeout(max(deadline - time.monotonic(), 0.001))
+                try:
+                    raw = self.stdout.readline()
+                except socket.timeout:
+                    # Shell may wait for rest of command, it can't be reused
+                    self.close()
+                    raise TimeoutError(f"command didn't end in {timeout}s")
+                if not raw:
+                    # Command exited the shell, its code comes after the output
+                    wait = max(deadline - time.monotonic(), 0.001)
+                    if not self.channel.status_event.wait(wait):
+                        self.close()
+                        raise ShellClosed("remote shell closed its output")
+                    response_code = self.channel.recv_exit_status()
+                    if response_code == -1:
+                        raise ShellClosed("remote shell closed")
+                    break
+                line = raw.decode("utf-8", "replace").strip()
+                if line.startswith(marker):
+                    response_code = int(line[len(marker) :])
+                    break
+                if pending is not None:
+                    self._add(output, pending, output_filter)
+                pending = line
+            if pending:
+                self._add(output, pending, output_filter)
+            self.commands += 1
+        if output_filter is not None:
+            return response_code, output_filter.result()
+        return response_code, output
+
+    @staticmethod
+    def _add(output: list, line: str, output_filter: Optional[object]):
+        if output_filter is not None:
+            output_filter.feed(line)
+        else:
+            output.append(line)
+
+    def close(self):
+        self.channel.close()
@@ -0,0 +1,175 @@
+# Copyright © 2022 Nikolay Shishov. All rights reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import json
+import queue
+import socket
+import threading
+import time
+from typing import Optional
+
+from leases import HostLeaseRegistry
+
+
+class SessionStore:
+    """Clients' session params, owners of hosts and host leases.
+
+    MemoryStore keeps everything inside one server process, BrokerStore
+    shares it between server workers through broker process.
+    """
+
+    def get(self, sid: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    def set(self, sid: str, params: dict):
+        raise NotImplementedError
+
+    def delete(self, sid: str):
+        raise NotImplementedError
+
+    def claim(self, host: str, worker: str, ttl: float) -> str:
+        """Make worker owner of host if host has no alive owner
+
+        Returns:
+            str -- current owner of host
+        """
+        raise NotImplementedError
+
+    def leases(self):
+        """Lease registry shared by everybody who uses the store"""
+        raise NotImplementedError
+
+
+class MemoryStore(SessionStore):
+    def __init__(self):
+        self._sessions: dict = {}
+        self._owners: dict = {}
+        self._leases = HostLeaseRegistry()
+        self._lock = threading.Lock()
+
+    def get(self, sid: str) -> Optional[dict]:
+        params = self._sessions.get(sid)
+        return dict(params) if params is not None else None
+
+    def set(self, sid: str, params: dict):
+        self._sessions[sid] = dict(params)
+
+    def delete(self, sid: str):
+        self._sessions.pop(sid, None)
+
+    def claim(self, host: str, worker: str, ttl: float) -> str:
+        now = time.monotonic()
+        with self._lock:
+            owner, expires = self._owners.get(host, (None, 0.0))
+            if owner is None or owner == worker or expires <= now:
+                owner = worker
+                self._owners[host] = (worker, now + ttl)
+            return owner
+
+    def leases(self) -> HostLeaseRegistry:
+        return self._leases
+
+
+class BrokerError(Exception):
+    pass
+
+
+class BrokerClient:
+    def __init__(self, path: str, max_idle: int = 8):
+        """Calls to broker over Unix socket, one JSON line per request and answer.
+
+        Connections are reused, call which blocks in broker (like waiting for
+        lease) holds own connection, so other calls are not stuck behind it.
+
+        Arguments:
+            path {str} -- broker's Unix socket path
+            max_idle {int} -- max amount of kept idle connections
+        """
+        self.path = path
+        self._idle = queue.LifoQueue(max_idle)
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.path)
+        return sock, sock.makefile("rwb")
+
+    @staticmethod
+    def send(stream, op: str, *args):
+        stream.write(json.dumps({"op": op, "args": args}).encode() + b"\n")
+        stream.flush()
+
+    def call(self, op: str, *args):
+        try:
+            sock, stream = self._idle.get_nowait()
+        except queue.Empty:
+            sock, stream = self.connect()
+        try:
+            self.send(stream, op, *args)
+            line = stream.readline()
+            if not line:
+                raise BrokerError("broker closed connection")
+            answer = json.loads(line)
+        except Exception:
+            sock.close()
+            raise
+        try:
+            self._idle.put_nowait((sock, stream))
+        except queue.Full:
+            sock.close()
+        if "error" in answer:
+            raise BrokerError(answer["error"])
+        return answer["result"]
+
+
+class RemoteLeases:
+    def __init__(self, client: BrokerClient):
+        """HostLeaseRegistry kept by broker, same interface as local one"""
+        self.client = client
+
+    def acquire(self, sid: str, host: str, mode: str = "exclusive", timeout: float = 0):
+        return self.client.call("leases.acquire", sid, host, mode, timeout)
+
+    def release(self, sid: str, host: str):
+        self.client.call("leases.release", sid, host)
+
+    def release_all(self, sid: str):
+        self.client.call("leases.release_all", sid)
+
+    def holders(self, host: str) -> set:
+        return set(self.client.call("leases.holders", host))
+
+    def stats(self) -> dict:
+        return self.client.call("leases.stats")
+
+
+class BrokerStore(SessionStore):
+    def __init__(self, path: str):
+        self.client = BrokerClient(path)
+        self._leases = RemoteLeases(self.client)
+
+    def get(self, sid: str) -> Optional[dict]:
+        return self.client.call("store.get", sid)
+
+    def set(self, sid: str, params: dict):
+        self.client.call("store.set", sid, params)
+
+    def delete(self, sid: str):
+        self.client.call("store.delete", sid)
+
+    def claim(self, host: str, worker: str, ttl: float) -> str:
+        return self.client.call("store.claim", host, worker, ttl)
+
+    def leases(self) -> RemoteLeases:
+        return self._leases
+
+
+def store_init(url: str) -> SessionStore:
+    """Store by url from config: 'memory' or 'unix:<broker socket path>'"""
+    if url == "memory":
+        return MemoryStore()
+    if url.startswith("unix:"):
+        return BrokerStore(url[len("unix:") :])
+    raise ValueError(f"unknown session store: {url}")
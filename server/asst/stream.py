@@ -0,0 +1,112 @@
+# Copyright © 2022 Nikolay Shishov. All rights reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import codecs
+import logging
+import threading
+from typing import Optional
+
+# Size of one chunk read from remote channel
+CHUNK_SIZE = 32 * 1024
+# Max amount of chunks sent to client and not acknowledged yet
+WINDOW = 8
+# Seconds to wait for client's ack before window is ignored
+ACK_TIMEOUT = 30
+
+
+class OutputStream:
+    def __init__(
+        self,
+        job: object,
+        max_bytes: Optional[int] = None,
+        max_lines: Optional[int] = None,
+        window: int = WINDOW,
+    ):
+        """Forwards remote command output to client as 'job_output' events.
+
+        Only 'window' chunks can wait for client's ack, reader blocks above it,
+        so SSH channel window fills up and remote command is paused too.
+
+        Arguments:
+            job {Job} -- job which output belongs to
+            max_bytes {int} -- stop after this amount of bytes, None for no limit
+            max_lines {int} -- stop after this amount of lines, None for no limit
+            window {int} -- max amount of not acknowledged chunks
+        """
+        self.log = logging.getLogger(__name__)
+        self.job = job
+        self.max_bytes = max_bytes
+        self.max_lines = max_lines
+        self.bytes = 0
+        self.lines = 0
+        self.truncated = False
+        self._window = threading.BoundedSemaphore(window)
+        self._acks = True
+        self._decoders = {}
+
+    def _release(self, *_):
+        try:
+            self._window.release()
+        except ValueError:
+            pass
+
+    def _send(self, name: str, text: str):
+        if self._acks and not self._window.acquire(timeout=ACK_TIMEOUT):
+            # Client doesn't ack output events, don't wait for it anymore
+            self.log.warning(f"no acks for job {self.job.id} output, window disabled")
+            self._acks = False
+        self.job.emit(
+            "job_output",
+            {"stream": name, "data": text},
+            callback=self._release if self._acks else None,
+        )
+
+    def write(self, name: str, data: bytes) -> bool:
+        """Send chunk of output
+
+        Arguments:
+            name {str} -- 'stdout' or 'stderr'
+            data {bytes} -- raw chunk from channel
+
+        Returns:
+            bool -- False if limit reached and command should be stopped
+        """
+        if self.truncated:
+            return False
+        if self.max_bytes is not None and self.bytes + len(data) > self.max_bytes:
+            data = data[: self.max_bytes - self.bytes]
+            self.truncated = True
+        if self.max_lines is not None:
+            pos = -1
+            for _ in range(self.max_lines - self.lines):
+                pos = data.find(b"\n", pos + 1)
+                if pos < 0:
+                    break
+            else:
+                # All allowed lines are inside chunk, cut the rest
+                if pos + 1 < len(data):
+                    data = data[: pos + 1]
+                    self.truncated = True
+        self.bytes += len(data)
+        self.lines += data.count(b"\n")
+        if name not in self._decoders:
+            self._decoders[name] = codecs.getincrementaldecoder("utf-8")("replace")
+        text = self._decoders[name].decode(data, final=self.truncated)
+        if text:
+            self._send(name, text)
+        if self.truncated:
+            self._send(
+                name,
+                f"\n[output truncated after {self.bytes} bytes, {self.lines} lines]\n",
+            )
+        return not self.truncated
+
+    def close(self):
+        """Flush partly decoded characters"""
+        for name, decoder in self._decoders.items():
+            text = decoder.decode(b"", final=True)
+            if text:
+                self._send(name, text)
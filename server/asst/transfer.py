@@ -0,0 +1,486 @@
+# Copyright © 2022 Nikolay Shishov. All rights reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import contextvars
+import logging
+import os
+import posixpath
+import stat
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from functools import partial
+from pathlib import Path
+from typing import Callable, Optional
+
+from metrics import metrics
+
+# Size of one SFTP read request, most servers don't return more at once
+READ_SIZE = 32 * 1024
+# Size of local reads for upload, paramiko splits it into SFTP packets
+WRITE_SIZE = 1024 * 1024
+# Files bigger than this are split between workers
+PARALLEL_THRESHOLD = 64 * 1024 * 1024
+# Seconds between progress reports
+PROGRESS_INTERVAL = 1.0
+# Files are written under temporary names and renamed when they are complete.
+# Sequentially written file can be resumed from its size, parallel one can't.
+PART_SUFFIX = ".asst-part"
+PARALLEL_SUFFIX = ".asst-parallel-part"
+
+
+def transfer_dir_init(path: str, *protected: Path) -> Path:
+    """Local root of file transfers, created if it doesn't exist
+
+    Arguments:
+        path {str} -- directory from config, '~' is expanded
+        protected {Path} -- server's code and config directories
+
+    Raises:
+        ValueError: if directory overlaps one of protected ones, clients could
+            overwrite jobs or read config through transfers
+    """
+    root = Path(path).expanduser().resolve()
+    for each in protected:
+        each = each.resolve()
+        if root.is_relative_to(each) or each.is_relative_to(root):
+            raise ValueError(f"transfer directory {root} overlaps {each}")
+    root.mkdir(parents=True, exist_ok=True)
+    return root
+
+
+def replace(sftp, part: str, remote: str):
+    """Rename complete temporary remote file over the target"""
+    try:
+        sftp.posix_rename(part, remote)
+    except IOError:
+        # Server without posix-rename extension can't overwrite on rename
+        try:
+            sftp.remove(remote)
+        except IOError:
+            pass
+        sftp.rename(part, remote)
+
+
+@dataclass
+class TransferStats:
+    files: int = 0
+    skipped: int = 0
+    bytes: int = 0
+    total: int = 0
+    started: float = field(default_factory=time.monotonic)
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    @property
+    def throughput(self) -> float:
+        """Bytes per second"""
+        return self.bytes / self.elapsed if self.elapsed > 0 else 0.0
+
+    def report(self) -> dict:
+        return {
+            "files": self.files,
+            "skipped": self.skipped,
+            "bytes": self.bytes,
+            "total": self.total,
+            "elapsed": round(self.elapsed, 3),
+            "throughput": round(self.throughput),
+        }
+
+
+class TransferEngine:
+    def __init__(
+        self,
+        open_sftp: Callable,
+        workers: int = 4,
+        progress: Optional[Callable] = None,
+        track: Optional[Callable] = None,
+    ):
+        """SFTP transfers over one SSH transport.
+
+        Every worker has own SFTP channel on the same transport and uses
+        pipelined writes and read-ahead, so many files (or parts of one big
+        file) are transferred at once without waiting for every packet's ack.
+        Partially transferred files are resumed from their current size.
+
+        Arguments:
+            open_sftp {callable} -- returns new SFTPClient on the transport,
+                called with blocking flag, None if connection has no free channel
+            workers {int} -- max amount of parallel SFTP channels, less of them
+                are used when connection has no free channels
+            progress {callable} -- called with dict of transfer stats
+            track {callable} -- context manager for opened channels, used to
+                cancel transfer with the job
+        """
+        self.log = logging.getLogger(__name__)
+        self.open_sftp = open_sftp
+        self.workers = max(workers, 1)
+        self.progress = progress
+        self.track = track
+        self.stats = TransferStats()
+        self._reported = 0.0
+        self._sessions: list = []
+        self._pool = None
+        self._lock = threading.Lock()
+
+    # --- SFTP sessions ---
+    def _sftp(self):
+        """First SFTP session, the only one which waits for a free channel"""
+        with self._lock:
+            if not self._sessions:
+                self._sessions.append(self.open_sftp(True))
+            return self._sessions[0]
+
+    def _open_sessions(self, wanted: int) -> list:
+        """Sessions for up to wanted workers
+
+        Extra sessions are opened only while connection has free channels.
+        """
+        self._sftp()
+        with self._lock:
+            while len(self._sessions) < wanted:
+                sftp = self.open_sftp(False)
+                if sftp is None:
+                    break
+                self._sessions.append(sftp)
+            return self._sessions[:wanted]
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+        with self._lock:
+            sessions, self._sessions = self._sessions, []
+        for sftp in sessions:
+            sftp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def _run(self, tasks: list) -> list:
+        """Run tasks on workers, every worker uses only own SFTP session
+
+        SFTPClient can't serve requests of several threads at once, so there
+        are as many workers as opened sessions and the rest of tasks waits in
+        queue for the first free worker.
+
+        Arguments:
+            tasks {list} -- callables which get SFTPClient
+
+        Returns:
+            list -- tasks' results in the same order
+        """
+        if not tasks:
+            return []
+        sessions = self._open_sessions(min(len(tasks), self.workers))
+        if len(sessions) <= 1:
+            return [self._call(sessions[0], task) for task in tasks]
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix="asst-sftp"
+            )
+        queue = deque(enumerate(tasks))
+        results = [None] * len(tasks)
+        errors = {}
+
+        def worker(sftp):
+            while True:
+                try:
+                    index, task = queue.popleft()
+                except IndexError:
+                    return
+                try:
+                    results[index] = self._call(sftp, task)
+                except Exception as e:
+                    errors[index] = e
+
+        # Workers run in caller's context, so they see its current job
+        futures = [
+            self._pool.submit(contextvars.copy_context().run, worker, sftp)
+            for sftp in sessions
+        ]
+        for future in futures:
+            future.result()
+        if errors:
+            raise errors[min(errors)]
+        return results
+
+    def _call(self, sftp, task: Callable):
+        if self.track is None:
+            return task(sftp)
+        with self.track(sftp.get_channel()):
+            return task(sftp)
+
+    # --- Progress ---
+    def _add(self, size: int):
+        with self._lock:
+            self.stats.bytes += size
+            now = time.monotonic()
+            if self.progress is None or now - self._reported < PROGRESS_INTERVAL:
+                return
+            self._reported = now
+            report = self.stats.report()
+        self.progress(report)
+
+    def _record(self, direction: str) -> dict:
+        """Add finished transfer to server's metrics"""
+        report = self.stats.report()
+        metrics.inc("sftp_bytes", report["bytes"], direction=direction)
+        metrics.inc("sftp_files", report["files"], direction=direction)
+        metrics.observe("sftp_transfer", report["elapsed"], direction=direction)
+        return report
+
+    def _done(self, skipped: bool = False):
+        with self._lock:
+            self.stats.files += 1
+            self.stats.skipped += int(skipped)
+
+    def _split(self, offset: int, size: int) -> list:
+        """Split file into ranges for workers"""
+        part = -(-(size - offset) // self.workers)
+        return [(start, min(start + part, size)) for start in range(offset, size, part)]
+
+    # --- Upload ---
+    @staticmethod
+    def _remote_size(sftp, path: str) -> Optional[int]:
+        try:
+            return sftp.stat(path).st_size
+        except IOError:
+            return None
+
+    @staticmethod
+    def _same(size: int, mtime: float, other_size: int, other_mtime: float) -> bool:
+        """Transferred file gets mtime of its source, so file with the same size
+        and mtime is considered transferred. Size alone misses edited files."""
+        return size == other_size and int(mtime) == int(other_mtime)
+
+    def _upload_plan(self, sftp, local: Path, remote: str, resume: bool):
+        """Prepare temporary remote file and split upload into ranges
+
+        Returns:
+            tuple -- (local, temporary remote path, remote, ranges, mtime) or None
+                if file is already uploaded
+        """
+        info = local.stat()
+        size, mtime = info.st_size, info.st_mtime
+        if resume:
+            try:
+                rinfo = sftp.stat(remote)
+            except IOError:
+                rinfo = None
+            if rinfo and self._same(size, mtime, rinfo.st_size, rinfo.st_mtime):
+                self._done(skipped=True)
+                return None
+        part = remote + PART_SUFFIX
+        offset = (self._remote_size(sftp, part) or 0) if resume else 0
+        if offset > size:
+            offset = 0
+        if offset:
+            self.log.info(f"resuming upload of {remote} from {offset} bytes")
+            ranges = [(offset, size)]
+        elif size < PARALLEL_THRESHOLD or self.workers == 1:
+            sftp.open(part, "wb").close()
+            ranges = [(0, size)]
+        else:
+            # Ranges are written in parallel, such file can't be resumed by size
+            part = remote + PARALLEL_SUFFIX
+            with sftp.open(part, "wb") as rfile:
+                rfile.truncate(size)
+            ranges = self._split(0, size)
+        with self._lock:
+            self.stats.total += size - offset
+        return local, part, remote, ranges, mtime
+
+    def _upload_range(self, sftp, local: Path, remote: str, start: int, end: int):
+        with open(local, "rb") as lfile, sftp.open(remote, "r+b") as rfile:
+            # Writes are not waiting for server's ack one by one
+            rfile.set_pipelined(True)
+            lfile.seek(start)
+            rfile.seek(start)
+            pos = start
+            while pos < end:
+                data = lfile.read(min(WRITE_SIZE, end - pos))
+                if not data:
+                    break
+                rfile.write(data)
+                pos += len(data)
+                self._add(len(data))
+
+    def _upload_finish(self, sftp, part: str, remote: str, mtime: float):
+        sftp.utime(part, (int(mtime), int(mtime)))
+        replace(sftp, part, remote)
+        self._done()
+
+    def put(self, pairs: list, resume: bool = True) -> dict:
+        """Upload files
+
+        Arguments:
+            pairs {list} -- (local path, remote path) pairs
+            resume {bool} -- skip uploaded files (same size and mtime) and continue
+                partly uploaded ones
+
+        Returns:
+            dict -- transfer stats
+        """
+        plans = self._run(
+            [
+                partial(
+                    self._upload_plan, local=Path(local), remote=remote, resume=resume
+                )
+                for local, remote in pairs
+            ]
+        )
+        plans = [plan for plan in plans if plan]
+        self._run(
+            [
+                partial(
+                    self._upload_range, local=local, remote=part, start=start, end=end
+                )
+                for local, part, _, ranges, _ in plans
+                for start, end in ranges
+            ]
+        )
+        self._run(
+            [
+                partial(self._upload_finish, part=part, remote=remote, mtime=mtime)
+                for _, part, remote, _, mtime in plans
+            ]
+        )
+        return self._record("upload")
+
+    def put_tree(self, local_dir: Path, remote_dir: str, resume: bool = True) -> dict:
+        """Upload directory with all its content"""
+        local_dir = Path(local_dir)
+        pairs = []
+        dirs = [remote_dir]
+        for root, subdirs, files in os.walk(local_dir):
+            rel = Path(root).relative_to(local_dir).as_posix()
+            rdir = posixpath.normpath(posixpath.join(remote_dir, rel))
+            dirs.extend(posixpath.join(rdir, name) for name in subdirs)
+            pairs.extend(
+                (Path(root, name), posixpath.join(rdir, name)) for name in files
+            )
+        sftp = self._sftp()
+        for rdir in dirs:
+            if self._remote_size(sftp, rdir) is None:
+                sftp.mkdir(rdir)
+        return self.put(pairs, resume)
+
+    # --- Download ---
+    def _download_plan(self, sftp, remote: str, local: Path, resume: bool):
+        """Prepare temporary local file and split download into ranges
+
+        Returns:
+            tuple -- (remote, temporary local path, local, ranges, mtime) or None
+                if file is already downloaded
+        """
+        rinfo = sftp.stat(remote)
+        size, mtime = rinfo.st_size, rinfo.st_mtime
+        if resume and local.exists():
+            info = local.stat()
+            if self._same(size, mtime, info.st_size, info.st_mtime):
+                self._done(skipped=True)
+                return None
+        local.parent.mkdir(parents=True, exist_ok=True)
+        part = local.with_name(local.name + PART_SUFFIX)
+        offset = part.stat().st_size if resume and part.exists() else 0
+        if offset > size:
+            offset = 0
+        if offset:
+            self.log.info(f"resuming download of {remote} from {offset} bytes")
+            ranges = [(offset, size)]
+        elif size < PARALLEL_THRESHOLD or self.workers == 1:
+            part.write_bytes(b"")
+            ranges = [(0, size)]
+        else:
+            part = local.with_name(local.name + PARALLEL_SUFFIX)
+            with open(part, "wb") as lfile:
+                lfile.truncate(size)
+            ranges = self._split(0, size)
+        with self._lock:
+            self.stats.total += size - offset
+        return remote, part, local, ranges, mtime
+
+    def _download_range(self, sftp, remote: str, local: Path, start: int, end: int):
+        with sftp.open(remote, "rb") as rfile, open(local, "r+b") as lfile:
+            lfile.seek(start)
+            chunks = [
+                (pos, min(READ_SIZE, end - pos))
+                for pos in range(start, end, READ_SIZE)
+            ]
+            # readv sends all read requests at once and yields data in order
+            for data in rfile.readv(chunks):
+                lfile.write(data)
+                self._add(len(data))
+
+    def _download_finish(self, sftp, part: Path, local: Path, mtime: float):
+        os.utime(part, (int(mtime), int(mtime)))
+        part.replace(local)
+        self._done()
+
+    def get(self, pairs: list, resume: bool = True) -> dict:
+        """Download files
+
+        Arguments:
+            pairs {list} -- (remote path, local path) pairs
+            resume {bool} -- skip downloaded files (same size and mtime) and continue
+                partly downloaded ones
+
+        Returns:
+            dict -- transfer stats
+        """
+        plans = self._run(
+            [
+                partial(
+                    self._download_plan, remote=remote, local=Path(local), resume=resume
+                )
+                for remote, local in pairs
+            ]
+        )
+        plans = [plan for plan in plans if plan]
+        self._run(
+            [
+                partial(
+                    self._download_range,
+                    remote=remote,
+                    local=part,
+                    start=start,
+                    end=end,
+                )
+                for remote, part, _, ranges, _ in plans
+                for start, end in ranges
+            ]
+        )
+        self._run(
+            [
+                partial(self._download_finish, part=part, local=local, mtime=mtime)
+                for _, part, local, _, mtime in plans
+            ]
+        )
+        return self._record("download")
+
+    def get_tree(self, remote_dir: str, local_dir: Path, resume: bool = True) -> dict:
+        """Download remote directory with all its content"""
+        sftp = self._sftp()
+        pairs = []
+        dirs = [(remote_dir, Path(local_dir))]
+        while dirs:
+            rdir, ldir = dirs.pop()
+            ldir.mkdir(parents=True, exist_ok=True)
+            for attr in sftp.listdir_attr(rdir):
+                rpath = posixpath.join(rdir, attr.filename)
+                if stat.S_ISDIR(attr.st_mode):
+                    dirs.append((rpath, ldir / attr.filename))
+                else:
+                    pairs.append((rpath, ldir / attr.filename))
+        return self.get(pairs, resume)
@@ -0,0 +1,69 @@
+# Copyright © 2022 Nikolay Shishov. All rights reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Compares two results of run.py, exits with 1 if new one is slower than
+# baseline by more than threshold.
+#
+#   python3 server/benchmarks/compare.py base.json new.json --threshold 10
+
+import argparse
+import json
+import sys
+from pathlib import Path
+
+# Metrics compared between runs and whether bigger value is better
+METRICS = {"throughput": True, "p50": False, "p99": False, "errors": False}
+
+
+def change(old: float, new: float) -> float:
+    """Change in percents, positive when value grows"""
+    if not old:
+        return 0.0 if not new else 100.0
+    return (new - old) / old * 100
+
+
+def compare(base: dict, new: dict, threshold: float) -> list:
+    """Returns:
+    list -- (scenario, metric, old, new, change, regression) rows
+    """
+    rows = []
+    for scenario, old in base["scenarios"].items():
+        current = new["scenarios"].get(scenario)
+        if current is None:
+            continue
+        for metric, bigger_better in METRICS.items():
+            diff = change(old[metric], current[metric])
+            worse = -diff if bigger_better else diff
+            if metric == "errors":
+                regression = current[metric] > old[metric]
+            else:
+                regression = worse > threshold
+            rows.append(
+                (scenario, metric, old[metric], current[metric], diff, regression)
+            )
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare ASST benchmark results")
+    parser.add_argument("base")
+    parser.add_argument("new")
+    parser.add_argument("--threshold", type=float, default=10.0, help="percents")
+    args = parser.parse_args()
+    base = json.loads(Path(args.base).read_text())
+    new = json.loads(Path(args.new).read_text())
+    print(f"{base['meta']['version']} -> {new['meta']['version']}")
+    rows = compare(base, new, args.threshold)
+    for scenario, metric, old, current, diff, regression in rows:
+        mark = "REGRESSION" if regression else ""
+        print(
+            f"{scenario:<10} {metric:<10} {old:>12} {current:>12} {diff:>+8.1f}% {mark}"
+        )
+    sys.exit(1 if any(row[-1] for row in rows) else 0)
+
+
+if __name__ == "__main__":
+    main()
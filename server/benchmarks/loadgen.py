@@ -0,0 +1,181 @@
+# Copyright © 2022 Nikolay Shishov. All rights reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Load generator: N SocketIO clients call server's jobs at the same time
+# and every call's latency is recorded.
+
+import json
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+
+import socketio
+
+# Size of one relay chunk in transfer scenario
+CHUNK_SIZE = 256 * 1024
+
+
+def percentile(values: list, pct: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, round(pct / 100 * (len(values) - 1)))]
+
+
+@dataclass
+class ScenarioResult:
+    name: str
+    clients: int
+    latencies: list = field(default_factory=list)
+    errors: int = 0
+    duration: float = 0.0
+    extra: dict = field(default_factory=dict)
+
+    def report(self) -> dict:
+        ops = len(self.latencies)
+        return {
+            "clients": self.clients,
+            "ops": ops,
+            "errors": self.errors,
+            "duration": round(self.duration, 3),
+            "throughput": round(ops / self.duration, 2) if self.duration else 0.0,
+            "mean": round(sum(self.latencies) / ops, 6) if ops else 0.0,
+            "p50": round(percentile(self.latencies, 50), 6),
+            "p90": round(percentile(self.latencies, 90), 6),
+            "p99": round(percentile(self.latencies, 99), 6),
+            "max": round(max(self.latencies, default=0.0), 6),
+            **self.extra,
+        }
+
+
+class BenchClient:
+    def __init__(self, url: str, ssh_params: dict, timeout: float = 120):
+        """One SocketIO connection with ssh params of the stub"""
+        self.timeout = timeout
+        self.sio = socketio.Client()
+        self.sio.connect(url)
+        answer = self.message(
+            {"type": "system", "job": "ssh_connection_init", "params": ssh_params}
+        )
+        if not answer.get("result"):
+            raise ConnectionError(f"ssh_connection_init failed: {answer}")
+
+    def message(self, data: dict):
+        return json.loads(self.sio.call("message", data, timeout=self.timeout))
+
+    def call(self, event: str, data: dict) -> dict:
+        return self.sio.call(event, data, timeout=self.timeout)
+
+    def close(self):
+        self.sio.disconnect()
+
+
+def ok(answer) -> bool:
+    if isinstance(answer, dict):
+        return answer.get("result") is not False
+    return isinstance(answer, list) and bool(answer) and answer[0] == 0
+
+
+def exec_call(client: BenchClient, _) -> bool:
+    return ok(
+        client.message(
+            {"type": "module", "job": "ssh", "func": "show_uptime", "params": []}
+        )
+    )
+
+
+def batch_call(size: int):
+    def call(client: BenchClient, _) -> bool:
+        items = [{"func": "show_uptime", "params": []}] * size
+        return ok(client.message({"type": "batch", "job": "ssh", "items": items}))
+
+    return call
+
+
+def fanout_call(targets: list):
+    def call(client: BenchClient, _) -> bool:
+        return ok(
+            client.message(
+                {
+                    "type": "module",
+                    "job": "ssh",
+                    "func": "show_uptime",
+                    "params": [],
+                    "targets": targets,
+                }
+            )
+        )
+
+    return call
+
+
+def transfer_call(size: int):
+    payload = os.urandom(min(size, CHUNK_SIZE))
+
+    def call(client: BenchClient, n: int) -> bool:
+        start = client.call("upload_start", {"path": f"/bench-{id(client)}-{n}.bin"})
+        if not start.get("result"):
+            return False
+        transfer_id = start["transfer_id"]
+        for offset in range(0, size, CHUNK_SIZE):
+            data = payload[: min(CHUNK_SIZE, size - offset)]
+            chunk = {"transfer_id": transfer_id, "offset": offset, "data": data}
+            if not client.call("upload_chunk", chunk).get("result"):
+                return False
+        end = {"transfer_id": transfer_id, "size": size}
+        return bool(client.call("upload_end", end)["result"])
+
+    return call
+
+
+def run_scenario(
+    name: str,
+    call,
+    url: str,
+    ssh_params: dict,
+    clients: int,
+    requests: int,
+    warmup: int = 1,
+) -> ScenarioResult:
+    """Run 'requests' calls from each of 'clients' connections at once
+
+    Warmup calls are not measured, they open pooled ssh connections.
+    """
+    result = ScenarioResult(name, clients)
+    lock = threading.Lock()
+    conns = [BenchClient(url, ssh_params) for _ in range(clients)]
+    for conn in conns:
+        for n in range(warmup):
+            call(conn, -1 - n)
+    barrier = threading.Barrier(clients + 1)
+
+    def worker(conn: BenchClient):
+        latencies, errors = [], 0
+        barrier.wait()
+        for n in range(requests):
+            started = time.perf_counter()
+            try:
+                success = call(conn, n)
+            except Exception:
+                success = False
+            latencies.append(time.perf_counter() - started)
+            errors += int(not success)
+        with lock:
+            result.latencies.extend(latencies)
+            result.errors += errors
+
+    threads = [threading.Thread(target=worker, args=(conn,)) for conn in conns]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    started = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    result.duration = time.perf_counter() - started
+    for conn in conns:
+        conn.close()
+    return result
@@ -0,0 +1,154 @@
+# Copyright © 2022 Nikolay Shishov. All rights reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Benchmark of the whole path: client -> message() -> ConnectionHandler ->
+# paramiko -> SSH stub. Starts stubs and ASST server, runs scenarios and saves
+# results as JSON which can be compared with compare.py.
+#
+#   python3 server/benchmarks/run.py --clients 16 --requests 50 --out base.json
+
+import argparse
+import json
+import logging
+import os
+import platform
+import socket
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+import loadgen
+from ssh_stub import SSHStub
+
+SCENARIOS = ("exec", "batch", "fanout", "transfer")
+SERVER_DIR = Path(__file__).parent.parent.absolute() / "asst"
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(port: int) -> subprocess.Popen:
+    proc = subprocess.Popen(
+        [sys.executable, "main.py"],
+        cwd=SERVER_DIR,
+        env={**os.environ, "ASST_PORT": str(port)},
+        stdout=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return proc
+        except OSError:
+            time.sleep(0.2)
+    proc.terminate()
+    raise RuntimeError("ASST server didn't start")
+
+
+def version() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "describe", "--always", "--dirty"], cwd=SERVER_DIR, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def ssh_params(stub: SSHStub) -> dict:
+    return {
+        "ssh_ip": stub.host,
+        "ssh_user": "bench",
+        "ssh_pass": "bench",
+        "ssh_port": stub.port,
+        "lease": "shared",
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ASST load benchmark")
+    parser.add_argument("--server", help="url of running server, started if not set")
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=20, help="calls per client")
+    parser.add_argument("--latency", type=float, default=0.01, help="command seconds")
+    parser.add_argument("--output-lines", type=int, default=10)
+    parser.add_argument("--line-size", type=int, default=80)
+    parser.add_argument("--batch-size", type=int, default=5)
+    parser.add_argument("--fanout-hosts", type=int, default=4)
+    parser.add_argument("--transfer-size", type=int, default=1024 * 1024)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--out", default="bench-results.json")
+    args = parser.parse_args()
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+    log = logging.getLogger("bench")
+
+    stub_options = {
+        "latency": args.latency,
+        "output_lines": args.output_lines,
+        "line_size": args.line_size,
+    }
+    stub = SSHStub(**stub_options).start()
+    # Fan-out hosts differ by address, Linux routes whole 127.0.0.0/8 to loopback
+    fanout_stubs = [
+        SSHStub(host=f"127.0.0.{i + 2}", **stub_options).start()
+        for i in range(args.fanout_hosts)
+    ]
+    # Broken stub makes every call fail or hang, stop before measuring it
+    for each in [stub, *fanout_stubs]:
+        each.check()
+    server = None
+    url = args.server
+    if url is None:
+        port = free_port()
+        server = start_server(port)
+        url = f"http://127.0.0.1:{port}"
+
+    calls = {
+        "exec": loadgen.exec_call,
+        "batch": loadgen.batch_call(args.batch_size),
+        "fanout": loadgen.fanout_call([ssh_params(s) for s in fanout_stubs]),
+        "transfer": loadgen.transfer_call(args.transfer_size),
+    }
+    results = {}
+    try:
+        for name in args.scenarios.split(","):
+            log.info(f"scenario {name}: {args.clients} clients x {args.requests}")
+            result = loadgen.run_scenario(
+                name, calls[name], url, ssh_params(stub), args.clients, args.requests
+            )
+            if name == "transfer" and result.duration:
+                result.extra["bytes_per_second"] = round(
+                    args.transfer_size * len(result.latencies) / result.duration
+                )
+            results[name] = result.report()
+            log.info(f"scenario {name}: {results[name]}")
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        for each in [stub, *fanout_stubs]:
+            each.stop()
+
+    report = {
+        "meta": {
+            "version": version(),
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "params": vars(args),
+        },
+        "scenarios": results,
+    }
+    Path(args.out).write_text(json.dumps(report, indent=2))
+    log.info(f"results saved to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,262 @@
+# Copyright © 2022 Nikolay Shishov. All rights reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Local SSH server for benchmarks. Every exec command answers after given
+# latency with given amount of output, SFTP works inside temporary directory.
+
+import logging
+import os
+import socket
+import tempfile
+import threading
+import time
+
+import paramiko
+from paramiko import SFTPAttributes, SFTPHandle, SFTPServer, SFTPServerInterface
+
+
+class StubSFTPHandle(SFTPHandle):
+    def stat(self):
+        try:
+            return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def chattr(self, attr):
+        try:
+            SFTPServer.set_file_attr(self.filename, attr)
+            return paramiko.SFTP_OK
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+
+class StubSFTPServer(SFTPServerInterface):
+    def __init__(self, server, *args, root: str = "/tmp", **kwargs):
+        super().__init__(server, *args, **kwargs)
+        self.root = root
+
+    def _path(self, path: str) -> str:
+        return os.path.join(self.root, self.canonicalize(path).lstrip("/"))
+
+    def list_folder(self, path):
+        path = self._path(path)
+        try:
+            return [
+                SFTPAttributes.from_stat(os.stat(os.path.join(path, name)), name)
+                for name in os.listdir(path)
+            ]
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.stat(self._path(path)))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    lstat = stat
+
+    def open(self, path, flags, attr):
+        path = self._path(path)
+        try:
+            fd = os.open(path, flags, getattr(attr, "st_mode", None) or 0o666)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        if flags & os.O_WRONLY:
+            mode = "ab" if flags & os.O_APPEND else "wb"
+        elif flags & os.O_RDWR:
+            mode = "a+b" if flags & os.O_APPEND else "r+b"
+        else:
+            mode = "rb"
+        handle = StubSFTPHandle(flags)
+        handle.filename = path
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    def _call(self, func, *paths):
+        try:
+            func(*(self._path(path) for path in paths))
+            return paramiko.SFTP_OK
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def remove(self, path):
+        return self._call(os.remove, path)
+
+    def rename(self, oldpath, newpath):
+        if os.path.exists(self._path(newpath)):
+            return paramiko.SFTP_FAILURE
+        return self._call(os.rename, oldpath, newpath)
+
+    def posix_rename(self, oldpath, newpath):
+        return self._call(os.replace, oldpath, newpath)
+
+    def chattr(self, path, attr):
+        try:
+            SFTPServer.set_file_attr(self._path(path), attr)
+            return paramiko.SFTP_OK
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def mkdir(self, path, attr):
+        return self._call(os.mkdir, path)
+
+    def rmdir(self, path):
+        return self._call(os.rmdir, path)
+
+
+class StubHandler(paramiko.ServerInterface):
+    def __init__(self, stub):
+        self.stub = stub
+
+    def get_allowed_auths(self, username):
+        return "password"
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_pty_request(self, *args):
+        return True
+
+    def check_channel_shell_request(self, channel):
+        return False
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(
+            target=self.stub.run_command, args=(channel, command), daemon=True
+        ).start()
+        return True
+
+
+class SSHStub:
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency: float = 0.01,
+        output_lines: int = 10,
+        line_size: int = 80,
+        root: str = None,
+    ):
+        """SSH server with simulated command latency and output size.
+
+        Arguments:
+            host {str} -- address to listen on
+            port {int} -- port to listen on, 0 for any free port
+            latency {float} -- seconds every command takes
+            output_lines {int} -- lines of output of every command
+            line_size {int} -- bytes in every line of output
+            root {str} -- directory for SFTP, temporary one if not set
+        """
+        self.log = logging.getLogger(__name__)
+        self.latency = latency
+        self.output = (b"x" * (line_size - 1) + b"\n") * output_lines
+        self.root = root or tempfile.mkdtemp(prefix="asst-stub-")
+        self.key = paramiko.RSAKey.generate(2048)
+        self.commands = 0
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind((host, port))
+        self._sock.listen(128)
+        self.host, self.port = self._sock.getsockname()
+        self._transports: list = []
+        self._running = False
+
+    def run_command(self, channel, command: bytes):
+        time.sleep(self.latency)
+        self.commands += 1
+        try:
+            channel.sendall(self.output)
+            channel.send_exit_status(0)
+        finally:
+            channel.close()
+
+    def _serve(self, conn: socket.socket):
+        transport = paramiko.Transport(conn)
+        transport.add_server_key(self.key)
+        transport.set_subsystem_handler(
+            "sftp", SFTPServer, StubSFTPServer, root=self.root
+        )
+        self._transports.append(transport)
+        try:
+            transport.start_server(server=StubHandler(self))
+        except paramiko.SSHException:
+            return
+        # Channels are served by callbacks. Transport holds them only weakly,
+        # so accepted ones are kept here until they close, else they are
+        # garbage-collected and closed before the command answers.
+        channels = []
+        while self._running and transport.is_active():
+            channel = transport.accept(1)
+            channels = [each for each in channels if not each.closed]
+            if channel is not None:
+                channels.append(channel)
+
+    def _accept(self):
+        while self._running:
+            try:
+                conn, _ = self._sock.accept()
+            except OSError:
+                break
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def start(self):
+        self._running = True
+        threading.Thread(target=self._accept, daemon=True).start()
+        self.log.info(f"ssh stub listens on {self.host}:{self.port}")
+        return self
+
+    def check(self, timeout: float = 10):
+        """Smoke check: one exec through plain paramiko client
+
+        Raises:
+            RuntimeError: if stub doesn't answer with its output
+        """
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        try:
+            client.connect(
+                self.host,
+                self.port,
+                "bench",
+                "bench",
+                timeout=timeout,
+                look_for_keys=False,
+                allow_agent=False,
+            )
+            _, stdout, _ = client.exec_command("true", timeout=timeout)
+            output = stdout.read()
+            response_code = stdout.channel.recv_exit_status()
+        except (OSError, paramiko.SSHException) as e:
+            raise RuntimeError(f"ssh stub {self.host}:{self.port} failed: {e}")
+        finally:
+            client.close()
+        if response_code != 0 or output != self.output:
+            raise RuntimeError(
+                f"ssh stub {self.host}:{self.port} answered {response_code} "
+                f"with {len(output)} of {len(self.output)} bytes"
+            )
+
+    def stop(self):
+        self._running = False
+        self._sock.close()
+        for transport in self._transports:
+            transport.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    stub = SSHStub().start()
+    try:
+        stub.check()
+        stub.log.info("ssh stub smoke check passed")
+    finally:
+        stub.stop()